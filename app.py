@@ -1,24 +1,67 @@
 #!/usr/bin/env python
+# Cooperative I/O has to be patched in before anything else is imported
+import cooperative
+cooperative.monkey_patch()
+
 import os
+import sys
+import copy
 import json
 import time
 import hashlib
 import secrets
 import re
+import atexit
+import threading
 import requests
-from collections import defaultdict, deque
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
 from flask import Flask, render_template, request, redirect, session, url_for, jsonify
 from flask_socketio import SocketIO, join_room, leave_room, send, emit
+from storage import (load_bin, store_bin, get_backend, import_json_files,
+                     bin_lock, bin_transaction, bin_validator)
+from http_cache import conditional, compress
+from sync_queue import SyncQueue
+from jsonbin_client import create_client
+from user_index import UserIndex
+from membership_index import MembershipIndex
+from search_index import MessageSearchIndex
+from unread import UnreadCounters
+from fanout import RoomBatcher
+from presence import Presence
+from user_cards import UserCards
+import shared_state
+
+try:
+    import fcntl
+except ImportError:  # Windows: each process checks the bins on its own
+    fcntl = None
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.secret_key = '%637&&7@(_72)(28'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# Broadcasts cross workers through SOCKETIO_MESSAGE_QUEUE when one is set
+socketio = SocketIO(app,
+                    cors_allowed_origins="*",
+                    async_mode=cooperative.ASYNC_MODE,
+                    **shared_state.socketio_options())
+app.after_request(compress)
+
+# Transports the browser tries, in order. Several workers behind one gunicorn
+# need "websocket" alone: polling requests would land on workers that don't
+# hold the session
+app.jinja_env.globals['socketio_transports'] = [
+    transport.strip() for transport in os.environ.get(
+        'SOCKETIO_TRANSPORTS', 'polling,websocket').split(',')
+]
 
 # JSONBin.io configuration
-JSONBIN_API_KEY = '$2a$10$RgQMxiMWDn4XRQ70aEs7NuP/rw2z1Ay1qEwR.xrXwTsIIISGQVTVm'
-JSONBIN_ACCESS_KEY_ID = '6870d1a46063391d31ab5ece'
-JSONBIN_BASE_URL = 'https://api.jsonbin.io/v3/b'
+JSONBIN_API_KEY = os.environ.get('JSONBIN_API_KEY', '$2a$10$RgQMxiMWDn4XRQ70aEs7NuP/rw2z1Ay1qEwR.xrXwTsIIISGQVTVm')
+JSONBIN_ACCESS_KEY_ID = os.environ.get('JSONBIN_ACCESS_KEY_ID', '6870d1a46063391d31ab5ece')
+JSONBIN_BASE_URL = os.environ.get('JSONBIN_BASE_URL', 'https://api.jsonbin.io/v3/b')
+
+# One pooled keep-alive session for all JSONBin.io calls
+jsonbin_client = create_client(JSONBIN_BASE_URL)
 
 # Bin IDs for different data types - you'll need to create these bins first
 BINS = {
@@ -34,16 +77,58 @@ BINS = {
     'stories': '6874d6926063391d31ad4e12',
     'verification': '6874d692355eab5e8b1b144e'
 }
+# <BIN>_BIN_ID environment variables override the built-in IDs
+for _bin_name in BINS:
+    BINS[_bin_name] = os.environ.get(f"{_bin_name.upper()}_BIN_ID", BINS[_bin_name])
+
+# JSONBin.io doesn't take empty bins, so empty ones start with a placeholder
+PLACEHOLDER_DATA = {"placeholder": "data"}
+
+# Starting contents of each bin: new local files and JSONBin.io bins get
+# these, and load_json() falls back to them
+DEFAULT_BINS = {
+    'users': PLACEHOLDER_DATA,
+    'rooms': PLACEHOLDER_DATA,
+    'messages': {
+        'general': []
+    },
+    'blocks': PLACEHOLDER_DATA,
+    'banned': {
+        'users': []
+    },
+    'muted': PLACEHOLDER_DATA,
+    'hidden_messages': PLACEHOLDER_DATA,
+    'nickname_cooldowns': PLACEHOLDER_DATA,
+    'premium': PLACEHOLDER_DATA,
+    'stories': PLACEHOLDER_DATA,
+    'verification': PLACEHOLDER_DATA
+}
+
+# Bin IDs confirmed (or created) on earlier runs, so startup can skip probing
+JSONBIN_MANIFEST_FILE = 'jsonbin_manifest.json'
+JSONBIN_MANIFEST_TTL = int(os.environ.get('JSONBIN_MANIFEST_TTL', 24 * 3600))
+
+# Set once the bins on JSONBin.io are confirmed; until then the app serves
+# from local files and the sync queue holds uploads back
+remote_ready = threading.Event()
+remote_status = {'state': 'pending', 'checked_at': None, 'error': None}
+
+def broadcast_presence(version, joined, left):
+    # Clients apply the delta, or ask for a snapshot if they missed a version
+    socketio.emit('online_users_update', {
+        'version': version,
+        'joined': joined,
+        'left': left
+    })
 
-# Track online users
-online_users = {}
-user_sessions = {}
 
-# Anti-spam and security tracking
-message_timestamps = defaultdict(deque)
-failed_login_attempts = defaultdict(list)
-rate_limits = defaultdict(list)
-spam_violations = defaultdict(int)
+# Track online users: online while connected, then for PRESENCE_TTL seconds
+presence = Presence(ttl=int(os.environ.get('PRESENCE_TTL', 60)),
+                    on_change=broadcast_presence,
+                    seen_ttl=int(os.environ.get('PRESENCE_SEEN_DAYS', 30)) * 24 * 3600)
+
+# Socket ids, rate limits and anti-spam tracking, seen by every worker
+shared = shared_state.get_state()
 
 
 def create_jsonbin_bin(bin_name, data, collection_id=None):
@@ -66,10 +151,7 @@ def create_jsonbin_bin(bin_name, data, collection_id=None):
     try:
         print(f"Making request to create bin: {bin_name}")
         print(f"Headers: {headers}")
-        response = requests.post(JSONBIN_BASE_URL,
-                                 json=data,
-                                 headers=headers,
-                                 timeout=10)
+        response = jsonbin_client.post(json=data, headers=headers)
         print(f"Response status: {response.status_code}")
         print(f"Response text: {response.text[:200]}...")
 
@@ -89,7 +171,7 @@ def create_jsonbin_bin(bin_name, data, collection_id=None):
 
 
 def check_bin_exists(bin_id):
-    """Check if a bin exists on JSONBin.io"""
+    """Check if a bin exists on JSONBin.io: True, False, or None if unknown"""
     if not JSONBIN_API_KEY or not bin_id:
         return False
 
@@ -99,11 +181,13 @@ def check_bin_exists(bin_id):
     }
 
     try:
-        url = f"{JSONBIN_BASE_URL}/{bin_id}"
-        response = requests.get(url, headers=headers, timeout=10)
-        return response.status_code == 200
+        response = jsonbin_client.get(bin_id, headers=headers)
     except requests.RequestException:
-        return False
+        return None
+    if response.status_code == 200:
+        return True
+    # Only a 404 means the bin is gone; rate limits and server errors don't
+    return False if response.status_code == 404 else None
 
 
 def migrate_local_data_to_bins():
@@ -111,42 +195,81 @@ def migrate_local_data_to_bins():
     print("Migrating local data to JSONBin.io...")
 
     for bin_name in BINS.keys():
-        local_file = f"{bin_name}.json"
-        if os.path.exists(local_file):
-            try:
-                with open(local_file, 'r', encoding='utf-8') as f:
-                    local_data = json.load(f)
-
-                # Skip if it's just placeholder data
-                if local_data and not (len(local_data) == 1 and "placeholder" in local_data):
-                    print(f"Migrating {bin_name} data...")
-                    if save_json(bin_name, local_data):
-                        print(f"✓ Successfully migrated {bin_name} data")
-                    else:
-                        print(f"✗ Failed to migrate {bin_name} data")
+        if bin_name == 'messages':
+            # History lives in the message store, not in messages.json
+            messages_changed()
+            print(f"✓ Queued {bin_name} data")
+            continue
+        try:
+            local_data = load_bin(bin_name)
+            if local_data is None:
+                continue
+
+            # Skip if it's just placeholder data
+            if local_data and not (len(local_data) == 1 and "placeholder" in local_data):
+                print(f"Migrating {bin_name} data...")
+                if save_json(bin_name, local_data):
+                    print(f"✓ Successfully migrated {bin_name} data")
                 else:
-                    print(f"- Skipping {bin_name} (placeholder data)")
-            except Exception as e:
-                print(f"Error migrating {bin_name}: {e}")
+                    print(f"✗ Failed to migrate {bin_name} data")
+            else:
+                print(f"- Skipping {bin_name} (placeholder data)")
+        except Exception as e:
+            print(f"Error migrating {bin_name}: {e}")
 
 
-default_data = {
-        'users': {"placeholder": "data"},
-        'rooms': {"placeholder": "data"},
-        'messages': {
-            'general': []
-        },
-        'blocks': {"placeholder": "data"},
-        'banned': {
-            'users': []
-        },
-        'muted': {"placeholder": "data"},
-        'hidden_messages': {"placeholder": "data"},
-        'nickname_cooldowns': {"placeholder": "data"},
-        'premium': {"placeholder": "data"},
-        'stories': {"placeholder": "data"},
-        'verification': {"placeholder": "data"}
-    }
+def load_bin_manifest():
+    """Load the cached bin manifest ({bin_name: {'id', 'configured', 'verified_at'}})"""
+    # Workers on other nodes have to see recreated bins too
+    if shared.shared:
+        return shared.hgetall('jsonbin_manifest')
+    try:
+        with open(JSONBIN_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_bin_manifest(manifest):
+    if shared.shared:
+        shared.hset_many('jsonbin_manifest', manifest)
+        return
+    tmp_path = f"{JSONBIN_MANIFEST_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, JSONBIN_MANIFEST_FILE)
+    except OSError as e:
+        print(f"Error saving {JSONBIN_MANIFEST_FILE}: {e}")
+
+
+@contextmanager
+def bin_manifest_lock():
+    """Let one worker at a time check (and recreate) the bins.
+
+    The others wait, then find the bins confirmed in the manifest and don't
+    probe them again, so a missing bin is recreated once, not per worker.
+    """
+    if shared.shared:
+        with shared.lock('jsonbin_manifest', timeout=300):
+            yield
+        return
+    if fcntl is None:
+        yield
+        return
+    with open(f"{JSONBIN_MANIFEST_FILE}.lock", 'a') as lock_file:
+        # Polled rather than blocking, so a cooperative worker's hub keeps running
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(0.2)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 
 def auto_create_bins():
     """Automatically create all required bins if they don't exist"""
@@ -158,36 +281,51 @@ def auto_create_bins():
         return
 
     # Check if we have the Collection ID in environment
-    collection_id = '6870ced0c17214220fc74e76'
-
-    default_data = {
-        'users': {"placeholder": "data"},
-        'rooms': {"placeholder": "data"},
-        'messages': {
-            'general': []
-        },
-        'blocks': {"placeholder": "data"},
-        'banned': {
-            'users': []
-        },
-        'muted': {"placeholder": "data"},
-        'hidden_messages': {"placeholder": "data"},
-        'nickname_cooldowns': {"placeholder": "data"},
-        'premium': {"placeholder": "data"},
-        'stories': {"placeholder": "data"},
-        'verification': {"placeholder": "data"}
-    }
+    collection_id = os.environ.get('JSONBIN_COLLECTION_ID', '6870ced0c17214220fc74e76')
 
     print("Checking and creating JSONBin.io bins...")
     print(f"Using Collection ID: {collection_id}")
 
+    with bin_manifest_lock():
+        check_bins(collection_id)
+
+
+def check_bins(collection_id):
+    """Probe the bins not confirmed recently and recreate missing ones"""
+    # Reuse bins recreated on earlier runs (or by another worker), unless the
+    # configured ID changed
+    manifest = load_bin_manifest()
+    configured = dict(BINS)
+    for bin_name, entry in manifest.items():
+        if bin_name in BINS and entry.get('configured') == BINS[bin_name]:
+            BINS[bin_name] = entry.get('id') or BINS[bin_name]
+
+    # Probe only bins not confirmed recently, all at once instead of one by one
+    now = time.time()
+    to_check = [
+        bin_name for bin_name in DEFAULT_BINS
+        if BINS.get(bin_name) and
+        (manifest.get(bin_name, {}).get('id') != BINS[bin_name]
+         or now - manifest[bin_name].get('verified_at', 0) > JSONBIN_MANIFEST_TTL)
+    ]
+    exists = {}
+    if to_check:
+        with ThreadPoolExecutor(max_workers=len(to_check)) as pool:
+            results = pool.map(lambda name: check_bin_exists(BINS[name]), to_check)
+            exists = dict(zip(to_check, results))
+
     bins_created = False
-    for bin_name, data in default_data.items():
+    for bin_name, data in DEFAULT_BINS.items():
         bin_id = BINS.get(bin_name)
 
-        if bin_id and check_bin_exists(bin_id):
+        if bin_id and exists.get(bin_name, True):
             print(f"✓ {bin_name} bin already exists: {bin_id}")
-        elif bin_id and not check_bin_exists(bin_id):
+            verified_at = now if bin_name in exists else manifest[bin_name]['verified_at']
+        elif bin_id and exists[bin_name] is None:
+            # Keep the bin; it is probed again on the next start
+            print(f"? Couldn't check {bin_name} bin {bin_id}, keeping it")
+            continue
+        elif bin_id:
             print(f"⚠ {bin_name} bin ID configured but bin doesn't exist, creating new one...")
             new_bin_id = create_jsonbin_bin(bin_name, data, collection_id)
             if new_bin_id:
@@ -195,8 +333,10 @@ def auto_create_bins():
                 print(f"✓ Recreated {bin_name} bin: {new_bin_id}")
                 print(f"Update your environment: {bin_name.upper()}_BIN_ID={new_bin_id}")
                 bins_created = True
+                verified_at = now
             else:
                 print(f"✗ Failed to recreate {bin_name} bin")
+                continue
         else:
             print(f"Creating bin for {bin_name}...")
             bin_id = create_jsonbin_bin(bin_name, data, collection_id)
@@ -205,35 +345,65 @@ def auto_create_bins():
                 print(f"✓ Created {bin_name} bin: {bin_id}")
                 print(f"Add to your environment: {bin_name.upper()}_BIN_ID={bin_id}")
                 bins_created = True
+                verified_at = now
             else:
                 print(f"✗ Failed to create {bin_name} bin")
+                continue
+
+        manifest[bin_name] = {
+            'id': BINS[bin_name],
+            'configured': configured.get(bin_name),
+            'verified_at': verified_at
+        }
+
+    save_bin_manifest(manifest)
 
     # If new bins were created, migrate local data
     if bins_created:
         migrate_local_data_to_bins()
 
 
+def verify_remote_bins():
+    """Background startup task: confirm the JSONBin.io bins, then open the gate"""
+    remote_status['state'] = 'checking'
+    try:
+        auto_create_bins()
+        remote_status['state'] = 'ready' if JSONBIN_API_KEY else 'disabled'
+    except Exception as e:
+        remote_status['state'] = 'error'
+        remote_status['error'] = str(e)
+        print(f"Error verifying JSONBin.io bins: {e}")
+    finally:
+        remote_status['checked_at'] = int(time.time())
+        remote_ready.set()
+
+
+_remote_thread = None
+
+
+def start_remote_sync():
+    """Verify JSONBin.io bins in the background so startup never waits on it"""
+    global _remote_thread
+    if remote_ready.is_set() or (_remote_thread and _remote_thread.is_alive()):
+        return
+    _remote_thread = threading.Thread(target=verify_remote_bins,
+                                      name='jsonbin-startup',
+                                      daemon=True)
+    _remote_thread.start()
+
+
+# Under gunicorn each worker starts the check from post_fork in
+# gunicorn.conf.py: with preload_app, threads started in the master would be
+# lost in the fork while holding JSONBin.io client state. Workers take turns
+# through bin_manifest_lock(), so only the first one probes; the rest reuse
+# what it wrote to the manifest. The first request starts the check wherever
+# neither the hook nor a direct run did.
+app.before_request(start_remote_sync)
+
+
 def create_default_json_files():
     """Create default JSON files locally if they don't exist"""
-    default_data = {
-        'users': {"placeholder": "data"},
-        'rooms': {"placeholder": "data"},
-        'messages': {
-            'general': []
-        },
-        'blocks': {"placeholder": "data"},
-        'banned': {
-            'users': []
-        },
-        'muted': {"placeholder": "data"},
-        'hidden_messages': {"placeholder": "data"},
-        'nickname_cooldowns': {"placeholder": "data"},
-        'premium': {"placeholder": "data"},
-        'stories': {"placeholder": "data"},
-        'verification': {"placeholder": "data"}
-    }
-
-    for filename, data in default_data.items():
+    for filename, data in DEFAULT_BINS.items():
         filepath = f"{filename}.json"
         if not os.path.exists(filepath):
             try:
@@ -257,11 +427,10 @@ def jsonbin_request(method, bin_name, data=None):
     }
 
     bin_id = BINS[bin_name]
-    url = f"{JSONBIN_BASE_URL}/{bin_id}"
 
     try:
         if method == 'GET':
-            response = requests.get(url, headers=headers, timeout=5, verify=False)
+            response = jsonbin_client.get(bin_id, headers=headers)
             if response.status_code == 200:
                 return response.json().get('record', {})
             else:
@@ -270,11 +439,10 @@ def jsonbin_request(method, bin_name, data=None):
 
         elif method == 'PUT':
             headers['X-Bin-Versioning'] = 'false'  # Don't create new versions
-            response = requests.put(url,
-                                    json=data,
-                                    headers=headers,
-                                    timeout=5,
-                                    verify=False)
+            if isinstance(data, bytes):  # already-encoded snapshot
+                response = jsonbin_client.put(bin_id, data=data, headers=headers)
+            else:
+                response = jsonbin_client.put(bin_id, json=data, headers=headers)
             return response.status_code == 200
 
     except Exception as e:
@@ -282,16 +450,171 @@ def jsonbin_request(method, bin_name, data=None):
         return {} if method == 'GET' else False
 
 
+def upload_bin(bin_name, data):
+    """Upload one bin to JSONBin.io (called from the background sync queue)"""
+    # Don't upload to bin IDs that startup may still replace
+    if not remote_ready.wait(timeout=30):
+        return False
+    if callable(data):
+        data = data()  # snapshots are built at upload time, not per save
+    if data is None:
+        return True  # the bin is gone locally, nothing to upload
+    return jsonbin_request('PUT', bin_name, data)
+
+
+def encode_bin(bin_name):
+    """A bin's current data, encoded for upload under its lock"""
+    with bin_lock(bin_name):
+        data = load_bin(bin_name)
+        if data is None:
+            return None
+        return json.dumps(data).encode('utf-8')
+
+
+# Saves are written locally right away and uploaded to JSONBin.io in the
+# background; repeated saves of a bin within the interval become one upload.
+sync_queue = SyncQueue(upload_bin,
+                       interval=float(os.environ.get('JSONBIN_SYNC_INTERVAL', 2)),
+                       max_delay=float(os.environ.get('JSONBIN_SYNC_MAX_DELAY', 10)))
+atexit.register(sync_queue.stop)
+
+# Chat history lives in the storage engine's message store (per-room
+# append-only logs for the JSON engine, the messages table for SQLite)
+message_log = get_backend().messages
+
+# The SQLite engine answers user, membership and ban lookups from its indexes
+# instead of having the whole bin loaded and scanned
+indexed_queries = get_backend().name == 'sqlite'
+
+# Full-text index over the message store, updated as messages come and go
+search_index = MessageSearchIndex(message_log)
+
+# Unread counts per user and room, derived from the read_cursors bin
+unread_counters = UnreadCounters(message_log)
+
+# Messages per /messages/<room> page when the client doesn't pass a limit
+MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', 50))
+
+
+def send_message_frame(room, events):
+    """One socket frame to a room: new_message, or new_messages for a batch"""
+    if len(events) == 1:
+        socketio.emit('new_message', events[0], room=room)
+    else:
+        socketio.emit('new_messages', {'room': room, 'messages': events},
+                      room=room)
+
+
+# Room broadcasts of new messages, coalesced over MESSAGE_BATCH_MS (0 = off)
+message_batcher = RoomBatcher(
+    send_message_frame,
+    window=int(os.environ.get('MESSAGE_BATCH_MS', 25)) / 1000)
+
+
+# Encoded history per room for the JSONBin.io backup, with the room version
+# it was read at; each upload reads and encodes only the rooms changed since
+history_backup = {}
+history_backup_lock = threading.Lock()
+
+
+def encode_history():
+    """Every room's newest messages in the old bin layout, encoded for upload"""
+    with history_backup_lock:
+        rooms = message_log.rooms()
+        for room in set(history_backup) - set(rooms):
+            del history_backup[room]
+        for room in rooms:
+            # Version first: a change racing with the read is picked up next time
+            version = message_log.versions.get(room)[0]
+            cached = history_backup.get(room)
+            if cached is None or cached[0] != version:
+                history_backup[room] = (
+                    version,
+                    f"{json.dumps(room)}: {json.dumps(message_log.read(room))}")
+        entries = [history_backup[room][1] for room in rooms]
+    return ('{' + ', '.join(entries) + '}').encode('utf-8')
+
+
+def messages_changed():
+    """Queue a JSONBin.io backup of the message history after it changed"""
+    if JSONBIN_API_KEY and BINS.get('messages'):
+        sync_queue.enqueue('messages', encode_history)
+
+
+def hidden_state(hidden_data, nickname, room):
+    """(upto, ids): a user hides every message up to id `upto` plus `ids`"""
+    entry = hidden_data.get(nickname, {}).get(room)
+    if not entry:
+        return 0, set()
+    if not isinstance(entry, dict):
+        entry = convert_hidden_positions(nickname, room)
+    return entry.get('upto', 0), set(entry.get('ids', []))
+
+
+@bin_transaction('hidden_messages')
+def convert_hidden_positions(nickname, room):
+    """Rewrite an older hidden entry from history positions to ids, once.
+
+    A run of positions from the start (a cleared history) becomes the
+    watermark. The result is saved, so the history is only read the first
+    time the entry is seen.
+    """
+    hidden_data = load_json('hidden_messages')
+    entry = hidden_data.get(nickname, {}).get(room)
+    if isinstance(entry, dict):
+        return entry  # converted by another request in the meantime
+    if not entry:
+        return {'upto': 0, 'ids': []}
+
+    history = message_log.read(room)
+    positions = sorted({
+        index
+        for index in entry if isinstance(index, int) and 0 <= index < len(history)
+    })
+    prefix = 0
+    while prefix < len(positions) and positions[prefix] == prefix:
+        prefix += 1
+    entry = {
+        'upto': history[prefix - 1]['id'] if prefix else 0,
+        'ids': sorted(history[index]['id'] for index in positions[prefix:])
+    }
+    hidden_data[nickname][room] = entry
+    save_json('hidden_messages', hidden_data)
+    return entry
+
+
+def hide_messages(hidden_data, nickname, room, message_ids=(), upto=0):
+    """Hide single messages and/or everything up to an id for a user"""
+    current_upto, hidden_ids = hidden_state(hidden_data, nickname, room)
+    upto = max(upto, current_upto)
+    hidden_ids = sorted(i for i in hidden_ids | set(message_ids) if i > upto)
+    hidden_data.setdefault(nickname, {})[room] = {'upto': upto, 'ids': hidden_ids}
+
+
+def migrate_messages_to_log():
+    """Import the old messages bin into the per-room logs on first start"""
+    if message_log.exists():
+        return
+    messages_data = load_json('messages')
+    message_log.import_rooms(messages_data)
+    print(f"Imported message history for {len(messages_data)} rooms into {message_log.directory}")
+
+
+def migrate_storage():
+    """Bring local data into the configured storage engine on first start"""
+    # No-op for the JSON engine; SQLite imports the *.json files once
+    import_json_files(list(BINS.keys()))
+    migrate_messages_to_log()
+
+
 def load_json(bin_name):
-    """Load data from local file first, then JSONBin.io as backup"""
-    # Try local file first for better performance
+    """Load data from the in-memory store first, then JSONBin.io as backup"""
+    # Local bins are parsed once and served from memory until the file changes
     filepath = f"{bin_name}.json"
     try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if data and data != {"placeholder": "data"}:
-                    return data
+        data = load_bin(bin_name)
+        if data and data != PLACEHOLDER_DATA:
+            return data
     except Exception as e:
         print(f"Error loading {filepath}: {e}")
 
@@ -299,11 +622,10 @@ def load_json(bin_name):
     if JSONBIN_API_KEY and BINS.get(bin_name):
         try:
             data = jsonbin_request('GET', bin_name)
-            if data and data != {"placeholder": "data"}:
+            if data and data != PLACEHOLDER_DATA:
                 # Save to local file for next time
                 try:
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, indent=2, ensure_ascii=False)
+                    store_bin(bin_name, data)
                 except Exception as e:
                     print(f"Error saving to local file {filepath}: {e}")
                 return data
@@ -311,39 +633,25 @@ def load_json(bin_name):
             print(f"Error loading from JSONBin {bin_name}: {e}")
 
     # Return default data if both fail
-    default_data = {
-        'users': {},
-        'rooms': {},
-        'messages': {
-            'general': []
-        },
-        'blocks': {},
-        'banned': {
-            'users': []
-        },
-        'muted': {},
-        'hidden_messages': {},
-        'nickname_cooldowns': {},
-        'premium': {},
-        'stories': {},
-        'verification': {}
-    }
-    return default_data.get(bin_name, {})
+    data = DEFAULT_BINS.get(bin_name, {})
+    return {} if data == PLACEHOLDER_DATA else copy.deepcopy(data)
 
 
 def save_json(bin_name, data):
     """Save data to JSONBin.io and local file as backup"""
-    # Save to local file first
+    # Save to local file first (this also refreshes the in-memory copy)
     filepath = f"{bin_name}.json"
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        store_bin(bin_name, data)
     except Exception as e:
         print(f"Error saving to {filepath}: {e}")
 
-    # Try to save to JSONBin.io
+    # Queue the upload to JSONBin.io instead of blocking the caller on it.
+    # Handlers keep changing the cached dict in place, so only the bin name is
+    # queued; the upload encodes whatever the bin holds then, under its lock,
+    # once for all the saves it covers.
     if JSONBIN_API_KEY and BINS.get(bin_name):
-        return jsonbin_request('PUT', bin_name, data)
+        sync_queue.enqueue(bin_name, partial(encode_bin, bin_name))
 
     return True  # Return True if local save succeeded
 
@@ -359,27 +667,53 @@ def login_required(f):
     return decorated
 
 
-def get_user_list():
-    """Get list of all registered users"""
+# Nickname -> record and IP -> nicknames lookups over the users bin
+user_index = UserIndex()
+membership_index = MembershipIndex()
+
+# Profile cards served by /users/cards, rebuilt when their bins change
+user_cards = UserCards()
+
+
+def load_users():
+    """Load the users bin and keep the nickname index in step with it"""
     users_data = load_json('users')
-    users = set()
+    user_index.sync(users_data)
+    return users_data
+
 
-    for user_id, user_info in users_data.items():
-        if isinstance(user_info, dict) and 'nickname' in user_info:
-            users.add(user_info['nickname'])
+def load_user_cards():
+    """Rebuild the profile cards if the users, verification or premium bin changed"""
+    versions, _ = bin_validator('users', 'verification', 'premium')
+    user_cards.sync(versions, lambda: (load_users(),
+                                       load_json('verification') or {},
+                                       load_json('premium') or {}))
 
-    return list(users)
 
+def find_user(nickname):
+    """Return the stored record for a nickname, or None"""
+    if indexed_queries:
+        users = get_backend().find_users(nickname=nickname)
+        return next(iter(users.values()), None)
+    load_users()
+    return user_index.get(nickname)[1]
 
+
+def get_user_list():
+    """Get list of all registered users"""
+    load_users()
+    return user_index.nicknames()
+
+
+@bin_transaction('users')
 def save_user(ip, nickname, password):
     """Save user to JSONBin users storage"""
     try:
-        users_data = load_json('users')
+        users_data = load_users()
 
         # Check if nickname already exists
-        for user_info in users_data.values():
-            if isinstance(user_info, dict) and user_info.get('nickname') == nickname:
-                return False  # User already exists
+        if nickname in user_index:
+            return False  # User already exists
 
         user_id = hashlib.md5(f"{ip}_{nickname}".encode()).hexdigest()
 
@@ -390,6 +724,7 @@ def save_user(ip, nickname, password):
             'timestamp': int(time.time()),
             'date': time.strftime('%Y-%m-%d %H:%M:%S')
         }
+        user_index.added(user_id, users_data[user_id])
 
         result = save_json('users', users_data)
         if result:
@@ -404,29 +739,34 @@ def save_user(ip, nickname, password):
 
 def verify_user(nickname, password):
     """Verify user credentials"""
-    users_data = load_json('users')
+    user_info = find_user(nickname)
 
-    for user_info in users_data.values():
-        if (isinstance(user_info, dict)
-                and user_info.get('nickname') == nickname):
-            # Check if passwords match (handle both string and encoded passwords)
-            stored_password = user_info.get('password', '')
-            if stored_password == password:
-                return True
-            # Also try comparing with stripped whitespace
-            if stored_password.strip() == password.strip():
-                return True
+    if user_info:
+        # Check if passwords match (handle both string and encoded passwords)
+        stored_password = user_info.get('password', '')
+        if stored_password == password:
+            return True
+        # Also try comparing with stripped whitespace
+        if stored_password.strip() == password.strip():
+            return True
 
     return False
 
 
 def check_account_exists(nickname):
     """Check if account exists"""
-    return nickname in get_user_list()
+    if indexed_queries:
+        return find_user(nickname) is not None
+    load_users()
+    return nickname in user_index
 
 
 def is_user_banned(nickname, ip=None):
     """Check if user is banned"""
+    if indexed_queries:
+        bans = get_backend().active_bans(nickname, ip or None)
+        return (True, bans[0]) if bans else (False, None)
+
     banned_data = load_json('banned')
     current_time = int(time.time())
 
@@ -447,32 +787,28 @@ def is_user_blocked(from_user, to_user):
 
 def check_rate_limit(ip, limit=30, window=60):
     """Check if IP exceeds rate limit"""
-    current_time = time.time()
-    rate_limits[ip] = [t for t in rate_limits[ip] if current_time - t < window]
-    if len(rate_limits[ip]) >= limit:
+    if shared.window_count(f"rate:{ip}", window) >= limit:
         return False
-    rate_limits[ip].append(current_time)
+    shared.window_add(f"rate:{ip}", window)
     return True
 
 
 def check_spam_protection(nickname, message):
     """Advanced spam detection"""
     current_time = time.time()
+    violations = f"spam_violations:{nickname}"
 
-    message_timestamps[nickname] = deque(
-        [t for t in message_timestamps[nickname] if current_time - t < 60])
-
-    if len(message_timestamps[nickname]) >= 10:
-        spam_violations[nickname] += 1
+    if shared.window_count(f"messages:{nickname}", 60, current_time) >= 10:
+        shared.incr(violations)
         return False, "Too many messages. Please slow down."
 
     if len(message) > 10 and len(set(message)) < 4:
-        spam_violations[nickname] += 1
+        shared.incr(violations)
         return False, "Spam detected: repeated characters"
 
     if len(message) > 20 and sum(c.isupper()
                                  for c in message) / len(message) > 0.7:
-        spam_violations[nickname] += 1
+        shared.incr(violations)
         return False, "Spam detected: excessive caps"
 
     url_count = len(
@@ -480,24 +816,25 @@ def check_spam_protection(nickname, message):
             r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
             message))
     if url_count > 2:
-        spam_violations[nickname] += 1
+        shared.incr(violations)
         return False, "Spam detected: too many URLs"
 
-    if spam_violations[nickname] >= 5:
-        muted_data = load_json('muted')
-        if 'general' not in muted_data:
-            muted_data['general'] = {}
-        muted_data['general'][nickname] = {
-            'until': int(current_time) + 3600,
-            'by': 'SYSTEM',
-            'duration': 60,
-            'reason': 'Automated spam detection'
-        }
-        save_json('muted', muted_data)
-        spam_violations[nickname] = 0
+    if shared.get(violations) >= 5:
+        with bin_transaction('muted'):
+            muted_data = load_json('muted')
+            if 'general' not in muted_data:
+                muted_data['general'] = {}
+            muted_data['general'][nickname] = {
+                'until': int(current_time) + 3600,
+                'by': 'SYSTEM',
+                'duration': 60,
+                'reason': 'Automated spam detection'
+            }
+            save_json('muted', muted_data)
+        shared.delete(violations)
         return False, "You have been muted for 1 hour due to spam violations"
 
-    message_timestamps[nickname].append(current_time)
+    shared.window_add(f"messages:{nickname}", 60, current_time)
     return True, None
 
 
@@ -562,11 +899,7 @@ def login():
                 error='Incorrect CAPTCHA. Please try again.',
                 captcha_question=session.get('captcha_question'))
 
-        current_time = time.time()
-        failed_login_attempts[ip] = [
-            t for t in failed_login_attempts[ip] if current_time - t < 900
-        ]
-        if len(failed_login_attempts[ip]) >= 5:
+        if shared.window_count(f"failed_login:{ip}", 900) >= 5:
             return render_template(
                 'base.html',
                 title='Login',
@@ -599,7 +932,7 @@ def login():
         # Check if user exists and verify password
         if check_account_exists(nick):
             if not verify_user(nick, pwd):
-                failed_login_attempts[ip].append(current_time)
+                shared.window_add(f"failed_login:{ip}", 900)
                 print(f"Login failed for user: {nick}")  # Debug logging
                 return render_template('base.html',
                                        title='Login',
@@ -613,6 +946,7 @@ def login():
                     title='Login',
                     error='Failed to create account. Please try again.',
                     captcha_question=session.get('captcha_question'))
+            start_read_cursors('general', [nick])
 
         session['nickname'] = nick
         import random
@@ -640,8 +974,7 @@ def chat():
         session.clear()
         return redirect(url_for('login'))
 
-    import time
-    online_users[nickname] = {'last_seen': int(time.time()), 'room': 'general'}
+    presence.touch(nickname, 'general')
 
     from flask import make_response
     response = make_response(
@@ -652,33 +985,201 @@ def chat():
     return response
 
 
+def user_bins_validator(*bin_names):
+    """ETag validator for views that depend on some bins and the user"""
+
+    def validator(*args, **kwargs):
+        versions, modified = bin_validator(*bin_names)
+        return (session['nickname'], versions), modified
+
+    return validator
+
+
+def messages_validator(room):
+    """A page of messages changes with the room, membership and hidden state"""
+    versions, modified = bin_validator('rooms', 'hidden_messages')
+    room_version, room_modified = message_log.versions.get(room)
+    return ((session['nickname'], versions, room_version),
+            max(modified, room_modified))
+
+
+def banned_validator():
+    # Bans also drop out of the list as they expire
+    versions, modified = bin_validator('banned')
+    now = int(time.time())
+    expired = sum(1 for ban in load_json('banned').get('users', [])
+                  if 0 <= ban.get('until_timestamp', 0) <= now)
+    return (session['nickname'], versions, expired), modified
+
+
 @app.route('/rooms')
 @login_required
+@conditional(user_bins_validator('rooms'))
 def get_rooms():
     try:
         rooms_data = load_json('rooms')
-        user_rooms = ['general']
-
-        print(f"Loading rooms for user: {session['nickname']}")
-        print(f"Rooms data: {rooms_data}")
-
-        if isinstance(rooms_data, dict):
-            for room_name, room_info in rooms_data.items():
-                if isinstance(room_info, dict) and session['nickname'] in room_info.get('members', []):
-                    user_rooms.append(room_name)
-                    print(f"Added room: {room_name}")
-        else:
+        if not isinstance(rooms_data, dict):
             print(f"Warning: rooms_data is not a dict: {type(rooms_data)}")
+            return jsonify(['general'])
 
-        print(f"Final user_rooms: {user_rooms}")
-        return jsonify(user_rooms)
+        return jsonify(rooms_for_user(session['nickname'], rooms_data))
     except Exception as e:
         print(f"Error in get_rooms: {e}")
         return jsonify(['general'])
 
 
+def rooms_for_user(nickname, rooms_data=None):
+    """Rooms a user can read: general plus every room they are a member of"""
+    if indexed_queries:
+        return ['general'] + get_backend().rooms_of(nickname)
+    membership_index.sync(load_json('rooms') if rooms_data is None else rooms_data)
+    return ['general'] + membership_index.rooms_of(nickname)
+
+
+# Most new messages /sync returns per room before asking for a reload
+SYNC_MESSAGE_LIMIT = 200
+
+
+def build_sync(nickname, payload):
+    """Changes since a client's last-seen message ids, in one response.
+
+    payload: {"rooms": {room: last seen id}, "have": {room: [loaded ids]},
+    "rooms_hash": hash from the previous sync}. For each room the client
+    knows, the response holds the messages after its last id and which of
+    its loaded ids are gone (deleted, or hidden on another device); rooms
+    with too much to catch up on are listed in "reset" instead. The room
+    list is only included when it changed.
+    """
+    hidden_data = load_json('hidden_messages')
+    user_rooms = rooms_for_user(nickname)
+    rooms_hash = hashlib.md5(json.dumps(sorted(user_rooms)).encode()).hexdigest()
+
+    result = {'rooms_hash': rooms_hash, 'messages': {}, 'deleted': {}, 'reset': []}
+    if payload.get('rooms_hash') != rooms_hash:
+        result['rooms'] = user_rooms
+
+    last_seen = payload.get('rooms')
+    have = payload.get('have') or {}
+    if not isinstance(last_seen, dict) or not isinstance(have, dict):
+        return result
+
+    readable = set(user_rooms)
+    for room, last_id in list(last_seen.items())[:100]:
+        if room not in readable or not isinstance(last_id, int):
+            continue
+        loaded = [i for i in have.get(room) or [] if isinstance(i, int)][-500:]
+        since = min(loaded + [last_id]) - 1 if loaded else last_id
+
+        hidden_upto, hidden_ids = hidden_state(hidden_data, nickname, room)
+        window = message_log.page(room,
+                                  SYNC_MESSAGE_LIMIT + len(loaded),
+                                  after=since,
+                                  hidden_upto=hidden_upto,
+                                  hidden_ids=hidden_ids)
+        if len(window) >= SYNC_MESSAGE_LIMIT + len(loaded):
+            result['reset'].append(room)
+            continue
+
+        new = [msg for msg in window if msg['id'] > last_id]
+        if new:
+            result['messages'][room] = new
+        present = {msg['id'] for msg in window}
+        gone = [i for i in loaded if i not in present]
+        if gone:
+            result['deleted'][room] = gone
+    return result
+
+
+@app.route('/sync', methods=['POST'])
+@login_required
+def sync():
+    return jsonify(build_sync(session['nickname'], request.get_json(silent=True) or {}))
+
+
+@bin_transaction('read_cursors')
+def start_read_cursors(room, nicknames):
+    """New members of a room have read everything sent before they joined"""
+    cursors_data = load_json('read_cursors')
+    for nickname in nicknames:
+        unread_counters.joined(nickname, room)
+    last_id = message_log.last_id(room)
+    for nickname in nicknames:
+        cursors_data.setdefault(nickname, {})[room] = last_id
+    save_json('read_cursors', cursors_data)
+
+
+def push_unread(room, sender, count=1):
+    """Count new messages as unread and push the changed counts"""
+    if room == 'general':
+        # Everyone is in general: one broadcast, clients count it themselves
+        unread_counters.message_added(room, sender, count=count)
+        socketio.emit('unread_update', {'room': room, 'increment': count, 'from': sender})
+        return
+
+    members = load_json('rooms').get(room, {}).get('members', [])
+    changed = unread_counters.message_added(room, sender, members, count)
+    for nickname, unread in changed.items():
+        socketio.emit('unread_update', {'room': room, 'count': unread},
+                      room=f"user:{nickname}")
+    if shared.shared:
+        # Members whose counts other workers hold count the messages themselves
+        for nickname in members:
+            if nickname != sender and nickname not in changed:
+                socketio.emit('unread_update',
+                              {'room': room, 'increment': count, 'from': sender},
+                              room=f"user:{nickname}")
+
+
+@app.route('/unread')
+@login_required
+def get_unread():
+    """Unread message counts for all of the user's rooms"""
+    nickname = session['nickname']
+    rooms = rooms_for_user(nickname)
+    # Rooms the user joined without a cursor being set count from the start
+    cursors = load_json('read_cursors').get(nickname, {})
+    hidden_data = load_json('hidden_messages')
+    counts = unread_counters.counts(
+        nickname, rooms, cursors,
+        lambda room: hidden_state(hidden_data, nickname, room))
+    return jsonify(counts=counts, limit=unread_counters.limit)
+
+
+@app.route('/mark_read', methods=['POST'])
+@login_required
+def mark_read():
+    """Move the user's read cursor in a room forward to a message id"""
+    nickname = session['nickname']
+    room = request.json.get('room')
+    message_id = request.json.get('id')
+    if not room or not isinstance(message_id, int):
+        return jsonify(success=False, error='Invalid request')
+    if room not in rooms_for_user(nickname):
+        return jsonify(success=False, error='Access denied'), 403
+
+    message_id = min(message_id, message_log.last_id(room))
+    with bin_transaction('read_cursors'):
+        cursors_data = load_json('read_cursors')
+        cursors = cursors_data.setdefault(nickname, {})
+        if message_id > cursors.get(room, 0):
+            cursors[room] = message_id
+            save_json('read_cursors', cursors_data)
+
+    unread_counters.forget(nickname, room)
+    hidden_data = load_json('hidden_messages')
+    count = unread_counters.counts(
+        nickname, [room], cursors,
+        lambda room: hidden_state(hidden_data, nickname, room))[room]
+
+    # Other tabs of the same user update their badge too
+    socketio.emit('unread_update', {'room': room, 'count': count},
+                  room=f"user:{nickname}")
+    return jsonify(success=True, count=count)
+
+
 @app.route('/messages/<room>')
 @login_required
+@conditional(messages_validator)
 def get_messages(room):
     if room != 'general':
         rooms_data = load_json('rooms')
@@ -686,24 +1187,77 @@ def get_messages(room):
                 room].get('members', []):
             return jsonify([])
 
-    messages_data = load_json('messages')
-    messages = messages_data.get(room, [])
-
     try:
-        hidden_data = load_json('hidden_messages')
-        user_hidden = hidden_data.get(session['nickname'], {}).get(room, [])
-
-        for index in sorted(user_hidden, reverse=True):
-            if 0 <= index < len(messages):
-                messages.pop(index)
+        hidden_upto, hidden_ids = hidden_state(load_json('hidden_messages'),
+                                               session['nickname'], room)
     except:
-        pass
+        hidden_upto, hidden_ids = 0, set()
+
+    # One page of history next to a message id cursor, newest page by
+    # default; the user's hidden messages are skipped while reading
+    limit = request.args.get('limit', MESSAGE_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, message_log.cap))
+    messages = message_log.page(room,
+                                limit,
+                                before=request.args.get('before', type=int),
+                                after=request.args.get('after', type=int),
+                                hidden_upto=hidden_upto,
+                                hidden_ids=hidden_ids)
 
     return jsonify(messages)
 
 
+@app.route('/search_messages')
+@login_required
+def search_messages():
+    """Ranked full-text search over the rooms the user can read"""
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+    if not query:
+        return jsonify(results=[], total=0, page=page, has_more=False)
+
+    nickname = session['nickname']
+    rooms = set(rooms_for_user(nickname))
+
+    hidden_data = load_json('hidden_messages')
+    hidden = {}
+    for room in hidden_data.get(nickname, {}):
+        if room in rooms:
+            upto, ids = hidden_state(hidden_data, nickname, room)
+            hidden[room] = lambda message_id, upto=upto, ids=ids: (
+                message_id <= upto or message_id in ids)
+
+    # Hits whose message is gone are dropped from the index and the search
+    # re-run, so `total` and the page only count messages that exist
+    while True:
+        total, hits = search_index.search(query,
+                                          rooms,
+                                          offset=(page - 1) * limit,
+                                          limit=limit,
+                                          hidden=hidden)
+        results = []
+        missing = []
+        for score, room, message_id in hits:
+            message = message_log.get(room, message_id)
+            if message is None:
+                missing.append((room, message_id))
+            else:
+                results.append(dict(message, room=room, score=round(score, 3)))
+        if not missing:
+            break
+        for room, message_id in missing:
+            search_index.forget(room, message_id)
+
+    return jsonify(results=results,
+                   total=total,
+                   page=page,
+                   has_more=page * limit < total)
+
+
 @app.route('/users')
 @login_required
+@conditional(user_bins_validator('users'))
 def get_users():
     users = get_user_list()
     return jsonify([u for u in users if u != session['nickname']])
@@ -711,6 +1265,7 @@ def get_users():
 
 @app.route('/search_users')
 @login_required
+@conditional(user_bins_validator('users'))
 def search_users():
     query = request.args.get('q', '').lower()
     users = get_user_list()
@@ -722,13 +1277,14 @@ def search_users():
 
 @app.route('/create_private', methods=['POST'])
 @login_required
+@bin_transaction('rooms', 'read_cursors')
 def create_private():
     target_nick = request.json.get('nick', '').strip()
 
     if not target_nick or target_nick == session['nickname']:
         return jsonify(success=False, error='Invalid username')
 
-    if target_nick not in get_user_list():
+    if not check_account_exists(target_nick):
         return jsonify(success=False, error='User not found')
 
     if is_user_blocked(session['nickname'], target_nick):
@@ -745,13 +1301,16 @@ def create_private():
             'admins': [session['nickname']],
             'type': 'private'
         }
+        membership_index.room_added(room, users)
         save_json('rooms', rooms_data)
+        start_read_cursors(room, users)
 
     return jsonify(success=True, room=room)
 
 
 @app.route('/create_group', methods=['POST'])
 @login_required
+@bin_transaction('rooms', 'read_cursors')
 def create_group():
     group_name = request.json.get('name', '').strip()
 
@@ -767,13 +1326,16 @@ def create_group():
         'admins': [session['nickname']],
         'type': 'group'
     }
+    membership_index.room_added(group_name, [session['nickname']])
     save_json('rooms', rooms_data)
+    start_read_cursors(group_name, [session['nickname']])
 
     return jsonify(success=True, room=group_name)
 
 
 @app.route('/delete_room', methods=['POST'])
 @login_required
+@bin_transaction('rooms')
 def delete_room():
     room = request.json.get('room')
 
@@ -796,17 +1358,21 @@ def delete_room():
                            error='Only admins can delete rooms'), 403
 
     rooms_data.pop(room, None)
+    membership_index.room_removed(room, room_info.get('members', []))
+    for member in room_info.get('members', []):
+        unread_counters.forget(member, room)
     save_json('rooms', rooms_data)
 
-    messages_data = load_json('messages')
-    messages_data.pop(room, None)
-    save_json('messages', messages_data)
+    message_log.drop(room)
+    messages_changed()
+    search_index.room_cleared(room)
 
     return jsonify(success=True)
 
 
 @app.route('/block_user', methods=['POST'])
 @login_required
+@bin_transaction('blocks')
 def block_user():
     room = request.json.get('room')
 
@@ -830,6 +1396,7 @@ def block_user():
 
 @app.route('/unblock_user', methods=['POST'])
 @login_required
+@bin_transaction('blocks')
 def unblock_user():
     room = request.json.get('room')
 
@@ -851,6 +1418,7 @@ def unblock_user():
 
 @app.route('/admin/ban_user', methods=['POST'])
 @login_required
+@bin_transaction('banned')
 def admin_ban_user():
     if session['nickname'] != 'Wixxy':
         return jsonify(success=False, error='Access denied'), 403
@@ -862,15 +1430,9 @@ def admin_ban_user():
     if not username or not reason:
         return jsonify(success=False, error='Username and reason required')
 
-        # Get user's IP from users data
-    users_data = load_json('users')
-    user_ip = None
-
-    for user_info in users_data.values():
-        if isinstance(user_info,
-                      dict) and user_info.get('nickname') == username:
-            user_ip = user_info.get('ip')
-            break
+    # Get user's IP from users data
+    user_info = find_user(username)
+    user_ip = user_info.get('ip') if user_info else None
 
     if not user_ip:
         return jsonify(success=False, error='User not found')
@@ -916,6 +1478,7 @@ def admin_ban_user():
 
 @app.route('/admin/banned_users')
 @login_required
+@conditional(banned_validator)
 def get_banned_users():
     if session['nickname'] != 'Wixxy':
         return jsonify(success=False, error='Access denied'), 403
@@ -936,6 +1499,7 @@ def get_banned_users():
 
 @app.route('/admin/unban_user', methods=['POST'])
 @login_required
+@bin_transaction('banned')
 def unban_user():
     if session['nickname'] != 'Wixxy':
         return jsonify(success=False, error='Access denied'), 403
@@ -956,16 +1520,15 @@ def unban_user():
 @login_required
 def delete_message():
     room = request.json.get('room')
-    message_index = request.json.get('index')
+    message_id = request.json.get('id')
     delete_type = request.json.get('type', 'all')
 
-    messages_data = load_json('messages')
-
-    if room not in messages_data or message_index < 0 or message_index >= len(
-            messages_data[room]):
+    message = None
+    if room and isinstance(message_id, int):
+        message = message_log.get(room, message_id)
+    if message is None:
         return jsonify(success=False, error='Message not found')
 
-    message = messages_data[room][message_index]
     is_own_message = message['nick'] == session['nickname']
     is_admin = session['nickname'] == 'Wixxy'
 
@@ -973,27 +1536,24 @@ def delete_message():
         if not (is_admin or (room != 'general' and is_own_message)):
             return jsonify(success=False, error='Permission denied')
 
-        messages_data[room].pop(message_index)
-        save_json('messages', messages_data)
+        if message_log.remove(room, message_id) is None:
+            return jsonify(success=False, error='Message not found')
+        messages_changed()
+        search_index.removed(room, message_id)
 
         socketio.emit('message_deleted', {
             'room': room,
-            'index': message_index,
+            'id': message_id,
             'deleted_by': session['nickname']
         },
                       room=room)
 
     elif delete_type == 'me':
-        hidden_data = load_json('hidden_messages')
-        user_key = session['nickname']
-
-        if user_key not in hidden_data:
-            hidden_data[user_key] = {}
-        if room not in hidden_data[user_key]:
-            hidden_data[user_key][room] = []
-
-        hidden_data[user_key][room].append(message_index)
-        save_json('hidden_messages', hidden_data)
+        with bin_transaction('hidden_messages'):
+            hidden_data = load_json('hidden_messages')
+            hide_messages(hidden_data, session['nickname'], room, [message_id])
+            save_json('hidden_messages', hidden_data)
+        unread_counters.forget(session['nickname'], room)
 
     return jsonify(success=True)
 
@@ -1006,14 +1566,65 @@ def admin_clear_chat():
 
     room = request.json.get('room', 'general')
 
-    messages_data = load_json('messages')
-    messages_data[room] = []
-    save_json('messages', messages_data)
+    message_log.clear(room)
+    messages_changed()
+    search_index.room_cleared(room)
 
     socketio.emit('chat_cleared', {'room': room}, room=room)
 
     return jsonify(success=True)
 
+# Most messages and target rooms one /forward_messages call may combine
+MAX_FORWARD_MESSAGES = 50
+MAX_FORWARD_ROOMS = 20
+
+
+def forward_to_rooms(nickname, forwards, target_rooms):
+    """Append forwarded copies of messages to each target room.
+
+    `forwards` is a list of (text, original sender). All rooms get all of
+    them in one write to the message store, which takes all or none; only
+    then are counts pushed, with one batched socket frame per room.
+    """
+    timestamp = int(time.time())
+    stored_by_room = message_log.append_rooms({
+        room: [{
+            'nick': nickname,
+            'text': f"📤 Forwarded from {original_sender}:\n{message}",
+            'timestamp': timestamp,
+            'forwarded': True,
+            'original_sender': original_sender
+        } for message, original_sender in forwards]
+        for room in target_rooms
+    })
+    messages_changed()
+
+    for room, stored in stored_by_room.items():
+        search_index.added_many(room, stored)
+        push_unread(room, nickname, len(stored))
+
+        message_batcher.emit_many(room, [{
+            'room': room,
+            'id': message['id'],
+            'nickname': nickname,
+            'message': message['text'],
+            'timestamp': timestamp,
+            'forwarded': True,
+            'original_sender': message['original_sender']
+        } for message in stored])
+
+
+def forward_target_error(rooms_data, nickname, target_room):
+    """Why a user can't forward to a room, or None if they can"""
+    if target_room == 'general':
+        return None
+    if target_room not in rooms_data:
+        return 'Room not found'
+    if nickname not in rooms_data[target_room].get('members', []):
+        return 'Access denied to target room'
+    return None
+
+
 @app.route('/forward_message', methods=['POST'])
 @login_required
 def forward_message():
@@ -1024,50 +1635,79 @@ def forward_message():
     original_sender = data.get('original_sender')
     nickname = session.get('nickname')
 
-    if not target_room or not message:
-        return jsonify({'success': False, 'error': 'Missing required fields'})
-
     rooms_data = load_json('rooms')
 
-    if target_room != 'general':
-        if target_room not in rooms_data:
-            return jsonify({'success': False, 'error': 'Room not found'})
-
-        room_info = rooms_data[target_room]
-        if nickname not in room_info.get('members', []):
-            return jsonify({'success': False, 'error': 'Access denied to target room'})
+    # Messages are forwarded by id from a room the user can read
+    source_room = data.get('room')
+    message_id = data.get('id')
+    if source_room and isinstance(message_id, int):
+        if source_room != 'general' and nickname not in rooms_data.get(
+                source_room, {}).get('members', []):
+            return jsonify({'success': False, 'error': 'Access denied to source room'})
+        source = message_log.get(source_room, message_id)
+        if source is None:
+            return jsonify({'success': False, 'error': 'Message not found'})
+        message = source['text']
+        original_sender = source['nick']
 
-    messages_data = load_json('messages')
-    if target_room not in messages_data:
-        messages_data[target_room] = []
+    if not target_room or not message:
+        return jsonify({'success': False, 'error': 'Missing required fields'})
 
-    # Create forwarded message format
-    forwarded_text = f"📤 Forwarded from {original_sender}:\n{message}"
+    error = forward_target_error(rooms_data, nickname, target_room)
+    if error:
+        return jsonify({'success': False, 'error': error})
 
-    messages_data[target_room].append({
-        'nick': nickname,
-        'text': forwarded_text,
-        'timestamp': int(time.time()),
-        'forwarded': True,
-        'original_sender': original_sender
-    })
+    forward_to_rooms(nickname, [(message, original_sender)], [target_room])
+    return jsonify({'success': True})
 
-    save_json('messages', messages_data)
 
-    socketio.emit('new_message', {
-        'room': target_room,
-        'nickname': nickname,
-        'message': forwarded_text,
-        'timestamp': int(time.time()),
-        'forwarded': True,
-        'original_sender': original_sender
-    }, room=target_room)
+@app.route('/forward_messages', methods=['POST'])
+@login_required
+def forward_messages():
+    """Forward several messages (by room and id) to several rooms at once"""
+    data = request.get_json() or {}
+    sources = data.get('messages') or []
+    target_rooms = data.get('target_rooms') or []
+    nickname = session.get('nickname')
 
-    return jsonify({'success': True})
+    if not sources or not target_rooms:
+        return jsonify({'success': False, 'error': 'Missing required fields'})
+    if (not isinstance(sources, list) or not isinstance(target_rooms, list) or
+            not all(isinstance(room, str) for room in target_rooms)):
+        return jsonify({'success': False, 'error': 'Invalid request'})
+    target_rooms = list(dict.fromkeys(target_rooms))
+    if len(sources) > MAX_FORWARD_MESSAGES or len(target_rooms) > MAX_FORWARD_ROOMS:
+        return jsonify({'success': False, 'error': 'Too many messages or rooms'})
+
+    # Everything is checked before anything is sent: all or nothing
+    rooms_data = load_json('rooms')
+    readable = set(rooms_for_user(nickname, rooms_data))
+    forwards = []
+    for source in sources:
+        source_room = source.get('room') if isinstance(source, dict) else None
+        message_id = source.get('id') if isinstance(source, dict) else None
+        if source_room not in readable:
+            return jsonify({'success': False, 'error': 'Access denied to source room'})
+        message = message_log.get(source_room, message_id) if isinstance(
+            message_id, int) else None
+        if message is None:
+            return jsonify({'success': False, 'error': 'Message not found'})
+        forwards.append((message['text'], message['nick']))
+
+    for target_room in target_rooms:
+        error = forward_target_error(rooms_data, nickname, target_room)
+        if error:
+            return jsonify({'success': False, 'error': error, 'room': target_room})
+
+    forward_to_rooms(nickname, forwards, target_rooms)
+    return jsonify({'success': True,
+                    'forwarded': len(forwards),
+                    'rooms': target_rooms})
 
 
 @app.route('/clear_private_history', methods=['POST'])
 @login_required
+@bin_transaction('hidden_messages')
 def clear_private_history():
     room = request.json.get('room')
 
@@ -1075,18 +1715,14 @@ def clear_private_history():
         return jsonify(success=False,
                        error='Only private chats can be cleared this way')
 
-    messages_data = load_json('messages')
-    if room in messages_data:
+    # Everything sent so far is hidden by moving the watermark, so the cost
+    # doesn't grow with the history
+    last_id = message_log.last_id(room)
+    if last_id:
         hidden_data = load_json('hidden_messages')
-        user_key = session['nickname']
-
-        if user_key not in hidden_data:
-            hidden_data[user_key] = {}
-        if room not in hidden_data[user_key]:
-            hidden_data[user_key][room] = []
-
-        hidden_data[user_key][room] = list(range(len(messages_data[room])))
+        hide_messages(hidden_data, session['nickname'], room, upto=last_id)
         save_json('hidden_messages', hidden_data)
+        unread_counters.forget(session['nickname'], room)
 
     return jsonify(success=True)
 
@@ -1097,21 +1733,19 @@ def admin_stats():
     if session['nickname'] != 'Wixxy':
         return jsonify(success=False, error='Access denied'), 403
 
-    total_users = len(get_user_list())
+    load_users()
+    total_users = len(user_index)
 
-    import time
-    current_time = int(time.time())
     online_count = 0
     online_list = []
 
-    for nickname, data in online_users.items():
-        if current_time - data['last_seen'] < 300:
-            online_count += 1
-            online_list.append({
-                'nickname': nickname,
-                'room': data.get('room', 'Unknown'),
-                'last_seen': data['last_seen']
-            })
+    for nickname, data in presence.entries():
+        online_count += 1
+        online_list.append({
+            'nickname': nickname,
+            'room': data.get('room', 'Unknown'),
+            'last_seen': data['last_seen']
+        })
 
     return jsonify({
         'total_users': total_users,
@@ -1123,17 +1757,34 @@ def admin_stats():
 @app.route('/user_status/<username>')
 @login_required
 def get_user_status(username):
-    import time
-    current_time = int(time.time())
+    last_seen = presence.last_seen(username)
+    if presence.is_online(username):
+        return jsonify({'status': 'online', 'last_seen': last_seen})
+
+    return jsonify({'status': 'offline', 'last_seen': last_seen})
 
-    if username in online_users:
-        last_seen = online_users[username]['last_seen']
-        if current_time - last_seen < 300:
-            return jsonify({'status': 'online', 'last_seen': last_seen})
-        else:
-            return jsonify({'status': 'offline', 'last_seen': last_seen})
 
-    return jsonify({'status': 'offline', 'last_seen': None})
+# Most users one /users/cards request may ask for
+MAX_USER_CARDS = 200
+
+
+@app.route('/users/cards')
+@login_required
+def get_user_cards():
+    """Avatar, bio, status and badges of many users: ?users=a,b,c"""
+    nicknames = list(dict.fromkeys(
+        name for name in request.args.get('users', '').split(',') if name))
+    if len(nicknames) > MAX_USER_CARDS:
+        return jsonify(error=f'At most {MAX_USER_CARDS} users per request'), 400
+
+    load_user_cards()
+    cards = {}
+    for nickname, (online, last_seen) in presence.statuses(nicknames).items():
+        card = user_cards.get(nickname)
+        card['status'] = 'online' if online else 'offline'
+        card['last_seen'] = last_seen
+        cards[nickname] = card
+    return jsonify(cards=cards)
 
 
 @app.route('/room_stats/<room>')
@@ -1145,21 +1796,17 @@ def get_room_stats(room):
                 room].get('members', []):
             return jsonify({'error': 'Access denied'}), 403
 
-    import time
-    current_time = int(time.time())
-
     if room == 'general':
-        online_count = sum(
-            1 for nickname, data in online_users.items() if current_time -
-            data['last_seen'] < 300 and data.get('room') == 'general')
-        total_count = len(get_user_list())
+        online_count = sum(1 for nickname, data in presence.entries()
+                           if data.get('room') == 'general')
+        load_users()
+        total_count = len(user_index)
     else:
         rooms_data = load_json('rooms')
         members = rooms_data.get(room, {}).get('members', [])
         total_count = len(members)
         online_count = sum(1 for member in members
-                           if member in online_users and current_time -
-                           online_users[member]['last_seen'] < 300)
+                           if presence.is_online(member))
 
     return jsonify({'online_count': online_count, 'total_count': total_count})
 
@@ -1167,14 +1814,13 @@ def get_room_stats(room):
 @app.route('/get_user_profile/<username>')
 @login_required
 def get_user_profile(username):
-    users_data = load_json('users')
-    for user_info in users_data.values():
-        if isinstance(user_info, dict) and user_info.get('nickname') == username:
-            return jsonify({
-                'bio': user_info.get('bio', ''),
-                'joined': user_info.get('date', ''),
-                'nickname': username
-            })
+    user_info = find_user(username)
+    if user_info:
+        return jsonify({
+            'bio': user_info.get('bio', ''),
+            'joined': user_info.get('date', ''),
+            'nickname': username
+        })
     return jsonify({'bio': '', 'joined': '', 'nickname': username})
 
 
@@ -1187,6 +1833,8 @@ def is_valid_nickname(nickname):
 
 @app.route('/change_nickname', methods=['POST'])
 @login_required
+@bin_transaction('users', 'nickname_cooldowns', 'rooms', 'blocks',
+                 'hidden_messages', 'read_cursors')
 def change_nickname():
     new_nickname = request.json.get('new_nickname', '').strip()
 
@@ -1200,8 +1848,7 @@ def change_nickname():
     if not is_valid:
         return jsonify(success=False, error=error_msg)
 
-    existing_users = get_user_list()
-    if new_nickname in existing_users:
+    if check_account_exists(new_nickname):
         return jsonify(success=False, error='This nickname already exists. Please choose another one.')
 
     old_nickname = session['nickname']
@@ -1223,12 +1870,11 @@ def change_nickname():
             )
 
     # Update user nickname in users data
-    users_data = load_json('users')
-    for user_info in users_data.values():
-        if isinstance(user_info,
-                      dict) and user_info.get('nickname') == old_nickname:
-            user_info['nickname'] = new_nickname
-            break
+    users_data = load_users()
+    _, user_info = user_index.get(old_nickname)
+    if user_info:
+        user_info['nickname'] = new_nickname
+        user_index.renamed(old_nickname, new_nickname)
 
     save_json('users', users_data)
 
@@ -1240,22 +1886,22 @@ def change_nickname():
 
     session['nickname'] = new_nickname
 
-    if old_nickname in online_users:
-        online_users[new_nickname] = online_users.pop(old_nickname)
+    presence.rename(old_nickname, new_nickname)
 
-    # Update room memberships
+    # Update room memberships: only the rooms the user is in
     rooms_data = load_json('rooms')
-    for room_name, room_info in rooms_data.items():
-        if old_nickname in room_info.get('members', []):
-            room_info['members'] = [
-                new_nickname if m == old_nickname else m
-                for m in room_info['members']
-            ]
+    for room_name in rooms_for_user(old_nickname, rooms_data)[1:]:
+        room_info = rooms_data[room_name]
+        room_info['members'] = [
+            new_nickname if m == old_nickname else m
+            for m in room_info['members']
+        ]
         if old_nickname in room_info.get('admins', []):
             room_info['admins'] = [
                 new_nickname if a == old_nickname else a
                 for a in room_info['admins']
             ]
+    membership_index.renamed(old_nickname, new_nickname)
     save_json('rooms', rooms_data)
 
     # Update blocks data
@@ -1276,6 +1922,12 @@ def change_nickname():
     except:
         pass
 
+    cursors_data = load_json('read_cursors')
+    if old_nickname in cursors_data:
+        cursors_data[new_nickname] = cursors_data.pop(old_nickname)
+        save_json('read_cursors', cursors_data)
+    unread_counters.forget(old_nickname)
+
     socketio.emit('nickname_changed', {
         'old_nickname': old_nickname,
         'new_nickname': new_nickname
@@ -1286,6 +1938,7 @@ def change_nickname():
 
 @app.route('/leave_group', methods=['POST'])
 @login_required
+@bin_transaction('rooms')
 def leave_group():
     room = request.json.get('room')
 
@@ -1305,6 +1958,8 @@ def leave_group():
 
     if session['nickname'] in room_info['members']:
         room_info['members'].remove(session['nickname'])
+        membership_index.removed(room, session['nickname'])
+        unread_counters.forget(session['nickname'], room)
 
     if session['nickname'] in room_info.get('admins', []):
         room_info['admins'].remove(session['nickname'])
@@ -1314,9 +1969,9 @@ def leave_group():
 
     if not room_info['members']:
         del rooms_data[room]
-        messages_data = load_json('messages')
-        messages_data.pop(room, None)
-        save_json('messages', messages_data)
+        message_log.drop(room)
+        messages_changed()
+        search_index.room_cleared(room)
 
     save_json('rooms', rooms_data)
     return jsonify(success=True)
@@ -1324,6 +1979,7 @@ def leave_group():
 
 @app.route('/add_to_group', methods=['POST'])
 @login_required
+@bin_transaction('rooms', 'read_cursors')
 def add_to_group():
     room = request.json.get('room')
     username = request.json.get('username')
@@ -1341,12 +1997,14 @@ def add_to_group():
     if session['nickname'] not in room_info.get('admins', []):
         return jsonify(success=False, error='Only admins can add members')
 
-    if username not in get_user_list():
+    if not check_account_exists(username):
         return jsonify(success=False, error='User not found')
 
     if username not in room_info['members']:
         room_info['members'].append(username)
+        membership_index.added(room, username)
         save_json('rooms', rooms_data)
+        start_read_cursors(room, [username])
 
         socketio.emit(
             'room_update', {
@@ -1361,6 +2019,7 @@ def add_to_group():
 
 @app.route('/kick_from_group', methods=['POST'])
 @login_required
+@bin_transaction('rooms')
 def kick_from_group():
     room = request.json.get('room')
     username = request.json.get('username')
@@ -1383,6 +2042,8 @@ def kick_from_group():
 
     if username in room_info['members']:
         room_info['members'].remove(username)
+        membership_index.removed(room, username)
+        unread_counters.forget(username, room)
 
     if username in room_info.get('admins', []):
         room_info['admins'].remove(username)
@@ -1402,6 +2063,7 @@ def kick_from_group():
 
 @app.route('/mute_user', methods=['POST'])
 @login_required
+@bin_transaction('muted')
 def mute_user():
     room = request.json.get('room')
     username = request.json.get('username')
@@ -1448,6 +2110,7 @@ def mute_user():
 
 @app.route('/get_room_info/<room>')
 @login_required
+@conditional(user_bins_validator('rooms'))
 def get_room_info(room):
     rooms_data = load_json('rooms')
 
@@ -1475,6 +2138,8 @@ def get_room_info(room):
 
 @app.route('/delete_account', methods=['POST'])
 @login_required
+@bin_transaction('users', 'rooms', 'blocks', 'hidden_messages',
+                 'read_cursors')
 def delete_account():
     nickname = session['nickname']
 
@@ -1482,8 +2147,7 @@ def delete_account():
         return jsonify(success=False, error='Account not found')
 
     try:
-        if nickname in online_users:
-            del online_users[nickname]
+        presence.remove(nickname)
 
         socketio.emit('user_activity_update', {
             'user': nickname,
@@ -1491,22 +2155,21 @@ def delete_account():
         })
 
         # Remove from users data
-        users_data = load_json('users')
-        users_data = {
-            k: v
-            for k, v in users_data.items()
-            if not (isinstance(v, dict) and v.get('nickname') == nickname)
-        }
+        users_data = load_users()
+        user_id, _ = user_index.get(nickname)
+        users_data.pop(user_id, None)
+        user_index.removed(nickname)
         save_json('users', users_data)
 
         # Remove from rooms
         rooms_data = load_json('rooms')
         rooms_to_delete = []
-        for room_name, room_info in rooms_data.items():
-            if nickname in room_info.get('members', []):
-                room_info['members'] = [
-                    m for m in room_info['members'] if m != nickname
-                ]
+        for room_name in rooms_for_user(nickname, rooms_data)[1:]:
+            room_info = rooms_data[room_name]
+            room_info['members'] = [
+                m for m in room_info['members'] if m != nickname
+            ]
+            membership_index.removed(room_name, nickname)
             if nickname in room_info.get('admins', []):
                 room_info['admins'] = [
                     a for a in room_info['admins'] if a != nickname
@@ -1536,6 +2199,11 @@ def delete_account():
         except:
             pass
 
+        cursors_data = load_json('read_cursors')
+        if cursors_data.pop(nickname, None) is not None:
+            save_json('read_cursors', cursors_data)
+        unread_counters.forget(nickname)
+
         session.clear()
 
         from flask import jsonify
@@ -1553,8 +2221,8 @@ def delete_account():
 @login_required
 def logout():
     nickname = session.get('nickname')
-    if nickname and nickname in online_users:
-        del online_users[nickname]
+    if nickname:
+        presence.remove(nickname)
 
     socketio.emit('user_activity_update', {
         'user': nickname,
@@ -1620,10 +2288,6 @@ def upload_file():
         file_type = 'video' if is_video else 'image'
 
         # Save to database
-        messages_data = load_json('messages')
-        if room not in messages_data:
-            messages_data[room] = []
-
         message_data = {
             'nick': nickname,
             'text': file_url,
@@ -1632,28 +2296,28 @@ def upload_file():
             'file_type': file_type
         }
 
-        messages_data[room].append(message_data)
-        save_json('messages', messages_data)
+        message_log.append(room, message_data)
+        messages_changed()
+        search_index.added(room, message_data)
+        push_unread(room, nickname)
 
         # Broadcast to all users in room in real-time
-        socketio.emit('new_message', {
+        event = {
             'room': room,
+            'id': message_data['id'],
             'nickname': nickname,
             'message': file_url,
             'timestamp': timestamp,
             'type': 'media',
             'file_type': file_type
-        }, room=room)
+        }
+        message_batcher.emit(room, event)
 
-        # Also emit to sender for immediate feedback
-        socketio.emit('message_sent', {
-            'room': room,
-            'nickname': nickname,
-            'message': file_url,
-            'timestamp': timestamp,
-            'type': 'media',
-            'file_type': file_type
-        })
+        # Acknowledge to the uploading socket only (or the uploader's tabs)
+        sid = request.form.get('sid')
+        if shared.hget('user_sessions', sid) != nickname:
+            sid = f"user:{nickname}"
+        socketio.emit('message_sent', event, room=sid)
 
         return jsonify(success=True, url=file_url, type=file_type)
 
@@ -1696,13 +2360,15 @@ def upload_avatar():
         avatar_url = f"/static/avatars/{filename}"
 
         # Update user's avatar in users data
-        users_data = load_json('users')
-        for user_info in users_data.values():
-            if isinstance(user_info, dict) and user_info.get('nickname') == session['nickname']:
+        with bin_transaction('users'):
+            users_data = load_users()
+            _, user_info = user_index.get(session['nickname'])
+            if user_info:
                 user_info['avatar'] = avatar_url
-                break
+                # Versions the avatar URL: the file name stays the same
+                user_info['avatar_updated'] = int(time.time())
 
-        save_json('users', users_data)
+            save_json('users', users_data)
 
         # Broadcast avatar update to all users
         socketio.emit('avatar_updated', {
@@ -1719,26 +2385,25 @@ def upload_avatar():
 @app.route('/get_user_avatar/<username>')
 @login_required
 def get_user_avatar(username):
-    users_data = load_json('users')
-    for user_info in users_data.values():
-        if isinstance(user_info, dict) and user_info.get('nickname') == username:
-            return jsonify({'avatar': user_info.get('avatar', '/static/default-avatar.png')})
+    user_info = find_user(username)
+    if user_info:
+        return jsonify({'avatar': user_info.get('avatar', '/static/default-avatar.png')})
     return jsonify({'avatar': '/static/default-avatar.png'})
 
 
 @app.route('/update_profile', methods=['POST'])
 @login_required
+@bin_transaction('users')
 def update_profile():
     bio = request.json.get('bio', '').strip()
 
     if len(bio) > 200:
         return jsonify(success=False, error='Bio too long (max 200 characters)')
 
-    users_data = load_json('users')
-    for user_info in users_data.values():
-        if isinstance(user_info, dict) and user_info.get('nickname') == session['nickname']:
-            user_info['bio'] = bio
-            break
+    users_data = load_users()
+    _, user_info = user_index.get(session['nickname'])
+    if user_info:
+        user_info['bio'] = bio
 
     save_json('users', users_data)
 
@@ -1771,20 +2436,9 @@ def on_join(data):
 
     join_room(room)
 
-    import time
-    online_users[nickname] = {'last_seen': int(time.time()), 'room': room}
-    user_sessions[request.sid] = nickname
-
-    # Broadcast to all users about status change
-    socketio.emit('user_activity_update', {
-        'user': nickname,
-        'room': room,
-        'action': 'joined'
-    })
-
-    # Send updated online users list
-    online_users_list = list(online_users.keys())
-    socketio.emit('online_users_update', {'users': online_users_list})
+    # Coming online reaches everyone as part of the next presence delta
+    presence.touch(nickname, room, request.sid)
+    shared.hset('user_sessions', request.sid, nickname)
 
     socketio.emit('user_count_update', room=room)
 
@@ -1796,24 +2450,9 @@ def on_leave(data):
 
 @socketio.on('disconnect')
 def on_disconnect():
-    if request.sid in user_sessions:
-        nickname = user_sessions[request.sid]
-        if nickname in online_users:
-            import time
-            online_users[nickname]['last_seen'] = int(time.time())
-
-            # Broadcast user disconnect
-            socketio.emit('user_activity_update', {
-                'user': nickname,
-                'action': 'offline'
-            })
-
-            # Send updated online users list
-            online_users_list = [user for user, data in online_users.items() 
-                               if int(time.time()) - data['last_seen'] < 300]
-            socketio.emit('online_users_update', {'users': online_users_list})
-
-        del user_sessions[request.sid]
+    # Going offline is broadcast by the presence sweeper once the TTL runs out
+    presence.disconnect(request.sid)
+    shared.hdel('user_sessions', request.sid)
 
 
 @socketio.on('message')
@@ -1835,9 +2474,8 @@ def on_message(data):
             })
         return
 
-    import time
     current_time = int(time.time())
-    online_users[nickname] = {'last_seen': current_time, 'room': room}
+    presence.touch(nickname, room, request.sid)
 
     spam_ok, spam_error = check_spam_protection(nickname, message)
     if not spam_ok:
@@ -1879,10 +2517,13 @@ def on_message(data):
             })
             return
         else:
-            del muted_data[room][nickname]
-            if not muted_data[room]:
-                del muted_data[room]
-            save_json('muted', muted_data)
+            with bin_transaction('muted'):
+                muted_data = load_json('muted')
+                if nickname in muted_data.get(room, {}):
+                    del muted_data[room][nickname]
+                    if not muted_data[room]:
+                        del muted_data[room]
+                    save_json('muted', muted_data)
 
     if room == 'general':
         if len(message) > 500:
@@ -1893,36 +2534,44 @@ def on_message(data):
             emit('error', {'message': 'Spam detected'})
             return
 
-    messages_data = load_json('messages')
-    if room not in messages_data:
-        messages_data[room] = []
-
-    messages_data[room].append({
+    # Appending is O(1); older history is archived on disk in the background
+    stored = message_log.append(room, {
         'nick': nickname,
         'text': message,
         'timestamp': int(time.time())
     })
-
-    if len(messages_data[room]) > 1000:
-        messages_data[room] = messages_data[room][-1000:]
-
-    save_json('messages', messages_data)
+    messages_changed()
+    search_index.added(room, stored)
+    push_unread(room, nickname)
 
     # Emit message to specific room with better data structure
-    socketio.emit('new_message', {
+    event = {
         'room': room,
+        'id': stored['id'],
         'nickname': nickname,
         'message': message,
         'timestamp': int(time.time())
-    }, room=room)
+    }
+    message_batcher.emit(room, event)
+
+    # Confirmation goes back to the sending socket only
+    emit('message_sent', event)
+
+@socketio.on('connect')
+def on_connect():
+    # A personal room, so updates can be pushed to all of a user's tabs
+    nickname = session.get('nickname')
+    if nickname:
+        join_room(f"user:{nickname}")
+
+
+@socketio.on('sync')
+def handle_sync(data):
+    nickname = session.get('nickname')
+    if not nickname:
+        return
+    emit('sync', build_sync(nickname, data if isinstance(data, dict) else {}))
 
-    # Also emit to sender for confirmation
-    socketio.emit('message_sent', {
-        'room': room,
-        'nickname': nickname,
-        'message': message,
-        'timestamp': int(time.time())
-    })
 
 @socketio.on('join_room')
 def handle_join_room(data):
@@ -1936,9 +2585,8 @@ def handle_join_room(data):
         join_room(room)
 
         # Update online users
-        import time
-        online_users[nickname] = {'last_seen': int(time.time()), 'room': room}
-        user_sessions[request.sid] = nickname
+        presence.touch(nickname, room, request.sid)
+        shared.hset('user_sessions', request.sid, nickname)
 
         # Notify others about the join
         emit('user_joined', {
@@ -1947,8 +2595,8 @@ def handle_join_room(data):
         }, room=room, include_self=False)
 
         # Send online users list to the joining user
-        online_users_list = list(online_users.keys())
-        emit('online_users', {'users': online_users_list})
+        version, online = presence.snapshot()
+        emit('online_users', {'users': online, 'version': version})
 
     except Exception as e:
         print(f"Error in join_room: {e}")
@@ -1960,8 +2608,8 @@ def handle_get_online_users():
         if not nickname:
             return
 
-        online_users_list = list(online_users.keys())
-        emit('online_users', {'users': online_users_list})
+        version, online = presence.snapshot()
+        emit('online_users', {'users': online, 'version': version})
 
     except Exception as e:
         print(f"Error getting online users: {e}")
@@ -1969,13 +2617,21 @@ def handle_get_online_users():
 # Initialize on app startup (works with both gunicorn and direct python run)
 print("Initializing OrbitMess Chat...")
 create_default_json_files()
-auto_create_bins()
+migrate_storage()
+if 'gunicorn' not in sys.modules:
+    start_remote_sync()
 print("Initialization complete!")
 
 @app.route('/health')
 def health_check():
     """Health check endpoint для keepalive"""
-    return jsonify({'status': 'healthy', 'timestamp': time.time()})
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': time.time(),
+        'remote_ready': remote_ready.is_set(),
+        'remote_sync': remote_status,
+        'sync_queue': sync_queue.stats()
+    })
 
 @app.route('/ping')
 def ping():
@@ -2025,9 +2681,8 @@ def get_user_verification(username):
 @app.route('/get_stories')
 def get_stories():
     try:
-        with open('stories.json', 'r', encoding='utf-8') as f:
-            stories = json.load(f)
-        return jsonify(stories)
+        stories = load_bin('stories')
+        return jsonify(stories if stories is not None else [])
     except Exception:
         return jsonify([])
 
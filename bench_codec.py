@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Compare storage codecs: bytes on disk and encode/decode time per bin size.
+
+Usage: python bench_codec.py [sizes...]   (default: 100 1000 10000)
+"""
+import sys
+import time
+import random
+import hashlib
+
+import bin_codec
+
+
+def make_users(n):
+    users = {}
+    for i in range(n):
+        nickname = f"user{i}"
+        ip = f"10.0.{i // 250}.{i % 250}"
+        users[hashlib.md5(f"{ip}_{nickname}".encode()).hexdigest()] = {
+            'ip': ip,
+            'nickname': nickname,
+            'password': f"pass{i}",
+            'timestamp': 1752226389 + i,
+            'date': '2025-07-11 09:33:09',
+            'bio': 'Привіт, я тут новенький' if i % 3 == 0 else ''
+        }
+    return users
+
+
+def make_messages(n, rooms=10):
+    words = ['hello', 'привіт', 'chat', 'orbit', 'message', 'ok', '👍', 'test']
+    messages = {}
+    for i in range(n):
+        room = 'general' if i % rooms == 0 else f"room{i % rooms}"
+        messages.setdefault(room, []).append({
+            'nick': f"user{i % 50}",
+            'text': ' '.join(random.choice(words) for _ in range(8)),
+            'timestamp': 1752246755 + i
+        })
+    return messages
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    random.seed(1)
+
+    print(f"{'bin':<10}{'records':>9}  {'codec':<8}{'bytes':>11}"
+          f"{'encode ms':>11}{'decode ms':>11}")
+    for bin_name, factory in (('users', make_users), ('messages', make_messages)):
+        for size in sizes:
+            data = factory(size)
+            repeat = max(1, 20000 // size)
+            for codec in bin_codec.available_codecs():
+                payload, encode_ms = timed(lambda: bin_codec.encode(data, codec), repeat)
+                decoded, decode_ms = timed(lambda: bin_codec.decode(payload), repeat)
+                assert decoded == data, codec
+                print(f"{bin_name:<10}{size:>9}  {codec:<8}{len(payload):>11}"
+                      f"{encode_ms:>11.2f}{decode_ms:>11.2f}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Files written by the codec start with "OMBIN/<version> <codec>\n"; files
+# without it are plain JSON (old bins, and the "pretty" codec, which stays
+# readable by people and other tools) and are read as JSON.
+MAGIC = b'OMBIN/'
+VERSION = 1
+
+
+def _json_encode(data):
+    return json.dumps(data, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _pretty_encode(data):
+    return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def _json_decode(payload):
+    if orjson:
+        return orjson.loads(payload)
+    return json.loads(payload.decode('utf-8'))
+
+
+ENCODERS = {
+    'json': _json_encode,
+    'pretty': _pretty_encode,
+}
+DECODERS = {
+    'json': _json_decode,
+    'pretty': _json_decode,
+}
+
+if orjson:
+    ENCODERS['orjson'] = orjson.dumps
+    DECODERS['orjson'] = orjson.loads
+
+if msgpack:
+    ENCODERS['msgpack'] = lambda data: msgpack.packb(data, use_bin_type=True)
+    DECODERS['msgpack'] = lambda payload: msgpack.unpackb(payload, raw=False)
+
+
+def available_codecs():
+    return list(ENCODERS)
+
+
+def resolve_codec(name):
+    """Return a usable codec name, falling back to compact JSON"""
+    name = (name or 'json').lower()
+    if name == 'auto':
+        name = 'orjson' if orjson else 'json'
+    if name not in ENCODERS:
+        print(f"Storage codec '{name}' is not available, using json")
+        name = 'json'
+    return name
+
+
+def encode(data, codec='json'):
+    """Serialize a bin with a format/version header (plain JSON for "pretty")"""
+    if codec == 'pretty':
+        return _pretty_encode(data)
+    header = MAGIC + f"{VERSION} {codec}\n".encode('ascii')
+    return header + ENCODERS[codec](data)
+
+
+def decode(payload):
+    """Parse a bin written by encode() or an old headerless JSON file"""
+    if not payload.startswith(MAGIC):
+        return _json_decode(payload)
+
+    header, _, body = payload.partition(b'\n')
+    version, _, codec = header[len(MAGIC):].decode('ascii').partition(' ')
+    if int(version) > VERSION:
+        raise ValueError(f"Bin format version {version} is newer than supported ({VERSION})")
+    decoder = DECODERS.get(codec)
+    if decoder is None:
+        raise ValueError(f"Bin was written with codec '{codec}', which is not installed")
+    return decoder(body)
@@ -0,0 +1,52 @@
+import os
+
+# Socket.IO async mode, also used by gunicorn.conf.py to pick the worker class:
+# threading, gevent or eventlet
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading').lower()
+if ASYNC_MODE not in ('threading', 'gevent', 'eventlet'):
+    print(f"Unknown ASYNC_MODE '{ASYNC_MODE}', using threading")
+    ASYNC_MODE = 'threading'
+
+# Real OS threads available to blocking calls under gevent/eventlet
+BLOCKING_POOL_SIZE = int(os.environ.get('BLOCKING_POOL_SIZE', 8))
+
+_run_in_pool = None
+
+
+def monkey_patch():
+    """Make sockets, sleeps and locks cooperative; call before other imports"""
+    if ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    elif ASYNC_MODE == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+
+
+def _pool():
+    global _run_in_pool
+    if _run_in_pool is None:
+        if ASYNC_MODE == 'gevent':
+            from gevent import get_hub
+            threadpool = get_hub().threadpool
+            threadpool.maxsize = BLOCKING_POOL_SIZE
+            _run_in_pool = lambda fn, *args: threadpool.apply(fn, args)
+        elif ASYNC_MODE == 'eventlet':
+            os.environ.setdefault('EVENTLET_THREADPOOL_SIZE',
+                                  str(BLOCKING_POOL_SIZE))
+            from eventlet import tpool
+            _run_in_pool = tpool.execute
+        else:
+            _run_in_pool = lambda fn, *args: fn(*args)
+    return _run_in_pool
+
+
+def run_blocking(fn, *args):
+    """Call fn(*args) without stalling other greenlets.
+
+    Under gevent/eventlet every "thread" is a greenlet on one OS thread, so
+    a file write or fsync stops all sockets until it returns; such calls run
+    on a bounded pool of real threads instead, and only the calling greenlet
+    waits. In threading mode fn is simply called.
+    """
+    return _pool()(fn, *args)
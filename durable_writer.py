@@ -0,0 +1,194 @@
+import os
+import time
+import threading
+
+from cooperative import run_blocking
+
+MODES = ('fsync', 'batch', 'os')
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(directory):
+    # Makes the rename itself durable; not supported on every platform
+    try:
+        _fsync_path(directory or '.')
+    except OSError:
+        pass
+
+
+def _replace_file(path, payload, fsync):
+    """Write payload to a temp file next to path and atomically rename it"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_batch(batch):
+    """Commit a batch to disk; returns ({path: error}, files written)"""
+    errors = {}
+    directories = set()
+    writes = 0
+    for path, (payload, _) in batch.items():
+        try:
+            if payload is None:
+                _fsync_path(path)
+            else:
+                _replace_file(path, payload, fsync=True)
+                directories.add(os.path.dirname(path))
+                writes += 1
+        except Exception as e:
+            errors[path] = e
+
+    for directory in directories:
+        _fsync_dir(directory)
+    return errors, writes
+
+
+class _Ticket:
+    """Handle for a submitted write; wait() returns once it is committed"""
+
+    def __init__(self, done=False):
+        self.event = threading.Event()
+        self.error = None
+        if done:
+            self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error:
+            raise self.error
+
+
+class DurableWriter:
+    """Crash-safe file writes with a configurable durability mode.
+
+    Whole-file writes always go to a temp file that is renamed over the
+    target, so a crash never leaves a half-written file behind. The mode
+    decides when data reaches the disk:
+
+    - 'fsync': every write is fsynced before the caller continues;
+    - 'batch': writes arriving within `window` seconds are group-committed
+      by a background thread (repeated writes of one file collapse into the
+      latest), and callers wait for that shared commit;
+    - 'os': nothing is fsynced, the OS flushes its buffers when it likes.
+    """
+
+    def __init__(self, mode='batch', window=0.005):
+        if mode not in MODES:
+            print(f"Unknown durability mode '{mode}', using batch")
+            mode = 'batch'
+        self.mode = mode
+        self.window = window
+
+        self._pending = {}  # path -> (payload or None for a sync, [tickets])
+        self._cond = threading.Condition()
+        self._thread = None
+
+        self.commits = 0
+        self.writes = 0
+        self.coalesced = 0
+
+    def write(self, path, payload):
+        """Atomically replace a file with payload (bytes)"""
+        self.submit(path, payload).wait()
+
+    def submit(self, path, payload):
+        """Queue a write and return a ticket to wait() on.
+
+        Writes to one path are applied in submission order, so callers can
+        submit while holding a lock and wait for the disk after releasing it.
+        """
+        if self.mode != 'batch':
+            run_blocking(_replace_file, path, payload, self.mode == 'fsync')
+            if self.mode == 'fsync':
+                run_blocking(_fsync_dir, os.path.dirname(path))
+            self.writes += 1
+            return _Ticket(done=True)
+        return self._submit(path, payload)
+
+    def sync(self, path):
+        """Make data appended to a file durable according to the mode"""
+        if self.mode == 'fsync':
+            run_blocking(_fsync_path, path)
+        elif self.mode == 'batch':
+            self._submit(path, None).wait()
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'commits': self.commits,
+            'writes': self.writes,
+            'coalesced': self.coalesced
+        }
+
+    def _submit(self, path, payload):
+        ticket = _Ticket()
+        with self._cond:
+            previous = self._pending.get(path)
+            if previous:
+                self.coalesced += 1
+                old_payload, tickets = previous
+                # A newer full write supersedes an older one; a sync never
+                # downgrades a pending write
+                if payload is None:
+                    payload = old_payload
+                tickets.append(ticket)
+                self._pending[path] = (payload, tickets)
+            else:
+                self._pending[path] = (payload, [ticket])
+
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='durable-writer',
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return ticket
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Let concurrent writers join this commit
+            time.sleep(self.window)
+            with self._cond:
+                batch, self._pending = self._pending, {}
+            self._commit(batch)
+
+    def _commit(self, batch):
+        # The disk work leaves the event loop; tickets are released back here,
+        # since greenlet events must be set from their own thread
+        errors, writes = run_blocking(_write_batch, batch)
+        self.writes += writes
+        self.commits += 1
+
+        for path, (payload, tickets) in batch.items():
+            for ticket in tickets:
+                ticket.error = errors.get(path)
+                ticket.event.set()
+
+
+def create_writer():
+    """Writer configured by STORAGE_DURABILITY and STORAGE_COMMIT_WINDOW_MS"""
+    return DurableWriter(
+        mode=os.environ.get('STORAGE_DURABILITY', 'batch').lower(),
+        window=float(os.environ.get('STORAGE_COMMIT_WINDOW_MS', 5)) / 1000)
@@ -2,9 +2,19 @@ import os
 
 # Основні налаштування
 bind = "0.0.0.0:5000"
-workers = 1
-worker_class = "gevent"
+# More than one worker needs SHARED_STATE_URL and SOCKETIO_MESSAGE_QUEUE (see
+# .env.example), so workers share online users, limits and broadcasts
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+if workers > 1 and not (os.environ.get('SHARED_STATE_URL')
+                        and os.environ.get('SOCKETIO_MESSAGE_QUEUE')):
+    print("Warning: several workers without SHARED_STATE_URL and "
+          "SOCKETIO_MESSAGE_QUEUE don't see each other's users")
+
+# One setting picks both the worker class and the app's Socket.IO async mode
+async_mode = os.environ.setdefault('ASYNC_MODE', 'gevent').lower()
+worker_class = {'gevent': 'gevent', 'eventlet': 'eventlet'}.get(async_mode, 'gthread')
 worker_connections = 1000
+threads = int(os.environ.get('GUNICORN_THREADS', 100))  # gthread only
 timeout = 60
 keepalive = 5
 max_requests = 2000
@@ -33,4 +43,15 @@ def pre_fork(server, worker):
 
 def post_fork(server, worker):
     server.log.info("Worker spawned and ready (pid: %s)", worker.pid)
-    server.log.info("Worker ready (pid: %s)", worker.pid)
\ No newline at end of file
+    server.log.info("Worker ready (pid: %s)", worker.pid)
+    # JSONBin.io bins are checked from the workers, never in the preloading
+    # master; the first worker probes them and the rest reuse its manifest
+    from app import start_remote_sync
+    start_remote_sync()
+
+def worker_exit(server, worker):
+    # Push queued JSONBin uploads out before the worker goes away, and hand
+    # its online users back to the shared state
+    from app import sync_queue, presence
+    sync_queue.stop(timeout=graceful_timeout)
+    presence.close()
@@ -0,0 +1,101 @@
+import os
+import gzip
+import time
+import uuid
+import hashlib
+from functools import wraps
+
+from flask import request, make_response
+
+from shared_state import get_state
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Room versions behind the ETags live in memory, so tags from before a
+# restart must never match. Without shared state every worker counts on its
+# own, so a forked worker gets its own id too.
+BOOT_ID = uuid.uuid4().hex[:12]
+
+
+def _new_boot_id():
+    global BOOT_ID
+    if not get_state().shared:
+        BOOT_ID = uuid.uuid4().hex[:12]
+
+
+os.register_at_fork(after_in_child=_new_boot_id)
+
+# Bodies smaller than this are sent as they are
+MIN_COMPRESS_SIZE = 1024
+
+
+def conditional(validator):
+    """Serve a GET view with ETag/Last-Modified validators.
+
+    `validator(*args, **kwargs)` gets the view's arguments and returns
+    (key, last_modified): a value that changes whenever the response would,
+    and the unix time of the newest change behind it. When the client already
+    holds that version the view isn't run at all and a 304 goes out.
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key, modified = validator(*args, **kwargs)
+            etag = hashlib.sha1(repr((BOOT_ID, request.full_path,
+                                      key)).encode('utf-8')).hexdigest()[:24]
+            modified = int(modified)
+            # A change later in the same second would carry the same
+            # Last-Modified, so only send it for data that has settled
+            send_modified = modified and time.time() - modified >= 1
+
+            if request.if_none_match:
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                fresh = bool(send_modified and since and
+                             modified <= since.timestamp())
+
+            response = make_response('', 304) if fresh else make_response(
+                view(*args, **kwargs))
+            if response.status_code in (200, 304):
+                response.set_etag(etag, weak=True)
+                if send_modified:
+                    response.last_modified = modified
+                response.cache_control.no_cache = True
+                response.cache_control.private = True
+                response.vary.add('Cookie')
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def compress(response):
+    """after_request hook: brotli/gzip large JSON bodies the client accepts"""
+    if (response.status_code != 200 or response.direct_passthrough or
+            response.mimetype != 'application/json' or
+            'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli and accepted['br']:
+        body, encoding = brotli.compress(data, quality=5), 'br'
+    elif accepted['gzip']:
+        body, encoding = gzip.compress(data, compresslevel=6), 'gzip'
+    else:
+        return response
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,84 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class JsonBinClient:
+    """Shared HTTP session for all JSONBin.io traffic.
+
+    One pooled, keep-alive session is reused for every call, so uploads don't
+    pay a fresh TCP + TLS handshake each time. At most `max_concurrency`
+    requests are in flight at once, timeouts are split into connect and read,
+    and idempotent requests (GET/PUT) are retried with backoff on connection
+    errors and 429/5xx responses.
+    """
+
+    def __init__(self, base_url, max_concurrency=4, connect_timeout=3.05,
+                 read_timeout=10, retries=3, backoff=0.5, verify=True):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify
+        self.max_concurrency = max_concurrency
+        self.retry = Retry(total=retries,
+                           connect=retries,
+                           read=retries,
+                           backoff_factor=backoff,
+                           status_forcelist=(429, 500, 502, 503, 504),
+                           allowed_methods=frozenset(['GET', 'PUT']),
+                           raise_on_status=False)
+        self.reset()
+
+        # A forked worker must not share the parent's sockets, or inherit
+        # permits held by parent threads that don't exist in the child
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        """Start over with a new session and concurrency slots.
+
+        The old session is dropped, not closed: after a fork its sockets
+        still belong to the parent.
+        """
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.max_concurrency,
+                              max_retries=self.retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def url(self, bin_id=None):
+        return f"{self.base_url}/{bin_id}" if bin_id else self.base_url
+
+    def request(self, method, bin_id=None, timeout=None, **kwargs):
+        kwargs.setdefault('verify', self.verify)
+        with self._slots:
+            return self.session.request(method,
+                                        self.url(bin_id),
+                                        timeout=timeout or self.timeout,
+                                        **kwargs)
+
+    def get(self, bin_id, **kwargs):
+        return self.request('GET', bin_id, **kwargs)
+
+    def put(self, bin_id, **kwargs):
+        return self.request('PUT', bin_id, **kwargs)
+
+    def post(self, **kwargs):
+        return self.request('POST', **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def create_client(base_url):
+    """Client configured from JSONBIN_* environment variables"""
+    return JsonBinClient(
+        os.environ.get('JSONBIN_BASE_URL', base_url),
+        max_concurrency=int(os.environ.get('JSONBIN_MAX_CONCURRENCY', 4)),
+        connect_timeout=float(os.environ.get('JSONBIN_CONNECT_TIMEOUT', 3.05)),
+        read_timeout=float(os.environ.get('JSONBIN_READ_TIMEOUT', 10)),
+        retries=int(os.environ.get('JSONBIN_RETRIES', 3)),
+        verify=os.environ.get('JSONBIN_VERIFY_TLS', 'true').lower() != 'false')
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Concurrent Socket.IO connection capacity of a running server.
+
+Opens connections in steps and keeps them all open, measuring at each step
+how long connecting takes, how many connections fail, and how quickly the
+server still answers /ping (and, with --cookie, a socket round trip) while
+it holds them. Stops once connections fail or the server slows down past
+--max-latency; the last healthy step is the capacity.
+
+Compare the async modes by running it against each:
+
+    ASYNC_MODE=threading python app.py
+    gunicorn -c gunicorn.conf.py app:app          (gevent by default)
+
+Usage: python loadtest.py [url] [--clients 1000] [--step 100] [--cookie session=...]
+"""
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def ms(value):
+    return f"{value * 1000:8.1f}"
+
+
+class LoadClient:
+    """One Socket.IO connection held open for the whole test"""
+
+    def __init__(self, url, cookie=None):
+        self.url = url
+        self.headers = {'Cookie': cookie} if cookie else {}
+        self.sio = socketio.Client(reconnection=False)
+        self.reply = threading.Event()
+        self.sio.on('online_users', lambda data: self.reply.set())
+
+    def connect(self, timeout):
+        start = time.time()
+        self.sio.connect(self.url, headers=self.headers, wait_timeout=timeout)
+        return time.time() - start
+
+    def round_trip(self, timeout):
+        """Time from get_online_users to the server's online_users reply"""
+        self.reply.clear()
+        start = time.time()
+        self.sio.emit('get_online_users')
+        if not self.reply.wait(timeout):
+            return None
+        return time.time() - start
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+def ping_latencies(url, count=20, timeout=10):
+    latencies = []
+    for _ in range(count):
+        start = time.time()
+        try:
+            requests.get(f"{url}/ping", timeout=timeout)
+            latencies.append(time.time() - start)
+        except requests.RequestException:
+            latencies.append(timeout)
+    return latencies
+
+
+def run(args):
+    clients = []
+    pool = ThreadPoolExecutor(max_workers=args.parallel)
+    print(f"{'open':>6} {'failed':>7} {'connect p50':>12} {'p95':>8} "
+          f"{'ping p50':>9} {'p95':>8} {'socket rtt p95':>15}")
+
+    capacity = 0
+    try:
+        while len(clients) < args.clients:
+            batch = [LoadClient(args.url, args.cookie)
+                     for _ in range(min(args.step, args.clients - len(clients)))]
+            connect_times, failed = [], 0
+            for client, result in zip(batch, pool.map(
+                    lambda c: _try_connect(c, args.timeout), batch)):
+                if result is None:
+                    failed += 1
+                    client.close()
+                else:
+                    connect_times.append(result)
+                    clients.append(client)
+
+            pings = ping_latencies(args.url, timeout=args.timeout)
+            rtts = []
+            if args.cookie:
+                sample = clients[-min(len(clients), 50):]
+                rtts = [rtt if rtt is not None else args.timeout
+                        for rtt in pool.map(lambda c: c.round_trip(args.timeout),
+                                            sample)]
+
+            print(f"{len(clients):>6} {failed:>7} {ms(percentile(connect_times, 0.5)):>12} "
+                  f"{ms(percentile(connect_times, 0.95))} {ms(percentile(pings, 0.5)):>9} "
+                  f"{ms(percentile(pings, 0.95))} "
+                  f"{ms(percentile(rtts, 0.95)) if rtts else '-':>15}")
+
+            slow = max(percentile(pings, 0.95),
+                       percentile(rtts, 0.95) if rtts else 0) > args.max_latency
+            if failed > len(batch) * 0.1 or slow:
+                print("Server saturated: "
+                      f"{'connections failing' if failed else 'latency over limit'}")
+                break
+            capacity = len(clients)
+            time.sleep(args.hold)
+    finally:
+        print(f"\nHealthy with {capacity} concurrent connections; closing...")
+        list(pool.map(lambda c: c.close(), clients))
+        pool.shutdown()
+
+
+def _try_connect(client, timeout):
+    try:
+        return client.connect(timeout)
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='most connections to open')
+    parser.add_argument('--step', type=int, default=100,
+                        help='connections added per step')
+    parser.add_argument('--parallel', type=int, default=50,
+                        help='connections opened at the same time')
+    parser.add_argument('--hold', type=float, default=2.0,
+                        help='seconds to hold each step before the next')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--max-latency', type=float, default=1.0,
+                        help='p95 latency in seconds that counts as saturated')
+    parser.add_argument('--cookie',
+                        help='logged-in session cookie ("session=...") to also '
+                        'time socket round trips')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
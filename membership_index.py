@@ -0,0 +1,63 @@
+import threading
+
+
+class MembershipIndex:
+    """Nickname -> rooms lookups for the rooms bin.
+
+    Finding a user's rooms used to mean scanning every room on the server.
+    Like UserIndex, the index is built from the bin object the store hands
+    out and rebuilt whenever that object is replaced; membership changes
+    made in place are applied through room_added(), room_removed(), added(),
+    removed() and renamed().
+    """
+
+    def __init__(self):
+        self._source = None
+        self._by_member = {}  # nickname -> {room: None}, in bin order
+        self._lock = threading.RLock()
+
+    def sync(self, rooms_data):
+        """Make sure the index describes this rooms bin object"""
+        if rooms_data is self._source:
+            return
+        with self._lock:
+            if rooms_data is self._source:
+                return
+            self._by_member = {}
+            for room, info in list(rooms_data.items()):
+                if isinstance(info, dict):
+                    for nickname in info.get('members', []):
+                        self._by_member.setdefault(nickname, {})[room] = None
+            self._source = rooms_data
+
+    def rooms_of(self, nickname):
+        """Rooms a user is a member of, in the order they were created"""
+        return list(self._by_member.get(nickname, ()))
+
+    def room_added(self, room, members):
+        with self._lock:
+            for nickname in members:
+                self._by_member.setdefault(nickname, {})[room] = None
+
+    def room_removed(self, room, members):
+        with self._lock:
+            for nickname in members:
+                self.removed(room, nickname)
+
+    def added(self, room, nickname):
+        with self._lock:
+            self._by_member.setdefault(nickname, {})[room] = None
+
+    def removed(self, room, nickname):
+        with self._lock:
+            rooms = self._by_member.get(nickname)
+            if rooms is not None:
+                rooms.pop(room, None)
+                if not rooms:
+                    del self._by_member[nickname]
+
+    def renamed(self, old_nickname, new_nickname):
+        with self._lock:
+            rooms = self._by_member.pop(old_nickname, None)
+            if rooms:
+                self._by_member.setdefault(new_nickname, {}).update(rooms)
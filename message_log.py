@@ -0,0 +1,774 @@
+import os
+import re
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import deque, OrderedDict
+
+from cooperative import run_blocking
+from shared_state import get_state
+
+
+def _encode(message):
+    return (json.dumps(message, ensure_ascii=False, separators=(',', ':')) +
+            '\n').encode('utf-8')
+
+
+def _decode(lines):
+    """Parse JSONL lines, skipping a half-written line at the end of a log"""
+    messages = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            messages.append(json.loads(line))
+        except ValueError:
+            continue
+    return messages
+
+
+def _read_gzip(path):
+    with open(path, 'rb') as f:
+        return gzip.decompress(f.read())
+
+
+def _reverse_lines(filepath):
+    """Yield the non-empty lines of a file from last to first"""
+    with open(filepath, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        rest = b''
+        while pos > 0:
+            step = min(16384, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + rest).split(b'\n')
+            rest = lines.pop(0)  # may be cut off by the block boundary
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if rest.strip():
+            yield rest
+
+
+def hot_page(hot, complete, limit, before=None, after=None, hidden_upto=0,
+             hidden_ids=()):
+    """Answer a page query from a room's newest messages held in memory.
+
+    `hot` is the ring buffer (oldest first) and `complete` tells whether it
+    holds the room's whole history. Returns None when the answer could
+    include older messages that are not in memory.
+    """
+    oldest = hot[0]['id'] if hot else None
+    # Nothing older than the buffer can show up in the answer
+    covered = complete or (oldest is not None and oldest <= hidden_upto + 1)
+
+    if after is not None:
+        if not covered and (oldest is None or after < oldest - 1):
+            return None
+        return [
+            m for m in hot
+            if m['id'] > after and m['id'] > hidden_upto and
+            (before is None or m['id'] < before) and m['id'] not in hidden_ids
+        ][:limit]
+
+    window = []
+    for message in reversed(hot):
+        if message['id'] <= hidden_upto:
+            break
+        if before is not None and message['id'] >= before:
+            continue
+        if message['id'] in hidden_ids:
+            continue
+        window.append(message)
+        if len(window) >= limit:
+            break
+    else:
+        if not covered:
+            return None
+    window.reverse()
+    return window
+
+
+class RoomVersions:
+    """A change counter per room, so readers can tell a room is unchanged.
+
+    Counters live in the shared state, so changes made by other workers count.
+    """
+
+    def __init__(self, state=None):
+        self.state = state or get_state()
+        self._started = time.time()
+
+    def bump(self, room):
+        """Count a change to a room; returns its new version"""
+        version = self.state.incr(f"room_version:{room}")
+        self.state.hset('room_changed', room, time.time())
+        return version
+
+    def get(self, room):
+        """(version, time of the last change) of a room"""
+        return (self.state.get(f"room_version:{room}"),
+                self.state.hget('room_changed', room, self._started))
+
+
+class _RoomIndex:
+    """Where each live message of a room sits in its log file"""
+
+    def __init__(self):
+        self.offsets = {}  # message id -> byte offset of its line
+        self.first_id = None  # oldest id with a line in the file
+        self.last_id = 0  # newest id ever given out in the room
+        self.lines = 0  # lines in the file, tombstones included
+
+
+class MessageLog:
+    """Per-room message history in three tiers.
+
+    - hot: a ring buffer of each room's newest `hot_size` messages in memory,
+      which answers the usual "latest page" reads without touching disk;
+    - live: an append-only JSONL file per room, so the cost of a write does
+      not depend on how much history other rooms have;
+    - archive: once a room's file grows past cap * (1 + slack), the
+      background compactor keeps its newest `cap` messages and moves the rest
+      into an immutable gzip segment under archive/. Segments are only read
+      when a client pages back past the live file, so history is kept for
+      as long as there is disk for it.
+
+    Every message gets an `id` when it is written: a per-room sequence number
+    that only ever grows, even across deletions, compaction and clears. An
+    in-memory index maps ids to file offsets, so a single message is found
+    without scanning the room. Deleting appends a {"deleted": id} tombstone;
+    the compactor drops deleted messages and their tombstones for good.
+    """
+
+    def __init__(self, directory='message_log', cap=1000, slack=0.25,
+                 writer=None, hot_size=200):
+        self.directory = directory
+        self.writer = writer  # DurableWriter; appends are synced through it
+        self.cap = cap
+        self.compact_at = int(cap * (1 + slack))
+        self.hot_size = hot_size
+        self.manifest_path = os.path.join(directory, 'index.json')
+        self.archive_dir = os.path.join(directory, 'archive')
+
+        self._manifest = None  # room -> file name
+        self._indexes = {}  # room -> _RoomIndex
+        self._hot = {}  # room -> (deque of newest messages, holds everything?)
+        self._segments = {}  # room -> [(first id, last id, path)], oldest first
+        self._segment_cache = OrderedDict()  # path -> messages, a small LRU
+        self._room_locks = {}
+        self._lock = threading.RLock()
+        self.versions = RoomVersions()
+
+        self._to_compact = set()
+        self._compact_cond = threading.Condition()
+        self._compactor = None
+
+    # -- files -------------------------------------------------------------
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def _load_manifest(self):
+        if self._manifest is None:
+            with self._lock:
+                if self._manifest is None:
+                    try:
+                        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                            self._manifest = json.load(f)
+                    except (OSError, ValueError):
+                        self._manifest = {}
+        return self._manifest
+
+    def _replace_file(self, filepath, payload):
+        if self.writer:
+            self.writer.write(filepath, payload)
+            return
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, filepath)
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        payload = json.dumps(self._manifest, ensure_ascii=False).encode('utf-8')
+        self._replace_file(self.manifest_path, payload)
+
+    def _room_file(self, room, create=False):
+        manifest = self._load_manifest()
+        filename = manifest.get(room)
+        if filename is None:
+            if not create:
+                return None
+            with self._lock:
+                filename = manifest.get(room)
+                if filename is None:
+                    # Group names are free text, so file names are sanitized and hashed
+                    safe = re.sub(r'[^A-Za-z0-9_-]', '_', room)[:40]
+                    digest = hashlib.md5(room.encode('utf-8')).hexdigest()[:12]
+                    filename = f"{safe}-{digest}.jsonl"
+                    manifest[room] = filename
+                    self._save_manifest()
+        return os.path.join(self.directory, filename)
+
+    def _room_lock(self, room):
+        lock = self._room_locks.get(room)
+        if lock is None:
+            with self._lock:
+                lock = self._room_locks.setdefault(room, threading.RLock())
+        return lock
+
+    def _index(self, room, filepath):
+        """The room's id index, built by one scan of its file on first use.
+
+        Caller holds the room lock. Logs written before messages had ids are
+        numbered once, in place.
+        """
+        index = self._indexes.get(room)
+        if index is not None:
+            return index
+
+        index = _RoomIndex()
+        segments = self._room_segments(room, filepath)
+        if segments:
+            index.last_id = segments[-1][1]
+        unnumbered = []
+        if os.path.exists(filepath):
+            offset = 0
+            with open(filepath, 'rb') as f:
+                for line in f:
+                    start, offset = offset, offset + len(line)
+                    record = _decode([line])
+                    if not record:
+                        continue
+                    record = record[0]
+                    index.lines += 1
+                    if 'id' in record:
+                        if index.first_id is None:
+                            index.first_id = record['id']
+                        index.offsets[record['id']] = start
+                        index.last_id = max(index.last_id, record['id'])
+                    elif 'deleted' in record:
+                        index.offsets.pop(record['deleted'], None)
+                    elif 'last_id' in record:
+                        index.last_id = max(index.last_id, record['last_id'])
+                    else:
+                        unnumbered.append(record)
+
+        if unnumbered:
+            for message_id, message in enumerate(unnumbered, 1):
+                message['id'] = message_id
+            return self._rewrite(room, filepath, unnumbered)
+        self._indexes[room] = index
+        return index
+
+    def _rewrite(self, room, filepath, messages, last_id=0):
+        """Atomically replace a room's file; caller holds the room lock"""
+        index = _RoomIndex()
+        index.last_id = max([last_id] + [m['id'] for m in messages])
+        index.first_id = messages[0]['id'] if messages else None
+
+        lines = []
+        if not messages or messages[-1]['id'] < index.last_id:
+            # Remembers the newest id, so ids are never given out twice
+            lines.append(_encode({'last_id': index.last_id}))
+        offset = len(lines[0]) if lines else 0
+        for message in messages:
+            line = _encode(message)
+            index.offsets[message['id']] = offset
+            offset += len(line)
+            lines.append(line)
+        index.lines = len(lines)
+
+        self._replace_file(filepath, b''.join(lines))
+        self._indexes[room] = index
+        return index
+
+    def _append_line(self, room, filepath, record):
+        """Append one record to a room's file and keep the index in step"""
+        index, offsets = self._append_lines(room, filepath, [record])
+        return index, offsets[0]
+
+    def _append_lines(self, room, filepath, records):
+        """Append records with a single write; returns (index, their offsets)"""
+        index = self._index(room, filepath)
+        offsets, _ = self._write_lines(filepath, records)
+        index.lines += len(records)
+        return index, offsets
+
+    def _write_lines(self, filepath, records):
+        """Append records to a file; returns (their offsets, size before)"""
+        lines = [_encode(record) for record in records]
+        offsets = []
+        with open(filepath, 'ab') as f:
+            offset = size = f.tell()
+            for line in lines:
+                offsets.append(offset)
+                offset += len(line)
+            f.write(b''.join(lines))
+        return offsets, size
+
+    def _synced(self, room, filepath, lines):
+        # Outside the room lock, so concurrent writers share one commit
+        if self.writer:
+            self.writer.sync(filepath)
+        if lines > self.compact_at:
+            self.schedule_compaction(room)
+
+    # -- archive segments --------------------------------------------------
+
+    def _archive_path(self, filepath):
+        stem = os.path.splitext(os.path.basename(filepath))[0]
+        return os.path.join(self.archive_dir, stem)
+
+    def _room_segments(self, room, filepath):
+        """The room's archive segments, listed from disk on first use"""
+        segments = self._segments.get(room)
+        if segments is None:
+            segments = []
+            directory = self._archive_path(filepath)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    match = re.match(r'^(\d+)-(\d+)\.jsonl\.gz$', name)
+                    if match:
+                        segments.append((int(match.group(1)),
+                                         int(match.group(2)),
+                                         os.path.join(directory, name)))
+            segments.sort()
+            self._segments[room] = segments
+        return segments
+
+    def _read_segment(self, path):
+        with self._lock:
+            messages = self._segment_cache.get(path)
+            if messages is not None:
+                self._segment_cache.move_to_end(path)
+                return messages
+        messages = _decode(run_blocking(_read_gzip, path).split(b'\n'))
+        with self._lock:
+            self._segment_cache[path] = messages
+            while len(self._segment_cache) > 8:
+                self._segment_cache.popitem(last=False)
+        return messages
+
+    def _write_segment(self, room, filepath, messages, segment=None):
+        """Write messages as a new archive segment (or rewrite `segment`)"""
+        directory = self._archive_path(filepath)
+        os.makedirs(directory, exist_ok=True)
+        segments = self._room_segments(room, filepath)
+        if segment:
+            segments.remove(segment)
+            os.remove(segment[2])
+        with self._lock:
+            if segment:
+                self._segment_cache.pop(segment[2], None)
+        if not messages:
+            return
+        first, last = messages[0]['id'], messages[-1]['id']
+        path = os.path.join(directory, f"{first:012d}-{last:012d}.jsonl.gz")
+        payload = run_blocking(gzip.compress,
+                               b''.join(_encode(m) for m in messages))
+        self._replace_file(path, payload)
+        segments.append((first, last, path))
+        segments.sort()
+
+    def _archive(self, room, filepath, messages):
+        """Move messages into new segments of at most `cap` messages each"""
+        for start in range(0, len(messages), self.cap):
+            self._write_segment(room, filepath, messages[start:start + self.cap])
+
+    def _find_archived(self, room, filepath, message_id):
+        for segment in self._room_segments(room, filepath):
+            if segment[0] <= message_id <= segment[1]:
+                for message in self._read_segment(segment[2]):
+                    if message.get('id') == message_id:
+                        return segment, message
+        return None, None
+
+    def _drop_archive(self, room, filepath):
+        shutil.rmtree(self._archive_path(filepath), ignore_errors=True)
+        self._segments[room] = []
+        with self._lock:
+            self._segment_cache.clear()
+
+    # -- hot tier ----------------------------------------------------------
+
+    def _hot_window(self, room, filepath):
+        """(ring buffer, holds the whole history); caller holds the room lock"""
+        hot = self._hot.get(room)
+        if hot is None:
+            self._index(room, filepath)
+            newest = []
+            for message in self._iter_newest(room, filepath):
+                newest.append(message)
+                if len(newest) > self.hot_size:
+                    break
+            complete = len(newest) <= self.hot_size
+            newest = newest[:self.hot_size]
+            newest.reverse()
+            hot = (deque(newest, maxlen=self.hot_size), complete)
+            self._hot[room] = hot
+        return hot
+
+    def _iter_newest(self, room, filepath, before=None):
+        """Live messages from newest to oldest: the room's file, then archives"""
+        oldest_live = None
+        if os.path.exists(filepath):
+            # Reading backwards, a tombstone is always seen before its message
+            deleted = set()
+            for line in _reverse_lines(filepath):
+                record = _decode([line])
+                if not record:
+                    continue
+                record = record[0]
+                if 'id' not in record:
+                    if 'deleted' in record:
+                        deleted.add(record['deleted'])
+                    continue
+                oldest_live = record['id']
+                if record['id'] not in deleted:
+                    yield record
+
+        for first, last, path in reversed(self._room_segments(room, filepath)):
+            if before is not None and first >= before:
+                continue
+            for message in reversed(self._read_segment(path)):
+                # A crash mid-compaction can leave a message in both tiers
+                if oldest_live is None or message['id'] < oldest_live:
+                    yield message
+
+    def _iter_after(self, room, filepath, after):
+        """Live messages with ids above `after`, oldest first.
+
+        Only the archive segments that reach past the cursor are read, and
+        the file is read forward from the first message after it, so a
+        caller that stops early pays for what it takes, not for the history.
+        """
+        index = self._index(room, filepath)
+        first_live = index.first_id
+        for first, last, path in self._room_segments(room, filepath):
+            if last <= after:
+                continue
+            # A crash mid-compaction can leave a message in both tiers
+            if first_live is not None and first >= first_live:
+                break
+            for message in self._read_segment(path):
+                if first_live is not None and message['id'] >= first_live:
+                    break
+                if message['id'] > after:
+                    yield message
+
+        offsets = [offset for message_id, offset in index.offsets.items()
+                   if message_id > after]
+        if not offsets:
+            return
+        with open(filepath, 'rb') as f:
+            f.seek(min(offsets))
+            for line in f:
+                record = _decode([line])
+                # Tombstones and deleted messages are not in the index
+                if record and record[0].get('id') in index.offsets:
+                    yield record[0]
+
+    # -- public API --------------------------------------------------------
+
+    def rooms(self):
+        return list(self._load_manifest().keys())
+
+    def append(self, room, message):
+        """Append one message to a room's log, giving it the next id"""
+        return self.append_many(room, [message])[0]
+
+    def append_many(self, room, messages):
+        """Append messages to a room's log in one write and one sync"""
+        return self.append_rooms({room: messages}).get(room, [])
+
+    def append_rooms(self, batches):
+        """Append messages to several rooms at once: all of them or none.
+
+        `batches` maps a room to its new messages; returns the same mapping
+        with ids given out. Room locks are taken in name order. If writing
+        any room's file fails, the files already written are truncated back
+        and the error is raised, so no room keeps its messages alone.
+        """
+        rooms = sorted(room for room, messages in batches.items() if messages)
+        files = {room: self._room_file(room, create=True) for room in rooms}
+        locks = [self._room_lock(room) for room in rooms]
+        for lock in locks:
+            lock.acquire()
+        try:
+            written = {}  # room -> (offsets, size of the file before)
+            try:
+                for room in rooms:
+                    first_id = self._index(room, files[room]).last_id + 1
+                    for message_id, message in enumerate(batches[room], first_id):
+                        message['id'] = message_id
+                    written[room] = self._write_lines(files[room], batches[room])
+            except Exception:
+                for room, (_, size) in written.items():
+                    os.truncate(files[room], size)
+                raise
+
+            lines = {}
+            for room in rooms:
+                messages = batches[room]
+                index = self._indexes[room]
+                for message, offset in zip(messages, written[room][0]):
+                    index.offsets[message['id']] = offset
+                index.lines += len(messages)
+                if index.first_id is None:
+                    index.first_id = messages[0]['id']
+                index.last_id = messages[-1]['id']
+                lines[room] = index.lines
+
+                hot = self._hot.get(room)
+                if hot:
+                    ring, complete = hot
+                    if complete and len(ring) + len(messages) > ring.maxlen:
+                        self._hot[room] = (ring, False)
+                    ring.extend(messages)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        for room in rooms:
+            self.versions.bump(room)
+            self._synced(room, files[room], lines[room])
+        return {room: batches[room] for room in rooms}
+
+    def get(self, room, message_id):
+        """Return one message by id, or None if it was deleted"""
+        filepath = self._room_file(room)
+        if not filepath:
+            return None
+        with self._room_lock(room):
+            offset = self._index(room, filepath).offsets.get(message_id)
+            if offset is None:
+                return self._find_archived(room, filepath, message_id)[1]
+            with open(filepath, 'rb') as f:
+                f.seek(offset)
+                record = _decode([f.readline()])
+        if record and record[0].get('id') == message_id:
+            return record[0]
+        return None
+
+    def tail(self, room, limit=None):
+        """Return the newest `limit` messages of a room (at most `cap`)"""
+        return self.page(room, limit)
+
+    def page(self, room, limit=None, before=None, after=None, hidden_upto=0,
+             hidden_ids=()):
+        """Return up to `limit` messages next to a cursor, oldest first.
+
+        With `before`, these are the newest messages whose id is below it;
+        with `after`, the oldest ones above it; otherwise the newest ones.
+        Messages up to `hidden_upto` and those in `hidden_ids` are left out.
+        Pages within the hot window come from memory; older ones read only
+        as much of the file and the archive as the window needs, forward
+        from the cursor for `after`.
+        """
+        limit = min(limit or self.cap, self.cap)
+        filepath = self._room_file(room)
+        if not filepath:
+            return []
+        with self._room_lock(room):
+            ring, complete = self._hot_window(room, filepath)
+            window = hot_page(list(ring), complete, limit, before, after,
+                              hidden_upto, hidden_ids)
+            if window is not None:
+                return window
+
+            # Past the hot window; the lock keeps compaction from moving
+            # messages between the file and the archive mid-read
+            window = []
+            if after is not None:
+                for message in self._iter_after(room, filepath,
+                                                max(after, hidden_upto)):
+                    if before is not None and message['id'] >= before:
+                        break
+                    if message['id'] in hidden_ids:
+                        continue
+                    window.append(message)
+                    if len(window) >= limit:
+                        break
+                return window
+
+            for message in self._iter_newest(room, filepath, before):
+                message_id = message['id']
+                if message_id <= hidden_upto:
+                    break
+                if before is not None and message_id >= before:
+                    continue
+                if message_id in hidden_ids:
+                    continue
+                window.append(message)
+                if len(window) >= limit:
+                    break
+        window.reverse()
+        return window
+
+    def read(self, room):
+        """Return the newest `cap` messages of a room, oldest first"""
+        return self.tail(room, self.cap)
+
+    def count(self, room):
+        """Messages in the room's live file (archived ones not included)"""
+        filepath = self._room_file(room)
+        if not filepath:
+            return 0
+        with self._room_lock(room):
+            return len(self._index(room, filepath).offsets)
+
+    def last_id(self, room):
+        """Newest id given out in a room (0 if it has no history)"""
+        filepath = self._room_file(room)
+        if not filepath:
+            return 0
+        with self._room_lock(room):
+            return self._index(room, filepath).last_id
+
+    def replace(self, room, messages):
+        """Overwrite a room's whole history, archive included"""
+        filepath = self._room_file(room, create=True)
+        with self._room_lock(room):
+            # Keep existing ids; number new messages after the newest one
+            last_id = self._index(room, filepath).last_id
+            previous = 0
+            numbered = []
+            for message in messages:
+                message_id = message.get('id')
+                if not isinstance(message_id, int) or message_id <= previous:
+                    last_id = max(last_id, previous) + 1
+                    message = dict(message, id=last_id)
+                previous = message['id']
+                numbered.append(message)
+
+            self._drop_archive(room, filepath)
+            if len(numbered) > self.cap:
+                self._archive(room, filepath, numbered[:-self.cap])
+            self._rewrite(room, filepath, numbered[-self.cap:], last_id)
+            self._hot.pop(room, None)
+        self.versions.bump(room)
+
+    def remove(self, room, message_id):
+        """Delete a message by id; returns it, or None if it wasn't there"""
+        filepath = self._room_file(room)
+        if not filepath:
+            return None
+        with self._room_lock(room):
+            index = self._index(room, filepath)
+            if message_id in index.offsets:
+                message = self.get(room, message_id)
+                index, _ = self._append_line(room, filepath,
+                                             {'deleted': message_id})
+                index.offsets.pop(message_id, None)
+                lines = index.lines
+            else:
+                # Archived: rewrite its (small) segment without the message
+                segment, message = self._find_archived(room, filepath,
+                                                       message_id)
+                if message is None:
+                    return None
+                self._write_segment(room, filepath, [
+                    m for m in self._read_segment(segment[2])
+                    if m['id'] != message_id
+                ], segment)
+                lines = 0
+
+            hot = self._hot.get(room)
+            if hot and any(m['id'] == message_id for m in hot[0]):
+                ring, complete = hot
+                self._hot[room] = (deque((m for m in ring if m['id'] != message_id),
+                                         maxlen=self.hot_size), complete)
+
+        self.versions.bump(room)
+        self._synced(room, filepath, lines)
+        return message
+
+    def clear(self, room):
+        self.replace(room, [])
+
+    def drop(self, room):
+        """Delete a room's log and archive entirely"""
+        filepath = self._room_file(room)
+        if not filepath:
+            return
+        with self._room_lock(room):
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+            self._drop_archive(room, filepath)
+            self._indexes.pop(room, None)
+            self._hot.pop(room, None)
+            self._segments.pop(room, None)
+        self.versions.bump(room)
+        with self._lock:
+            self._manifest.pop(room, None)
+            self._save_manifest()
+
+    def snapshot(self):
+        """Every room's newest messages as one dict, in the old bin layout"""
+        return {room: self.read(room) for room in self.rooms()}
+
+    def import_rooms(self, messages_data):
+        """Seed the log from a {room: [messages]} dict (the old messages bin)"""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._load_manifest()
+            for room, messages in messages_data.items():
+                if isinstance(messages, list):
+                    self.replace(room, messages)
+            self._save_manifest()
+
+    # -- compaction --------------------------------------------------------
+
+    def schedule_compaction(self, room):
+        with self._compact_cond:
+            self._to_compact.add(room)
+            if not self._compactor or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target=self._compact_loop,
+                                                   name='message-log-compactor',
+                                                   daemon=True)
+                self._compactor.start()
+            self._compact_cond.notify()
+
+    def compact(self, room):
+        """Archive all but the newest `cap` live messages of a room.
+
+        The segment is written before the file is rewritten, so a crash in
+        between leaves messages in both tiers (reads skip the copies) rather
+        than losing them.
+        """
+        filepath = self._room_file(room)
+        if not filepath or not os.path.exists(filepath):
+            return
+        with self._room_lock(room):
+            index = self._index(room, filepath)
+            if index.lines <= self.cap:
+                return
+            live = []
+            for message in self._iter_newest(room, filepath):
+                if message['id'] not in index.offsets:
+                    break
+                live.append(message)
+            live.reverse()
+            if len(live) > self.cap:
+                self._archive(room, filepath, live[:-self.cap])
+            self._rewrite(room, filepath, live[-self.cap:], index.last_id)
+
+    def _compact_loop(self):
+        while True:
+            with self._compact_cond:
+                while not self._to_compact:
+                    self._compact_cond.wait()
+                room = self._to_compact.pop()
+            try:
+                self.compact(room)
+            except Exception as e:
+                print(f"Error compacting messages for {room}: {e}")
+                time.sleep(1)
@@ -0,0 +1,340 @@
+import os
+import time
+import uuid
+import threading
+
+from shared_state import get_state
+
+
+class Presence:
+    """Who is online, with TTL expiry and delta notifications.
+
+    A user is online while they have a connected socket, and for `ttl`
+    seconds after their last socket closes or their last socket-less
+    activity. Expiries sit in a timing wheel of one-second slots, so
+    touching a user is O(1) and the sweeper only looks at the users whose
+    slot comes up. Joins and leaves are gathered for `interval` seconds and
+    handed to `on_change(version, joined, left)` as one delta; `version`
+    goes up by one per delta, so a client that missed one can tell and ask
+    for a snapshot().
+
+    Sockets and expiries are tracked by the worker that holds them. The
+    shared state counts, per user, the workers where they are online, so a
+    join or leave is only announced when the first or last of them changes;
+    versions and last-seen times are kept there too. Each worker heartbeats
+    on every flush, and the users of a worker silent for `dead_after`
+    seconds (killed, so it never ran close()) are taken offline by the others.
+    Counts are dropped when they reach zero, and last-seen times older than
+    `seen_ttl` seconds are pruned every `prune_every` seconds.
+    """
+
+    def __init__(self, ttl=60, interval=1.0, on_change=None, state=None,
+                 dead_after=90, seen_ttl=30 * 24 * 3600, prune_every=3600):
+        self.ttl = int(ttl)
+        self.interval = interval
+        self.on_change = on_change
+        self.state = state or get_state()
+        self.dead_after = dead_after
+        self.seen_ttl = seen_ttl
+        self.prune_every = prune_every
+        self.version = 0
+        self._reset()
+
+        # A forked worker is a worker of its own: with the app preloaded it
+        # would otherwise share the master's id, and so its held users and
+        # heartbeat, with every other worker
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Start as a new worker with nobody online, under a new id"""
+        self.worker_id = uuid.uuid4().hex
+        self._pruned = time.time()
+        self._seen = {}  # nickname -> {'last_seen', 'room'}, online or not
+        self._online = set()
+        self._sockets = {}  # nickname -> connected socket ids
+        self._sids = {}  # socket id -> nickname
+        self._expires = {}  # nickname -> tick they go offline, if no socket
+        self._wheel = [set() for _ in range(self.ttl + 2)]
+        self._tick = int(time.time())  # last tick swept
+        self._joined = set()  # changes since the last delta
+        self._left = set()
+        self._touched = set()  # users whose last-seen entry changed
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # -- updates -----------------------------------------------------------
+
+    def touch(self, nickname, room=None, sid=None):
+        """Record activity; a socket id keeps the user online until it closes"""
+        now = time.time()
+        with self._lock:
+            seen = self._seen.setdefault(nickname, {'room': 'general'})
+            seen['last_seen'] = int(now)
+            if room:
+                seen['room'] = room
+            if sid and self._sids.get(sid) != nickname:
+                self._sids[sid] = nickname
+                self._sockets.setdefault(nickname, set()).add(sid)
+            self._touched.add(nickname)
+            self._schedule(nickname, now)
+            self._went_online(nickname)
+        self._start()
+
+    def disconnect(self, sid):
+        """Forget a socket; returns its user, who expires after `ttl`"""
+        now = time.time()
+        with self._lock:
+            nickname = self._sids.pop(sid, None)
+            if nickname is None:
+                return None
+            sockets = self._sockets.get(nickname, set())
+            sockets.discard(sid)
+            if not sockets:
+                self._sockets.pop(nickname, None)
+                self._seen[nickname]['last_seen'] = int(now)
+                self._touched.add(nickname)
+                self._schedule(nickname, now)
+        return nickname
+
+    def remove(self, nickname):
+        """Take a user offline right away (logout, deleted account)"""
+        with self._lock:
+            for sid in self._sockets.pop(nickname, ()):
+                self._sids.pop(sid, None)
+            self._expires.pop(nickname, None)
+            self._seen.pop(nickname, None)
+            self._touched.discard(nickname)
+            self._went_offline(nickname)
+        self.state.hdel('presence_seen', nickname)
+
+    def rename(self, old, new):
+        seen = self.state.hget('presence_seen', old)
+        if seen:
+            self.state.hset('presence_seen', new, seen)
+            self.state.zadd('presence_seen_at', {new: seen['last_seen']})
+            self.state.hdel('presence_seen', old)
+        with self._lock:
+            if old in self._seen:
+                self._seen[new] = self._seen.pop(old)
+                self._touched.discard(old)
+                self._touched.add(new)
+            sockets = self._sockets.pop(old, None)
+            if sockets:
+                self._sockets[new] = sockets
+                for sid in sockets:
+                    self._sids[sid] = new
+            if old in self._expires:
+                self._expires[new] = self._expires.pop(old)
+                self._wheel[self._expires[new] % len(self._wheel)].add(new)
+            if old in self._online:
+                self._went_offline(old)
+                self._went_online(new)
+
+    def _schedule(self, nickname, now):
+        tick = int(now) + self.ttl + 1
+        self._expires[nickname] = tick
+        self._wheel[tick % len(self._wheel)].add(nickname)
+
+    def _went_online(self, nickname):
+        if nickname in self._online:
+            return
+        self._online.add(nickname)
+        if nickname in self._left:
+            self._left.discard(nickname)
+        else:
+            self._joined.add(nickname)
+
+    def _went_offline(self, nickname):
+        if nickname not in self._online:
+            return
+        self._online.discard(nickname)
+        if nickname in self._joined:
+            self._joined.discard(nickname)
+        else:
+            self._left.add(nickname)
+
+    # -- queries -----------------------------------------------------------
+
+    def is_online(self, nickname):
+        return (nickname in self._online
+                or self.state.hget('presence', nickname, 0) > 0)
+
+    def last_seen(self, nickname):
+        seen = self._seen.get(nickname) or self.state.hget('presence_seen',
+                                                           nickname)
+        return seen['last_seen'] if seen else None
+
+    def statuses(self, nicknames):
+        """{nickname: (online, last seen)} for many users, reading only their
+        fields of the shared hashes"""
+        nicknames = list(nicknames)
+        workers = self.state.hmget('presence', nicknames)
+        seen = self.state.hmget('presence_seen', nicknames)
+        result = {}
+        with self._lock:
+            for nickname, count, entry in zip(nicknames, workers, seen):
+                entry = self._seen.get(nickname) or entry
+                result[nickname] = (nickname in self._online or bool(count),
+                                    entry['last_seen'] if entry else None)
+        return result
+
+    def _online_anywhere(self):
+        return {nickname for nickname, workers
+                in self.state.hgetall('presence').items() if workers > 0}
+
+    def entries(self):
+        """[(nickname, {'last_seen', 'room'})] of the users online now"""
+        with self._lock:
+            local = {nickname: dict(self._seen[nickname])
+                     for nickname in self._online}
+        online = sorted(self._online_anywhere() - set(local))
+        seen = dict(zip(online, self.state.hmget('presence_seen', online)))
+        seen.update(local)
+        return [(nickname, seen.get(nickname) or {'room': 'general'})
+                for nickname in seen]
+
+    def snapshot(self):
+        """(version, online nicknames) to resync a client from"""
+        version = self.state.get('presence_version')
+        online = self._online_anywhere()
+        with self._lock:
+            online.update(self._online)
+        return version, sorted(online)
+
+    # -- expiry ------------------------------------------------------------
+
+    def sweep(self, now=None):
+        """Expire users whose slots came up since the last sweep"""
+        tick = int(now if now is not None else time.time())
+        with self._lock:
+            size = len(self._wheel)
+            # After a long stall one turn of the wheel covers every slot
+            start = max(self._tick + 1, tick - size + 1)
+            for current in range(start, tick + 1):
+                slot = self._wheel[current % size]
+                keep = set()
+                for nickname in slot:
+                    expires = self._expires.get(nickname)
+                    if expires is None or expires % size != current % size:
+                        continue  # rescheduled to another slot since
+                    if expires > tick:
+                        keep.add(nickname)  # due on a later turn
+                    elif self._sockets.get(nickname):
+                        del self._expires[nickname]  # connected again
+                    else:
+                        del self._expires[nickname]
+                        self._went_offline(nickname)
+                self._wheel[current % size] = keep
+            self._tick = max(self._tick, tick)
+
+    def flush(self):
+        """Hand the changes gathered since the last flush to on_change"""
+        with self._lock:
+            joined, left = self._joined, self._left
+            self._joined, self._left = set(), set()
+            seen = {nickname: dict(self._seen[nickname])
+                    for nickname in self._touched if nickname in self._seen}
+            self._touched = set()
+        self.state.hset_many('presence_seen', seen)
+        self.state.zadd('presence_seen_at',
+                        {nickname: entry['last_seen'] for nickname, entry in seen.items()})
+
+        held = f"presence_held:{self.worker_id}"
+        self.state.hset('presence_workers', self.worker_id, time.time())
+        for nickname in joined:
+            self.state.hset(held, nickname, 1)
+        for nickname in left:
+            self.state.hdel(held, nickname)
+
+        # Only the first worker a user comes online on makes a join, and
+        # only the last one they leave makes a leave
+        joined = [nickname for nickname in sorted(joined)
+                  if self.state.hincr('presence', nickname, 1) == 1]
+        left = [nickname for nickname in sorted(left)
+                if self.state.hdecr('presence', nickname) == 0]
+        left = sorted(set(left) | set(self.reap()))
+        if not joined and not left:
+            return
+        self.version = self.state.incr('presence_version')
+        if self.on_change:
+            self.on_change(self.version, joined, left)
+
+    def reap(self, now=None):
+        """Take the users of dead workers offline; returns who went offline"""
+        now = time.time() if now is None else now
+        left = []
+        for worker, beat in self.state.hgetall('presence_workers').items():
+            if worker == self.worker_id or now - beat < self.dead_after:
+                continue
+            lock = self.state.lock(f"presence_reap:{worker}")
+            if not lock.acquire(blocking=False):
+                continue  # another worker is reaping it
+            try:
+                if self.state.hget('presence_workers', worker) is None:
+                    continue
+                held = f"presence_held:{worker}"
+                for nickname in self.state.hgetall(held):
+                    self.state.hdel(held, nickname)
+                    if self.state.hdecr('presence', nickname) == 0:
+                        left.append(nickname)
+                self.state.hdel('presence_workers', worker)
+                print(f"Presence: took {len(left)} users of dead worker {worker} offline")
+            finally:
+                lock.release()
+        return left
+
+    def prune(self, now=None):
+        """Forget the last-seen times of users offline for over `seen_ttl`"""
+        cutoff = (time.time() if now is None else now) - self.seen_ttl
+        with self._lock:
+            for nickname in [nickname for nickname, seen in self._seen.items()
+                             if seen['last_seen'] <= cutoff and
+                             nickname not in self._online]:
+                del self._seen[nickname]
+
+        stale = self.state.zpop_upto('presence_seen_at', cutoff)
+        if not stale:
+            return
+        # Users seen again since, or still connected, keep their entry and
+        # their place in the index
+        seen = self.state.hmget('presence_seen', stale)
+        workers = self.state.hmget('presence', stale)
+        keep = {nickname: entry['last_seen']
+                for nickname, entry, count in zip(stale, seen, workers)
+                if entry and (entry['last_seen'] > cutoff or count)}
+        self.state.hdel('presence_seen', *[nickname for nickname in stale
+                                           if nickname not in keep])
+        self.state.zadd('presence_seen_at', {
+            nickname: max(last_seen, cutoff + 1) for nickname, last_seen in keep.items()
+        })
+
+    def close(self):
+        """Take this worker's users offline in the shared state, on exit"""
+        with self._lock:
+            for nickname in list(self._online):
+                self._went_offline(nickname)
+        self.flush()
+        self.state.hdel('presence_workers', self.worker_id)
+
+    def _start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='presence-sweeper',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+                self.flush()
+                if time.time() - self._pruned >= self.prune_every:
+                    self._pruned = time.time()
+                    self.prune()
+            except Exception as e:
+                print(f"Presence sweep failed: {e}")
@@ -0,0 +1,173 @@
+import re
+import math
+import threading
+from collections import deque
+
+# Words of two or more letters/digits in any script
+TOKEN_RE = re.compile(r'\w{2,}')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def _searchable(message):
+    text = message.get('text')
+    return (isinstance(text, str) and message.get('type') != 'media' and
+            not text.startswith('/static/uploads/'))
+
+
+class MessageSearchIndex:
+    """Inverted index over chat messages: term -> {(room, id): count}.
+
+    Built once from the message store on first use and then kept current by
+    added()/removed()/room_cleared(), so a search only touches the postings
+    of its query terms. Each room's newest `cap` messages are indexed, both
+    when a room is (re)built and as messages are added; older ones drop out
+    as new ones arrive. A room whose version moved on without passing
+    through these calls (changed by another worker) is re-indexed before it
+    is searched.
+    """
+
+    def __init__(self, messages, cap=None):
+        self.messages = messages  # MessageLog or SQLiteMessageStore
+        self.cap = cap or messages.cap
+        self._postings = {}  # term -> {(room, id): term count}
+        self._docs = {}  # (room, id) -> set of terms
+        self._window = {}  # room -> ids of its newest `cap` messages, oldest first
+        self._versions = {}  # room -> room version the index is current at
+        self._built = False
+        self._lock = threading.RLock()
+
+    def _build(self):
+        with self._lock:
+            if self._built:
+                return
+            for room in self.messages.rooms():
+                self._index_room(room)
+            self._built = True
+            print(f"Search index built: {len(self._docs)} messages, "
+                  f"{len(self._postings)} terms")
+
+    def _add(self, room, message):
+        # Media count toward the window too, as they do in a rebuild
+        window = self._window.setdefault(room, deque())
+        window.append(message['id'])
+        while len(window) > self.cap:
+            self._remove((room, window.popleft()))
+        if not _searchable(message):
+            return
+        key = (room, message['id'])
+        counts = {}
+        for term in tokenize(message['text']):
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            self._postings.setdefault(term, {})[key] = count
+        self._docs[key] = set(counts)
+
+    def _index_room(self, room):
+        self._versions[room] = self.messages.versions.get(room)[0]
+        for message in self.messages.tail(room, self.cap):
+            self._add(room, message)
+
+    def _advance(self, room):
+        """Mark the index current after applying the room's latest change.
+
+        Only if it was current just before; otherwise a change went past it
+        and the room is re-indexed on its next search.
+        """
+        version = self.messages.versions.get(room)[0]
+        if self._versions.get(room, 0) == version - 1:
+            self._versions[room] = version
+
+    def _refresh(self, rooms):
+        for room in rooms:
+            version = self.messages.versions.get(room)[0]
+            if self._versions.get(room, 0) != version:
+                with self._lock:
+                    self.room_cleared(room)
+                    self._index_room(room)
+
+    def _remove(self, key):
+        for term in self._docs.pop(key, ()):
+            postings = self._postings.get(term)
+            if postings:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[term]
+
+    def added(self, room, message):
+        """Index a message just appended (media included, to keep versions)"""
+        self.added_many(room, [message])
+
+    def added_many(self, room, messages):
+        """Index messages appended to a room in one write"""
+        with self._lock:
+            # Before the first build the messages are picked up by the build
+            if self._built:
+                for message in messages:
+                    self._add(room, message)
+                self._advance(room)
+
+    def removed(self, room, message_id):
+        """Drop a message just deleted from the store"""
+        with self._lock:
+            self.forget(room, message_id)
+            self._advance(room)
+
+    def forget(self, room, message_id):
+        """Drop an entry whose message turned out to be gone"""
+        with self._lock:
+            self._remove((room, message_id))
+            window = self._window.get(room)
+            if window and message_id in window:
+                window.remove(message_id)
+
+    def room_cleared(self, room):
+        """Drop a room that was just cleared or deleted"""
+        with self._lock:
+            for key in [key for key in self._docs if key[0] == room]:
+                self._remove(key)
+            self._window.pop(room, None)
+            self._advance(room)
+
+    def search(self, query, rooms, offset=0, limit=20, hidden=None):
+        """Ranked matches for all query terms within `rooms`.
+
+        `hidden` maps a room to a predicate telling whether a message id is
+        hidden for the searching user. Returns (total, [(score, room, id)]).
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return 0, []
+        self._build()
+        self._refresh(rooms)
+
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not all(postings):
+                return 0, []
+            postings.sort(key=len)
+            total_docs = max(len(self._docs), 1)
+
+            # Rarer terms weigh more; messages must contain every term
+            scored = []
+            for key in postings[0]:
+                room, message_id = key
+                if room not in rooms:
+                    continue
+                if hidden and hidden.get(room) and hidden[room](message_id):
+                    continue
+                score = 0.0
+                for term_postings in postings:
+                    count = term_postings.get(key)
+                    if count is None:
+                        break
+                    idf = math.log(1 + total_docs / len(term_postings))
+                    score += (1 + math.log(count)) * idf
+                else:
+                    scored.append((score, room, message_id))
+
+        # Best score first, newest first among equals
+        scored.sort(key=lambda hit: (-hit[0], -hit[2]))
+        return len(scored), scored[offset:offset + limit]
@@ -0,0 +1,349 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import threading
+from collections import deque
+
+import socketio
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Where state shared by every worker lives: empty for this process only, or a
+# redis:// URL so several gunicorn workers or nodes can serve one chat
+SHARED_STATE_URL = os.environ.get('SHARED_STATE_URL', '')
+
+# Socket.IO message queue that carries broadcasts between workers: empty for
+# none, "local" for the in-process stand-in, or a redis://, amqp:// or
+# kafka:// URL
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', '')
+
+
+class LocalState:
+    """Shared state held in this process: the default for a single worker.
+
+    Also the stand-in for Redis in tests; objects handed the same LocalState
+    see each other's changes the way workers sharing one Redis do. Values
+    stored in hashes are copied through JSON, as they would be over the wire.
+    """
+
+    shared = False  # True when other processes see the same state
+
+    def __init__(self):
+        self._windows = {}  # key -> deque of hit times
+        self._counters = {}
+        self._hashes = {}
+        self._sorted = {}  # name -> {member: score}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    # -- sliding windows ---------------------------------------------------
+
+    def window_count(self, key, window, now=None):
+        """Hits recorded under key in the last `window` seconds"""
+        now = time.time() if now is None else now
+        with self._lock:
+            hits = self._windows.get(key)
+            if hits is None:
+                return 0
+            while hits and now - hits[0] >= window:
+                hits.popleft()
+            if not hits:
+                del self._windows[key]
+            return len(hits)
+
+    def window_add(self, key, window, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._windows.setdefault(key, deque()).append(now)
+
+    # -- counters ----------------------------------------------------------
+
+    def incr(self, key, amount=1):
+        """Add to a counter and return its new value"""
+        with self._lock:
+            value = self._counters.get(key, 0) + amount
+            self._counters[key] = value
+            return value
+
+    def get(self, key):
+        return self._counters.get(key, 0)
+
+    def delete(self, key):
+        with self._lock:
+            self._counters.pop(key, None)
+
+    # -- hashes ------------------------------------------------------------
+
+    def hget(self, name, field, default=None):
+        value = self._hashes.get(name, {}).get(field)
+        return default if value is None else json.loads(value)
+
+    def hmget(self, name, fields):
+        """Values of some fields of a hash, None for the missing ones"""
+        with self._lock:
+            values = self._hashes.get(name, {})
+            values = [values.get(field) for field in fields]
+        return [None if value is None else json.loads(value) for value in values]
+
+    def hgetall(self, name):
+        with self._lock:
+            items = list(self._hashes.get(name, {}).items())
+        return {field: json.loads(value) for field, value in items}
+
+    def hset(self, name, field, value):
+        with self._lock:
+            self._hashes.setdefault(name, {})[field] = json.dumps(value)
+
+    def hset_many(self, name, mapping):
+        with self._lock:
+            fields = self._hashes.setdefault(name, {})
+            for field, value in mapping.items():
+                fields[field] = json.dumps(value)
+
+    def hdel(self, name, *fields):
+        with self._lock:
+            values = self._hashes.get(name)
+            if values is not None:
+                for field in fields:
+                    values.pop(field, None)
+                if not values:
+                    del self._hashes[name]
+
+    def hincr(self, name, field, amount=1):
+        """Add to a number in a hash and return its new value"""
+        with self._lock:
+            fields = self._hashes.setdefault(name, {})
+            value = json.loads(fields.get(field, '0')) + amount
+            fields[field] = json.dumps(value)
+            return value
+
+    def hdecr(self, name, field, amount=1):
+        """Subtract from a number in a hash and return its new value; the
+        field is dropped once it reaches zero"""
+        with self._lock:
+            fields = self._hashes.setdefault(name, {})
+            value = json.loads(fields.get(field, '0')) - amount
+            if value > 0:
+                fields[field] = json.dumps(value)
+            else:
+                fields.pop(field, None)
+                if not fields:
+                    del self._hashes[name]
+            return value
+
+    # -- sorted sets -------------------------------------------------------
+
+    def zadd(self, name, mapping):
+        """Set the scores of some members of a sorted set"""
+        with self._lock:
+            self._sorted.setdefault(name, {}).update(mapping)
+
+    def zpop_upto(self, name, max_score):
+        """Remove and return the members scored at most `max_score`"""
+        with self._lock:
+            scores = self._sorted.get(name, {})
+            members = [member for member, score in scores.items()
+                       if score <= max_score]
+            for member in members:
+                del scores[member]
+            return members
+
+    # -- locks -------------------------------------------------------------
+
+    def lock(self, name, timeout=30):
+        """A lock every worker sharing this state agrees on (not reentrant)"""
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+
+# HINCRBY that deletes the field at zero, in one step so a concurrent
+# increment can't be lost between the two
+_HDECR_SCRIPT = """
+local value = redis.call('HINCRBY', KEYS[1], ARGV[1], -tonumber(ARGV[2]))
+if value <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return value
+"""
+
+
+class RedisState(LocalState):
+    """Shared state in Redis, seen by every worker and node using the URL.
+
+    Keys are namespaced by `prefix`. Windows are sorted sets of hit times,
+    hashes hold JSON values and locks expire after `timeout` seconds, so a
+    worker that dies holding one doesn't block the others for good.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix='orbitmess:'):
+        if redis is None:
+            raise RuntimeError(
+                'SHARED_STATE_URL needs the redis package (pip install redis)')
+        self._redis = redis.Redis.from_url(url)
+        self._hdecr = self._redis.register_script(_HDECR_SCRIPT)
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def window_count(self, key, window, now=None):
+        now = time.time() if now is None else now
+        pipe = self._redis.pipeline()
+        pipe.zremrangebyscore(self._key(key), '-inf', now - window)
+        pipe.zcard(self._key(key))
+        return pipe.execute()[1]
+
+    def window_add(self, key, window, now=None):
+        now = time.time() if now is None else now
+        pipe = self._redis.pipeline()
+        pipe.zadd(self._key(key), {uuid.uuid4().hex: now})
+        pipe.expire(self._key(key), int(window) + 1)
+        pipe.execute()
+
+    def incr(self, key, amount=1):
+        return self._redis.incrby(self._key(key), amount)
+
+    def get(self, key):
+        return int(self._redis.get(self._key(key)) or 0)
+
+    def delete(self, key):
+        self._redis.delete(self._key(key))
+
+    def hget(self, name, field, default=None):
+        value = self._redis.hget(self._key(name), field)
+        return default if value is None else json.loads(value)
+
+    def hmget(self, name, fields):
+        if not fields:
+            return []
+        return [None if value is None else json.loads(value)
+                for value in self._redis.hmget(self._key(name), fields)]
+
+    def hgetall(self, name):
+        return {field.decode('utf-8'): json.loads(value)
+                for field, value in self._redis.hgetall(self._key(name)).items()}
+
+    def hset(self, name, field, value):
+        self._redis.hset(self._key(name), field, json.dumps(value))
+
+    def hset_many(self, name, mapping):
+        if mapping:
+            self._redis.hset(self._key(name),
+                             mapping={field: json.dumps(value)
+                                      for field, value in mapping.items()})
+
+    def hdel(self, name, *fields):
+        if fields:
+            self._redis.hdel(self._key(name), *fields)
+
+    def hincr(self, name, field, amount=1):
+        return self._redis.hincrby(self._key(name), field, amount)
+
+    def hdecr(self, name, field, amount=1):
+        return self._hdecr(keys=[self._key(name)], args=[field, amount])
+
+    def zadd(self, name, mapping):
+        if mapping:
+            self._redis.zadd(self._key(name), mapping)
+
+    def zpop_upto(self, name, max_score):
+        pipe = self._redis.pipeline()
+        pipe.zrangebyscore(self._key(name), '-inf', max_score)
+        pipe.zremrangebyscore(self._key(name), '-inf', max_score)
+        members, _ = pipe.execute()
+        return [member.decode('utf-8') for member in members]
+
+    def lock(self, name, timeout=30):
+        return self._redis.lock(self._key(f"lock:{name}"), timeout=timeout)
+
+
+def create_state(url=None):
+    url = SHARED_STATE_URL if url is None else url
+    if not url:
+        return LocalState()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisState(url)
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """The process-wide shared state, created from SHARED_STATE_URL"""
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                _state = create_state()
+                print(f"Shared state: {'redis' if _state.shared else 'local'}")
+    return _state
+
+
+# -- Socket.IO message queue ----------------------------------------------
+
+_channels = {}  # channel -> client managers of the local broker
+_channels_lock = threading.Lock()
+
+
+class LocalPubSubManager(socketio.BaseManager):
+    """Socket.IO client manager over an in-process broker.
+
+    Stands in for RedisManager in tests: Socket.IO servers in one process
+    whose managers share a channel deliver each other's broadcasts, just as
+    workers sharing a Redis queue do. Delivery is synchronous, so it also
+    works with the Flask-SocketIO test client. Data is pickled on the way to
+    other servers, like on a real queue; acks only work on the sending server.
+    """
+
+    name = 'local'
+
+    def __init__(self, channel='flask-socketio'):
+        super().__init__()
+        self.channel = channel
+
+    def initialize(self):
+        super().initialize()
+        with _channels_lock:
+            peers = _channels.setdefault(self.channel, [])
+            if self not in peers:
+                peers.append(self)
+
+    def _peers(self):
+        with _channels_lock:
+            return [peer for peer in _channels.get(self.channel, ())
+                    if peer is not self]
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None,
+             callback=None, **kwargs):
+        namespace = namespace or '/'
+        super().emit(event, data, namespace, room=room, skip_sid=skip_sid,
+                     callback=callback)
+        payload = pickle.dumps(data)
+        for peer in self._peers():
+            socketio.BaseManager.emit(peer, event, pickle.loads(payload),
+                                      namespace, room=room, skip_sid=skip_sid)
+
+    def close_room(self, room, namespace=None):
+        namespace = namespace or '/'
+        super().close_room(room, namespace)
+        for peer in self._peers():
+            socketio.BaseManager.close_room(peer, room, namespace)
+
+
+def socketio_options(url=None):
+    """SocketIO() keyword arguments for SOCKETIO_MESSAGE_QUEUE"""
+    url = SOCKETIO_MESSAGE_QUEUE if url is None else url
+    if not url:
+        return {}
+    if url == 'local':
+        return {'client_manager': LocalPubSubManager()}
+    return {'message_queue': url}
@@ -0,0 +1,635 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from message_log import hot_page, RoomVersions
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS bin_versions (
+    bin TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    key TEXT PRIMARY KEY,
+    nickname TEXT,
+    ip TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_by_nickname ON users (nickname);
+CREATE INDEX IF NOT EXISTS users_by_ip ON users (ip);
+
+CREATE TABLE IF NOT EXISTS rooms (
+    key TEXT PRIMARY KEY,
+    type TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS room_members (
+    room TEXT NOT NULL,
+    nickname TEXT NOT NULL,
+    is_admin INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (room, nickname)
+);
+CREATE INDEX IF NOT EXISTS room_members_by_nickname ON room_members (nickname);
+
+CREATE TABLE IF NOT EXISTS messages (
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (room, seq)
+);
+CREATE TABLE IF NOT EXISTS message_rooms (
+    room TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS blocks (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS block_edges (
+    blocker TEXT NOT NULL,
+    blocked TEXT NOT NULL,
+    PRIMARY KEY (blocker, blocked)
+);
+CREATE INDEX IF NOT EXISTS block_edges_by_blocked ON block_edges (blocked);
+
+CREATE TABLE IF NOT EXISTS bans (
+    key TEXT PRIMARY KEY,
+    username TEXT,
+    ip TEXT,
+    until_timestamp INTEGER,
+    banned_at INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bans_by_username ON bans (username);
+CREATE INDEX IF NOT EXISTS bans_by_ip ON bans (ip);
+
+CREATE TABLE IF NOT EXISTS mutes (
+    key TEXT PRIMARY KEY,
+    room TEXT NOT NULL,
+    username TEXT NOT NULL,
+    until INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mutes_by_room_user ON mutes (room, username);
+
+CREATE TABLE IF NOT EXISTS documents (
+    bin TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (bin, key)
+);
+"""
+
+# Bins stored in their own tables; everything else goes into `documents`
+TABLE_BINS = {
+    'users': 'users',
+    'rooms': 'rooms',
+    'blocks': 'blocks',
+    'banned': 'bans',
+    'muted': 'mutes'
+}
+
+# STORAGE_DURABILITY -> PRAGMA synchronous; in WAL mode NORMAL already
+# group-commits, syncing the log only at checkpoints
+SYNCHRONOUS = {'fsync': 'FULL', 'batch': 'NORMAL', 'os': 'OFF'}
+
+# Stored in `documents` when a bin is not a JSON object at all
+WHOLE_DOCUMENT_KEY = '\x00document'
+
+
+def _message(seq, data):
+    """A stored message with its seq exposed as the message id"""
+    message = json.loads(data)
+    message['id'] = seq
+    return message
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'),
+                      sort_keys=True)
+
+
+class SQLiteBackend:
+    """SQLite (WAL mode) storage engine with real tables for the main bins.
+
+    Whole-bin writes from save_json() are diffed against the rows already in
+    the database, so only the users, rooms, bans, ... that actually changed
+    are updated. Each write bumps the bin's row in bin_versions, which is what
+    the in-memory cache uses to notice changes made by other processes.
+    User, membership and ban lookups are answered from the table indexes
+    without loading the bins at all.
+
+    Connections are borrowed from a small pool for one operation at a time.
+    Up to `pool_size` idle ones are kept open; any beyond that are closed
+    when they are handed back, so a burst of requests (or of greenlets, which
+    threading.local() would give a connection each) doesn't leave file
+    descriptors and WAL readers behind.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path='orbitmess.db', cap=1000, durability='batch',
+                 hot_size=200, pool_size=4):
+        self.path = path
+        self.synchronous = SYNCHRONOUS.get(durability, 'NORMAL')
+        self.pool_size = pool_size
+        self._idle = []
+        self._pool_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._rows = {}  # bin_name -> {row key: serialized row} as last read/written
+
+        with self._conn() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            conn.commit()
+
+        # Connections opened before a fork belong to the parent
+        os.register_at_fork(after_in_child=self._reset_pool)
+
+        self.messages = SQLiteMessageStore(self, cap=cap, hot_size=hot_size)
+
+    def _reset_pool(self):
+        self._idle = []
+        self._pool_lock = threading.Lock()
+
+    @contextmanager
+    def _conn(self):
+        """Borrow a pooled connection for the duration of a with block"""
+        with self._pool_lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            conn.execute('PRAGMA foreign_keys=ON')
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._pool_lock:
+                if len(self._idle) < self.pool_size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        """Close the idle pooled connections"""
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def get_meta(self, key):
+        with self._conn() as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                               (key, )).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._write_lock, self._conn() as conn:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                    (key, value))
+
+    # -- bins --------------------------------------------------------------
+
+    def stamp(self, bin_name):
+        with self._conn() as conn:
+            row = conn.execute('SELECT version FROM bin_versions WHERE bin = ?',
+                               (bin_name, )).fetchone()
+        return row[0] if row else None
+
+    def read(self, bin_name):
+        if self.stamp(bin_name) is None:
+            return None
+
+        table = TABLE_BINS.get(bin_name)
+        with self._conn() as conn:
+            if table == 'bans':
+                rows = conn.execute(
+                    'SELECT key, data FROM bans ORDER BY banned_at, rowid').fetchall()
+            elif table == 'mutes':
+                rows = conn.execute(
+                    'SELECT key, data FROM mutes ORDER BY rowid').fetchall()
+            elif table:
+                rows = conn.execute(
+                    f'SELECT key, data FROM {table} ORDER BY rowid').fetchall()
+            else:
+                rows = conn.execute(
+                    'SELECT key, data FROM documents WHERE bin = ? ORDER BY rowid',
+                    (bin_name, )).fetchall()
+
+        self._rows[bin_name] = dict(rows)
+        return self._build(bin_name, rows)
+
+    def write(self, bin_name, data):
+        new_rows = self._split(bin_name, data)
+        with self._write_lock:
+            old_rows = self._rows.get(bin_name)
+            if old_rows is None:
+                self.read(bin_name)
+                old_rows = self._rows.get(bin_name, {})
+
+            changed = {
+                key: row
+                for key, row in new_rows.items() if old_rows.get(key) != row
+            }
+            removed = [key for key in old_rows if key not in new_rows]
+
+            with self._conn() as conn, conn:
+                for key in removed:
+                    self._delete_row(conn, bin_name, key)
+                for key, row in changed.items():
+                    self._upsert_row(conn, bin_name, key, row)
+                conn.execute(
+                    'INSERT INTO bin_versions (bin, version) VALUES (?, 1) '
+                    'ON CONFLICT(bin) DO UPDATE SET version = version + 1',
+                    (bin_name, ))
+            self._rows[bin_name] = new_rows
+
+    def _split(self, bin_name, data):
+        """Turn a bin into {row key: serialized row}"""
+        if bin_name == 'banned':
+            bans = data.get('users', []) if isinstance(data, dict) else []
+            rows = {}
+            for ban in bans:
+                row = _dumps(ban)
+                rows[hashlib.md5(row.encode('utf-8')).hexdigest()] = row
+            return rows
+        if bin_name == 'muted':
+            rows = {}
+            for room, room_mutes in (data or {}).items():
+                if isinstance(room_mutes, dict):
+                    for username, info in room_mutes.items():
+                        rows[_dumps([room, username])] = _dumps(info)
+            return rows
+        if not isinstance(data, dict):
+            return {WHOLE_DOCUMENT_KEY: _dumps(data)}
+        return {key: _dumps(value) for key, value in data.items()}
+
+    def _build(self, bin_name, rows):
+        """Inverse of _split()"""
+        if bin_name == 'banned':
+            return {'users': [json.loads(row) for _, row in rows]}
+        if bin_name == 'muted':
+            data = {}
+            for key, row in rows:
+                room, username = json.loads(key)
+                data.setdefault(room, {})[username] = json.loads(row)
+            return data
+        if len(rows) == 1 and rows[0][0] == WHOLE_DOCUMENT_KEY:
+            return json.loads(rows[0][1])
+        return {key: json.loads(row) for key, row in rows}
+
+    def _delete_row(self, conn, bin_name, key):
+        table = TABLE_BINS.get(bin_name)
+        if table is None:
+            conn.execute('DELETE FROM documents WHERE bin = ? AND key = ?',
+                         (bin_name, key))
+            return
+        conn.execute(f'DELETE FROM {table} WHERE key = ?', (key, ))
+        if table == 'rooms':
+            conn.execute('DELETE FROM room_members WHERE room = ?', (key, ))
+        elif table == 'blocks':
+            conn.execute('DELETE FROM block_edges WHERE blocker = ?', (key, ))
+
+    def _upsert_row(self, conn, bin_name, key, row):
+        table = TABLE_BINS.get(bin_name)
+        if table is None:
+            conn.execute(
+                'INSERT OR REPLACE INTO documents (bin, key, data) VALUES (?, ?, ?)',
+                (bin_name, key, row))
+            return
+
+        value = json.loads(row)
+        info = value if isinstance(value, dict) else {}
+
+        if table == 'users':
+            # Upserts keep the rowid, so rows stay in bin order
+            conn.execute(
+                'INSERT INTO users (key, nickname, ip, data) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET nickname = excluded.nickname, '
+                'ip = excluded.ip, data = excluded.data',
+                (key, info.get('nickname'), info.get('ip'), row))
+        elif table == 'rooms':
+            conn.execute(
+                'INSERT INTO rooms (key, type, data) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET type = excluded.type, '
+                'data = excluded.data',
+                (key, info.get('type'), row))
+            conn.execute('DELETE FROM room_members WHERE room = ?', (key, ))
+            admins = set(info.get('admins', []))
+            conn.executemany(
+                'INSERT OR IGNORE INTO room_members (room, nickname, is_admin) '
+                'VALUES (?, ?, ?)',
+                [(key, member, int(member in admins))
+                 for member in info.get('members', [])])
+        elif table == 'blocks':
+            conn.execute(
+                'INSERT OR REPLACE INTO blocks (key, data) VALUES (?, ?)',
+                (key, row))
+            conn.execute('DELETE FROM block_edges WHERE blocker = ?', (key, ))
+            blocked = value if isinstance(value, list) else []
+            conn.executemany(
+                'INSERT OR IGNORE INTO block_edges (blocker, blocked) VALUES (?, ?)',
+                [(key, user) for user in blocked])
+        elif table == 'bans':
+            conn.execute(
+                'INSERT OR REPLACE INTO bans '
+                '(key, username, ip, until_timestamp, banned_at, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, info.get('username'), info.get('ip'),
+                 info.get('until_timestamp'), info.get('banned_at'), row))
+        elif table == 'mutes':
+            room, username = json.loads(key)
+            conn.execute(
+                'INSERT OR REPLACE INTO mutes (key, room, username, until, data) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, room, username, info.get('until'), row))
+
+    # -- indexed point queries ---------------------------------------------
+
+    def find_users(self, nickname=None, ip=None):
+        """Users matching a nickname and/or IP, via the users indexes, in bin order"""
+        clauses, args = [], []
+        if nickname is not None:
+            clauses.append('nickname = ?')
+            args.append(nickname)
+        if ip is not None:
+            clauses.append('ip = ?')
+            args.append(ip)
+        where = ' AND '.join(clauses) or '1'
+        with self._conn() as conn:
+            rows = conn.execute(
+                f'SELECT key, data FROM users WHERE {where} ORDER BY rowid',
+                args).fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def rooms_of(self, nickname):
+        """Names of the rooms a user is a member of, in the order they were created"""
+        with self._conn() as conn:
+            rows = conn.execute(
+                'SELECT m.room FROM room_members m JOIN rooms r ON r.key = m.room '
+                'WHERE m.nickname = ? ORDER BY r.rowid', (nickname, )).fetchall()
+        return [row[0] for row in rows]
+
+    def active_bans(self, username=None, ip=None, now=None):
+        """Bans on a username or IP that haven't expired, oldest first"""
+        now = int(now or time.time())
+        with self._conn() as conn:
+            rows = conn.execute(
+                'SELECT data FROM bans WHERE (username = ? OR ip = ?) '
+                'AND (until_timestamp = -1 OR until_timestamp > ?) '
+                'ORDER BY banned_at, rowid', (username, ip, now)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class SQLiteMessageStore:
+    """Chat history in the messages table, with the MessageLog interface.
+
+    The table keeps every message (it is the cold tier, indexed by
+    (room, seq)); each room's newest `hot_size` messages are also kept in an
+    in-memory ring buffer that answers recent page reads. A ring is only
+    trusted while the room's shared version is the one it was built at, so
+    writes from other workers are seen. `cap` only bounds the size of one page.
+    """
+
+    def __init__(self, backend, cap=1000, hot_size=200):
+        self.backend = backend
+        self.cap = cap
+        self.hot_size = hot_size
+        self.directory = backend.path
+        self._hot = {}  # room -> (deque of newest messages, holds everything?)
+        self._hot_versions = {}  # room -> room version its ring is current at
+        self.versions = RoomVersions()
+
+    def _conn(self):
+        return self.backend._conn()
+
+    def exists(self):
+        return bool(self.backend.get_meta('imported_json'))
+
+    def _floor(self, conn, room):
+        """Newest id handed out in a room whose message is gone since"""
+        row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                           (f'last_id:{room}', )).fetchone()
+        return int(row[0]) if row else 0
+
+    def _raise_floor(self, conn, room, last_id):
+        # Keeps ids of deleted or cleared messages from being given out again
+        if last_id > self._floor(conn, room):
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         (f'last_id:{room}', str(last_id)))
+
+    def rooms(self):
+        with self._conn() as conn:
+            rows = conn.execute('SELECT room FROM message_rooms').fetchall()
+        return [row[0] for row in rows]
+
+    def append(self, room, message):
+        return self.append_many(room, [message])[0]
+
+    def append_many(self, room, messages):
+        """Append messages to a room in one transaction"""
+        return self.append_rooms({room: messages}).get(room, [])
+
+    def append_rooms(self, batches):
+        """Append messages to several rooms in one transaction"""
+        rooms = sorted(room for room, messages in batches.items() if messages)
+        if not rooms:
+            return {}
+        with self.backend._write_lock:
+            with self._conn() as conn, conn:
+                for room in rooms:
+                    messages = batches[room]
+                    conn.execute(
+                        'INSERT OR IGNORE INTO message_rooms (room) VALUES (?)',
+                        (room, ))
+                    last = self._last_id(conn, room)
+                    for message_id, message in enumerate(messages, last + 1):
+                        message['id'] = message_id
+                    conn.executemany(
+                        'INSERT INTO messages (room, seq, data) VALUES (?, ?, ?)',
+                        [(room, message['id'], _dumps(message))
+                         for message in messages])
+
+            for room in rooms:
+                messages = batches[room]
+                hot = self._hot.get(room)
+                if hot:
+                    ring, complete = hot
+                    if complete and len(ring) + len(messages) > ring.maxlen:
+                        self._hot[room] = (ring, False)
+                    ring.extend(messages)
+                self._changed(room)
+        return {room: batches[room] for room in rooms}
+
+    def _changed(self, room):
+        """Bump a room's version; caller holds the write lock.
+
+        If another worker changed the room since its ring was current, the
+        ring misses that change and is dropped.
+        """
+        version = self.versions.bump(room)
+        if self._hot_versions.get(room) == version - 1:
+            self._hot_versions[room] = version
+        else:
+            self._hot.pop(room, None)
+
+    def _hot_window(self, room):
+        """(ring buffer, holds the whole history); caller holds the write lock"""
+        version = self.versions.get(room)[0]
+        hot = self._hot.get(room)
+        if hot is None or self._hot_versions.get(room) != version:
+            with self._conn() as conn:
+                rows = conn.execute(
+                    'SELECT seq, data FROM messages WHERE room = ? '
+                    'ORDER BY seq DESC LIMIT ?',
+                    (room, self.hot_size + 1)).fetchall()
+            complete = len(rows) <= self.hot_size
+            rows = rows[:self.hot_size]
+            rows.reverse()
+            hot = (deque((_message(seq, data) for seq, data in rows),
+                         maxlen=self.hot_size), complete)
+            self._hot[room] = hot
+            self._hot_versions[room] = version
+        return hot
+
+    def tail(self, room, limit=None):
+        return self.page(room, limit)
+
+    def page(self, room, limit=None, before=None, after=None, hidden_upto=0,
+             hidden_ids=()):
+        """Messages next to an id cursor, oldest first (see MessageLog.page)"""
+        limit = min(limit or self.cap, self.cap)
+        with self.backend._write_lock:
+            ring, complete = self._hot_window(room)
+            window = hot_page(list(ring), complete, limit, before, after,
+                              hidden_upto, hidden_ids)
+        if window is not None:
+            return window
+
+        # Hidden ids are filtered here, so fetch enough rows to fill the page
+        fetch = limit + len(hidden_ids)
+        with self._conn() as conn:
+            if after is not None:
+                rows = conn.execute(
+                    'SELECT seq, data FROM messages WHERE room = ? AND seq > ? '
+                    'ORDER BY seq LIMIT ?',
+                    (room, max(after, hidden_upto), fetch)).fetchall()
+            else:
+                rows = conn.execute(
+                    'SELECT seq, data FROM messages WHERE room = ? AND seq > ? '
+                    'AND seq < ? ORDER BY seq DESC LIMIT ?',
+                    (room, hidden_upto, before if before is not None else 2**62,
+                     fetch)).fetchall()
+        rows = [row for row in rows if row[0] not in hidden_ids][:limit]
+        if after is None:
+            rows.reverse()
+        return [_message(seq, data) for seq, data in rows]
+
+    def read(self, room):
+        return self.tail(room, self.cap)
+
+    def count(self, room):
+        with self._conn() as conn:
+            row = conn.execute('SELECT COUNT(*) FROM messages WHERE room = ?',
+                               (room, )).fetchone()
+        return row[0]
+
+    def replace(self, room, messages):
+        with self.backend._write_lock, self._conn() as conn:
+            row = conn.execute('SELECT MAX(seq) FROM messages WHERE room = ?',
+                               (room, )).fetchone()
+
+            # Keep existing ids; number new messages after the newest one
+            rows = []
+            last_id = max(row[0] or 0, self._floor(conn, room))
+            previous = 0
+            for message in messages:
+                message_id = message.get('id')
+                if not isinstance(message_id, int) or message_id <= previous:
+                    last_id = max(last_id, previous) + 1
+                    message = dict(message, id=last_id)
+                previous = message['id']
+                rows.append((room, previous, _dumps(message)))
+
+            with conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO message_rooms (room) VALUES (?)',
+                    (room, ))
+                conn.execute('DELETE FROM messages WHERE room = ?', (room, ))
+                conn.executemany(
+                    'INSERT INTO messages (room, seq, data) VALUES (?, ?, ?)',
+                    rows)
+                self._raise_floor(conn, room, max(last_id, previous))
+            self._hot.pop(room, None)
+            self._changed(room)
+
+    def get(self, room, message_id):
+        with self._conn() as conn:
+            row = conn.execute(
+                'SELECT seq, data FROM messages WHERE room = ? AND seq = ?',
+                (room, message_id)).fetchone()
+        return _message(*row) if row else None
+
+    def _last_id(self, conn, room):
+        row = conn.execute('SELECT MAX(seq) FROM messages WHERE room = ?',
+                           (room, )).fetchone()
+        return max(row[0] or 0, self._floor(conn, room))
+
+    def last_id(self, room):
+        with self._conn() as conn:
+            return self._last_id(conn, room)
+
+    def remove(self, room, message_id):
+        with self.backend._write_lock:
+            message = self.get(room, message_id)
+            if message is None:
+                return None
+            with self._conn() as conn, conn:
+                self._raise_floor(conn, room, self._last_id(conn, room))
+                conn.execute('DELETE FROM messages WHERE room = ? AND seq = ?',
+                             (room, message_id))
+
+            hot = self._hot.get(room)
+            if hot and any(m['id'] == message_id for m in hot[0]):
+                ring, complete = hot
+                self._hot[room] = (deque((m for m in ring if m['id'] != message_id),
+                                         maxlen=self.hot_size), complete)
+            self._changed(room)
+            return message
+
+    def clear(self, room):
+        self.replace(room, [])
+
+    def drop(self, room):
+        with self.backend._write_lock:
+            with self._conn() as conn, conn:
+                conn.execute('DELETE FROM messages WHERE room = ?', (room, ))
+                conn.execute('DELETE FROM message_rooms WHERE room = ?',
+                             (room, ))
+                conn.execute('DELETE FROM meta WHERE key = ?',
+                             (f'last_id:{room}', ))
+            self._hot.pop(room, None)
+            self._changed(room)
+
+    def snapshot(self):
+        return {room: self.read(room) for room in self.rooms()}
+
+    def import_rooms(self, messages_data):
+        for room, messages in messages_data.items():
+            if isinstance(messages, list):
+                self.replace(room, messages)
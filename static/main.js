@@ -2,7 +2,7 @@ document.addEventListener('DOMContentLoaded', () => {
   // Check if we're on the login page - if so, don't initialize chat functionality
   if (!nickname || nickname.trim() === '') return;
 
-  const socket = io();
+  const socket = io({ transports: socketTransports });
   const chatList = document.getElementById('chat-list');
   const messagesDiv = document.getElementById('messages');
   const messageForm = document.getElementById('message-form');
@@ -36,6 +36,63 @@ document.addEventListener('DOMContentLoaded', () => {
   let searchTimeout;
   let useMobileInterface = window.innerWidth <= 768;
 
+  // fetch() + JSON parsing that fails loudly on HTTP errors
+  async function safeFetchJson(url, options = {}) {
+    const response = await fetch(url, options);
+    if (!response.ok) {
+      throw new Error(`${url}: HTTP ${response.status}`);
+    }
+    return response.json();
+  }
+
+  // User cards (avatar, bio, status, badges) are fetched in batches: every
+  // card asked for in the same tick goes out in one /users/cards request.
+  // Cards are reused for CARD_MAX_AGE ms; status readers ask for fresh ones.
+  const CARD_MAX_AGE = 30000;
+  const CARDS_PER_REQUEST = 200;
+  const userCards = new Map(); // username -> {promise, time}
+  let cardQueue = null; // username -> {promise, resolve, reject}
+
+  function getUserCard(username, maxAge = CARD_MAX_AGE) {
+    const cached = userCards.get(username);
+    if (cached && Date.now() - cached.time < maxAge) return cached.promise;
+
+    if (!cardQueue) {
+      cardQueue = new Map();
+      setTimeout(flushCardQueue, 0);
+    }
+    let entry = cardQueue.get(username);
+    if (!entry) {
+      entry = {};
+      entry.promise = new Promise((resolve, reject) => {
+        entry.resolve = resolve;
+        entry.reject = reject;
+      });
+      cardQueue.set(username, entry);
+    }
+    userCards.set(username, { promise: entry.promise, time: Date.now() });
+    return entry.promise;
+  }
+
+  function flushCardQueue() {
+    const queue = cardQueue;
+    cardQueue = null;
+    const usernames = [...queue.keys()];
+    for (let i = 0; i < usernames.length; i += CARDS_PER_REQUEST) {
+      const batch = usernames.slice(i, i + CARDS_PER_REQUEST);
+      safeFetchJson(`/users/cards?users=${batch.map(encodeURIComponent).join(',')}`)
+        .then(data => batch.forEach(username => queue.get(username).resolve(data.cards[username])))
+        .catch(error => batch.forEach(username => {
+          userCards.delete(username);
+          queue.get(username).reject(error);
+        }));
+    }
+  }
+
+  function forgetUserCard(username) {
+    userCards.delete(username);
+  }
+
   // Force dark theme only
   document.body.setAttribute('data-theme', 'dark');
   localStorage.setItem('theme', 'dark');
@@ -268,10 +325,12 @@ document.addEventListener('DOMContentLoaded', () => {
   }
 
   // Load rooms
-  async function loadRooms() {
+  async function loadRooms(rooms = null) {
     try {
-      const response = await fetch('/rooms');
-      const rooms = await response.json();
+      if (!rooms) {
+        const response = await fetch('/rooms');
+        rooms = await response.json();
+      }
       console.log('Rooms received:', rooms);
 
       if (!chatList) {
@@ -315,8 +374,7 @@ document.addEventListener('DOMContentLoaded', () => {
               `;
 
               // Load user status
-              fetch(`/user_status/${otherUser}`)
-                .then(r => r.json())
+              getUserCard(otherUser, 0)
                 .then(data => {
                   const statusEl = document.getElementById(`status-${otherUser}`);
                   if (statusEl) {
@@ -391,6 +449,9 @@ document.addEventListener('DOMContentLoaded', () => {
         activeItem.classList.add('active');
       }
 
+      Object.keys(unreadCounts).forEach(renderUnreadBadge);
+      loadUnread();
+
       console.log('Rooms loaded successfully');
     } catch (err) {
       console.error('Failed to load rooms:', err);
@@ -487,24 +548,153 @@ document.addEventListener('DOMContentLoaded', () => {
     socket.emit('join', {room, nickname});
   }
 
+  // History is fetched a page at a time; older pages load on scroll to top
+  let hasOlderMessages = false;
+  let loadingOlderMessages = false;
+
+  // Unread counts per room, shown as badges in the room list
+  let unreadCounts = {};
+  let unreadLimit = 100;
+  const markReadTimers = {};
+
+  function renderUnreadBadge(room) {
+    const item = chatList && chatList.querySelector(`[data-room="${CSS.escape(room)}"]`);
+    if (!item) return;
+    let badge = item.querySelector('.unread-badge');
+    const count = unreadCounts[room] || 0;
+    if (!count) {
+      if (badge) badge.remove();
+      return;
+    }
+    if (!badge) {
+      badge = document.createElement('span');
+      badge.className = 'unread-badge';
+      item.insertBefore(badge, item.querySelector('.chat-icon'));
+    }
+    badge.textContent = count >= unreadLimit ? `${unreadLimit - 1}+` : count;
+  }
+
+  function setUnread(room, count) {
+    unreadCounts[room] = Math.min(count, unreadLimit);
+    renderUnreadBadge(room);
+  }
+
+  async function loadUnread() {
+    try {
+      const data = await safeFetchJson('/unread');
+      unreadLimit = data.limit || unreadLimit;
+      unreadCounts = {};
+      Object.entries(data.counts || {}).forEach(([room, count]) => {
+        setUnread(room, room === currentRoom && !document.hidden ? 0 : count);
+      });
+      if (!document.hidden) markRead(currentRoom);
+    } catch (err) {
+      console.error('Failed to load unread counts:', err);
+    }
+  }
+
+  // Move the read cursor to the newest loaded message, at most once a second
+  function markRead(room) {
+    setUnread(room, 0);
+    if (markReadTimers[room]) return;
+    markReadTimers[room] = setTimeout(() => {
+      delete markReadTimers[room];
+      const withIds = (messageHistory[room] || []).filter(msg => msg.id);
+      if (!withIds.length) return;
+      fetch('/mark_read', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({room, id: withIds[withIds.length - 1].id})
+      }).catch(err => console.error('Failed to mark as read:', err));
+    }, 1000);
+  }
+
+  socket.on('unread_update', (data) => {
+    if (data.room === currentRoom && !document.hidden) {
+      if (data.count) markRead(data.room);
+      return;
+    }
+    if (data.increment) {
+      if (data.from === nickname) return;
+      setUnread(data.room, (unreadCounts[data.room] || 0) + data.increment);
+    } else {
+      setUnread(data.room, data.count || 0);
+    }
+  });
+
+  function messagePageSize() {
+    // Enough messages to fill the viewport twice over
+    const rows = Math.ceil((messagesDiv.clientHeight || window.innerHeight) / 40);
+    return Math.min(200, Math.max(30, rows * 2));
+  }
+
   async function loadMessages(room) {
     try {
-      const messages = await safeFetchJson(`/messages/${room}`);
+      const limit = messagePageSize();
+      const messages = await safeFetchJson(`/messages/${encodeURIComponent(room)}?limit=${limit}`);
+      if (room !== currentRoom) return;
+      hasOlderMessages = messages.length >= limit;
       messageHistory[room] = messages;
       localStorage.setItem('messageHistory', JSON.stringify(messageHistory));
       displayMessages(messages);
+      if (!document.hidden) markRead(room);
     } catch (err) {
       console.error('Failed to load messages:', err);
       showNotification('❌ Failed to load messages', 'error');
     }
   }
 
-  function displayMessages(messages) {
+  async function loadOlderMessages() {
+    const room = currentRoom;
+    const loaded = messageHistory[room] || [];
+    if (!hasOlderMessages || loadingOlderMessages || !loaded.length || !loaded[0].id) return;
+
+    loadingOlderMessages = true;
+    try {
+      const limit = messagePageSize();
+      const older = await safeFetchJson(`/messages/${encodeURIComponent(room)}?limit=${limit}&before=${loaded[0].id}`);
+      if (room !== currentRoom) return;
+      hasOlderMessages = older.length >= limit;
+      if (older.length) {
+        messageHistory[room] = older.concat(loaded);
+        localStorage.setItem('messageHistory', JSON.stringify(messageHistory));
+        displayMessages(messageHistory[room], true);
+      }
+    } catch (err) {
+      console.error('Failed to load older messages:', err);
+    } finally {
+      loadingOlderMessages = false;
+    }
+  }
+
+  messagesDiv.addEventListener('scroll', () => {
+    if (messagesDiv.scrollTop < 100) {
+      loadOlderMessages();
+    }
+  });
+
+  // Drop one message from the cached history and redraw if it is on screen
+  function removeMessageLocally(room, id) {
+    const messages = messageHistory[room];
+    if (!messages) return;
+    const index = messages.findIndex(msg => msg.id === id);
+    if (index < 0) return;
+    messages.splice(index, 1);
+    localStorage.setItem('messageHistory', JSON.stringify(messageHistory));
+    if (room === currentRoom) {
+      displayMessages(messages, true);
+    }
+  }
+
+  function displayMessages(messages, keepScrollPosition = false) {
+    const distanceFromBottom = messagesDiv.scrollHeight - messagesDiv.scrollTop;
     messagesDiv.innerHTML = '';
     messages.forEach((msg, index) => {
       addMessage(msg.nick, msg.text, msg.nick === nickname, false, index);
     });
-    messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    messagesDiv.scrollTop = keepScrollPosition
+      ? messagesDiv.scrollHeight - distanceFromBottom
+      : messagesDiv.scrollHeight;
   }
 
   // Load and display stories
@@ -537,12 +727,11 @@ document.addEventListener('DOMContentLoaded', () => {
           `;
           
           // Load user avatar
-          fetch(`/get_user_avatar/${username}`)
-            .then(r => r.json())
+          getUserCard(username)
             .then(data => {
               const avatar = storyItem.querySelector('.header-story-avatar');
               if (data.avatar && data.avatar !== '/static/default-avatar.png') {
-                avatar.src = data.avatar + '?t=' + Date.now();
+                avatar.src = data.avatar;
               }
             })
             .catch(() => {});
@@ -667,12 +856,11 @@ document.addEventListener('DOMContentLoaded', () => {
       if (!isOwnMessage) {
         avatarHtml = `<img src="/static/default-avatar.svg" alt="${nick}" class="message-avatar" onclick="showUserProfile('${nick}')" onerror="this.src='/static/default-avatar.svg'">`;
         // Load actual avatar
-        fetch(`/get_user_avatar/${nick}`)
-          .then(r => r.json())
+        getUserCard(nick)
           .then(data => {
             const avatar = div.querySelector('.message-avatar');
             if (avatar && data.avatar && data.avatar !== '/static/default-avatar.png') {
-              avatar.src = data.avatar + '?t=' + Date.now();
+              avatar.src = data.avatar;
             }
           })
           .catch(() => {
@@ -751,8 +939,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
       // Check for verification badge
       let verificationBadge = '';
-      fetch(`/get_user_verification/${nick}`)
-        .then(r => r.json())
+      getUserCard(nick)
         .then(data => {
           if (data.verified) {
             const authorEl = div.querySelector('.message-author');
@@ -869,11 +1056,7 @@ document.addEventListener('DOMContentLoaded', () => {
     document.body.appendChild(modal);
 
     // Load user data
-    Promise.all([
-      fetch(`/get_user_avatar/${username}`).then(r => r.json()),
-      fetch(`/user_status/${username}`).then(r => r.json()),
-      fetch(`/get_user_profile/${username}`).then(r => r.json())
-    ]).then(([avatarData, statusData, profileData]) => {
+    getUserCard(username, 0).then(card => {
       const avatar = document.getElementById('profile-avatar');
       const status = document.getElementById('profile-status');
       const bio = document.getElementById('profile-bio');
@@ -881,10 +1064,10 @@ document.addEventListener('DOMContentLoaded', () => {
 
       if (avatar) {
         // Виправлено: показувати кастомну аватарку, якщо вона є у users.json
-        if (avatarData && avatarData.avatar &&
-            avatarData.avatar !== '/static/default-avatar.png' &&
-            avatarData.avatar !== '/static/default-avatar.svg') {
-          avatar.src = avatarData.avatar + '?t=' + Date.now(); // Force refresh
+        if (card && card.avatar &&
+            card.avatar !== '/static/default-avatar.png' &&
+            card.avatar !== '/static/default-avatar.svg') {
+          avatar.src = card.avatar;
           avatar.onerror = function() {
             this.src = '/static/default-avatar.svg';
           };
@@ -894,22 +1077,22 @@ document.addEventListener('DOMContentLoaded', () => {
       }
 
       if (status) {
-        status.textContent = statusData.status === 'online' ? 'Online' : 'Offline';
-        status.className = `profile-status ${statusData.status}`;
+        status.textContent = card.status === 'online' ? 'Online' : 'Offline';
+        status.className = `profile-status ${card.status}`;
       }
 
-      if (bioInput && profileData) {
+      if (bioInput && card) {
         // Виправлено: якщо біо є у users.json, показувати його
-        bioInput.value = profileData.bio || '';
+        bioInput.value = card.bio || '';
       }
 
-      if (lastSeen && statusData.last_seen) {
-        const lastSeenDate = new Date(statusData.last_seen * 1000);
+      if (lastSeen && card.last_seen) {
+        const lastSeenDate = new Date(card.last_seen * 1000);
         const now = new Date();
         const diffHours = (now - lastSeenDate) / (1000 * 60 * 60);
         const diffDays = Math.floor(diffHours / 24);
 
-        if (statusData.status === 'online') {
+        if (card.status === 'online') {
           lastSeen.textContent = 'Зараз у мережі';
         } else if (diffDays >= 3) {
           lastSeen.textContent = `Був у мережі: ${lastSeenDate.toLocaleDateString('uk-UA')}`;
@@ -1039,6 +1222,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const modal = document.createElement('div');
     modal.className = 'admin-panel forward-modal';
     const isMobile = window.innerWidth <= 768;
+    const selectedRooms = new Set();
 
     modal.innerHTML = `
       <div class="admin-content forward-content">
@@ -1065,6 +1249,7 @@ document.addEventListener('DOMContentLoaded', () => {
         </div>
 
         <div class="modal-footer">
+          <button class="admin-btn forward-btn" id="forward-selected-btn" disabled>Forward to selected</button>
           <button class="admin-btn close-btn" onclick="this.closest('.admin-panel').remove()">Cancel</button>
         </div>
       </div>
@@ -1072,6 +1257,22 @@ document.addEventListener('DOMContentLoaded', () => {
 
     document.body.appendChild(modal);
 
+    // Ticked rooms all get the message in one request
+    const forwardSelectedBtn = document.getElementById('forward-selected-btn');
+    modal.addEventListener('change', (e) => {
+      if (!e.target.classList.contains('forward-select')) return;
+      if (e.target.checked) {
+        selectedRooms.add(e.target.value);
+      } else {
+        selectedRooms.delete(e.target.value);
+      }
+      forwardSelectedBtn.disabled = selectedRooms.size === 0;
+      forwardSelectedBtn.textContent = selectedRooms.size
+        ? `Forward to ${selectedRooms.size} selected`
+        : 'Forward to selected';
+    });
+    forwardSelectedBtn.onclick = () => forwardMessageToRooms([...selectedRooms], messageIndex);
+
     // Load available rooms
     fetch('/rooms')
       .then(r => r.json())
@@ -1108,6 +1309,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
             return `
               <div class="forward-room-item" data-room="${room}">
+                <input type="checkbox" class="forward-select" value="${room}" ${selectedRooms.has(room) ? 'checked' : ''} />
                 <div class="forward-room-info">
                   <div class="forward-room-name">${emoji} ${displayName}</div>
                   <div class="forward-room-type">${roomType}</div>
@@ -1149,6 +1351,38 @@ document.addEventListener('DOMContentLoaded', () => {
       });
   }
 
+  // Forward a message to several rooms with one /forward_messages call
+  function forwardMessageToRooms(targetRooms, messageIndex) {
+    const message = (messageHistory[currentRoom] || [])[messageIndex];
+    if (!message || !message.id) {
+      showNotification('❌ Message not found', 'error');
+      return;
+    }
+
+    fetch('/forward_messages', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({
+        messages: [{room: currentRoom, id: message.id}],
+        target_rooms: targetRooms
+      })
+    })
+    .then(r => r.json())
+    .then(data => {
+      if (data.success) {
+        showNotification(`✅ Message forwarded to ${data.rooms.length} chats`, 'success');
+        const modal = document.querySelector('.forward-modal');
+        if (modal) modal.remove();
+      } else {
+        showNotification('❌ Failed to forward message: ' + (data.error || 'Unknown error'), 'error');
+      }
+    })
+    .catch(err => {
+      console.error('Failed to forward messages:', err);
+      showNotification('❌ Error forwarding message', 'error');
+    });
+  }
+
   // Forward message to specific room
   window.forwardMessageToRoom = function(targetRoom, messageIndex, originalSender) {
     const messages = messageHistory[currentRoom] || [];
@@ -1164,6 +1398,8 @@ document.addEventListener('DOMContentLoaded', () => {
       headers: {'Content-Type': 'application/json'},
       body: JSON.stringify({
         target_room: targetRoom,
+        room: currentRoom,
+        id: message.id,
         message: message.text,
         original_sender: originalSender
       })
@@ -1213,17 +1449,22 @@ document.addEventListener('DOMContentLoaded', () => {
   // Delete message function (global scope)
   window.deleteMessage = function(index, type = 'all') {
     const confirmText = type === 'me' ? 'Hide this message for yourself?' : 'Delete this message for everyone?';
+    const message = (messageHistory[currentRoom] || [])[index];
+    if (!message || !message.id) {
+      showNotification('❌ Message not found', 'error');
+      return;
+    }
 
     if (confirm(confirmText)) {
       fetch('/delete_message', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({room: currentRoom, index: index, type: type})
+        body: JSON.stringify({room: currentRoom, id: message.id, type: type})
       })
       .then(r => r.json())
       .then(data => {
         if (data.success) {
-          loadMessages(currentRoom);
+          removeMessageLocally(currentRoom, message.id);
         } else {
           showNotification('❌ ' + (data.error || 'Failed to delete message'), 'error');
         }
@@ -1330,6 +1571,7 @@ document.addEventListener('DOMContentLoaded', () => {
       const formData = new FormData();
       formData.append('file', file);
       formData.append('room', currentRoom);
+      formData.append('sid', socket.id);
 
       // Show uploading notification
       showNotification('📤 Uploading...', 'info');
@@ -1751,8 +1993,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
           // Load member statuses
           data.members.forEach(member => {
-            fetch(`/user_status/${member}`)
-              .then(r => r.json())
+            getUserCard(member, 0)
               .then(statusData => {
                 const statusEl = document.getElementById(`member-status-${member}`);
                 if (statusEl) {
@@ -1784,11 +2025,10 @@ document.addEventListener('DOMContentLoaded', () => {
 
   // Load member avatar
   window.loadMemberAvatar = function(username, imgElement) {
-    fetch(`/get_user_avatar/${username}`)
-      .then(r => r.json())
+    getUserCard(username)
       .then(data => {
         if (data.avatar && data.avatar !== '/static/default-avatar.png') {
-          imgElement.src = data.avatar + '?t=' + Date.now(); // Force refresh
+          imgElement.src = data.avatar;
         } else {
           imgElement.src = '/static/default-avatar.svg'; // Use SVG default
         }
@@ -1881,8 +2121,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentRoom.startsWith('private_')) return;
 
     try {
-      const response = await fetch(`/user_status/${username}`);
-      const data = await response.json();
+      const data = await getUserCard(username, 0);
       const statusEl = document.getElementById(`status-${username}`);
       if (statusEl) {
         if (data.status === 'online') {
@@ -2010,8 +2249,15 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   });
 
+  // Bursts of messages arrive batched into one frame per room
+  socket.on('new_messages', (data) => {
+    (data.messages || []).forEach(handleNewMessage);
+  });
+
   // Handle real-time video/file messages
-  socket.on('new_message', (data) => {
+  socket.on('new_message', handleNewMessage);
+
+  function handleNewMessage(data) {
     if (data.room !== currentRoom) {
       return;
     }
@@ -2022,6 +2268,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // Update cache immediately
     if (!messageHistory[currentRoom]) messageHistory[currentRoom] = [];
     messageHistory[currentRoom].push({
+      id: data.id,
       nick: data.nickname, 
       text: data.message, 
       timestamp: data.timestamp,
@@ -2029,6 +2276,7 @@ document.addEventListener('DOMContentLoaded', () => {
       file_type: data.file_type
     });
     localStorage.setItem('messageHistory', JSON.stringify(messageHistory));
+    if (!document.hidden) markRead(currentRoom);
 
     // Show notification for media files (but not for our own messages)
     if (data.nickname !== nickname && data.message.startsWith('/static/uploads/')) {
@@ -2040,7 +2288,7 @@ document.addEventListener('DOMContentLoaded', () => {
       }
       playNotificationSound();
     }
-  });
+  }
 
   socket.on('error', (data) => {
     showNotification('❌ ' + data.message, 'error');
@@ -2063,9 +2311,7 @@ document.addEventListener('DOMContentLoaded', () => {
   });
 
   socket.on('message_deleted', (data) => {
-    if (data.room === currentRoom) {
-      loadMessages(currentRoom);
-    }
+    removeMessageLocally(data.room, data.id);
   });
 
   socket.on('room_update', (data) => {
@@ -2787,24 +3033,23 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Load current user data and check premium
     Promise.all([
-      fetch(`/get_user_avatar/${nickname}`).then(r => r.json()).catch(() => ({avatar: '/static/default-avatar.svg'})),
-      fetch(`/get_user_profile/${nickname}`).then(r => r.json()).catch(() => ({bio: ''})),
+      getUserCard(nickname, 0).catch(() => ({avatar: '/static/default-avatar.svg', bio: ''})),
       fetch('/check_premium').then(r => r.json()).catch(() => ({premium: false})),
       fetch('/get_ui_settings').then(r => r.json()).catch(() => ({}))
-    ]).then(([avatarData, profileData, premiumData, uiSettings]) => {
+    ]).then(([card, premiumData, uiSettings]) => {
       const avatar = document.getElementById('settings-avatar');
       const bioInput = document.getElementById('bio-input');
 
       if (avatar) {
-        console.log('Avatar data received:', avatarData); // Debug log
+        console.log('Avatar data received:', card); // Debug log
         // Check if we have a valid avatar
-        if (avatarData && avatarData.avatar && 
-            avatarData.avatar !== '/static/default-avatar.png' && 
-            avatarData.avatar !== '/static/default-avatar.svg' &&
-            !avatarData.avatar.includes('default-avatar')) {
+        if (card && card.avatar && 
+            card.avatar !== '/static/default-avatar.png' && 
+            card.avatar !== '/static/default-avatar.svg' &&
+            !card.avatar.includes('default-avatar')) {
           
-          console.log('Loading custom avatar:', avatarData.avatar);
-          avatar.src = avatarData.avatar + '?t=' + Date.now(); // Force refresh
+          console.log('Loading custom avatar:', card.avatar);
+          avatar.src = card.avatar;
           avatar.onerror = function() {
             console.log('Avatar failed to load, using default');
             this.src = '/static/default-avatar.svg';
@@ -2815,9 +3060,9 @@ document.addEventListener('DOMContentLoaded', () => {
         }
       }
 
-      if (bioInput && profileData) {
-        bioInput.value = profileData.bio || '';
-        console.log('Bio loaded:', profileData.bio);
+      if (bioInput && card) {
+        bioInput.value = card.bio || '';
+        console.log('Bio loaded:', card.bio);
       }
 
       // Setup avatar upload after elements are loaded
@@ -3415,6 +3660,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const formData = new FormData();
     formData.append('file', file);
     formData.append('room', currentRoom);
+    formData.append('sid', socket.id);
 
     showNotification('📤 Uploading...', 'info');
 
@@ -3439,8 +3685,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
   // Update user status for private chats
   function updateUserStatus(username) {
-    fetch(`/user_status/${username}`)
-      .then(r => r.json())
+    getUserCard(username, 0)
       .then(data => {
         const statusEl = document.getElementById('user-status');
         if (statusEl) statusEl.remove();
@@ -3541,6 +3786,8 @@ document.addEventListener('DOMContentLoaded', () => {
   // Listen for avatar updates
   socket.on('avatar_updated', (data) => {
     if (data.user && data.avatar_url) {
+      forgetUserCard(data.user);
+
       // Update all avatars for this user in messages
       document.querySelectorAll(`.message-avatar[alt="${data.user}"]`).forEach(img => {
         img.src = data.avatar_url + '?t=' + Date.now();
@@ -3572,6 +3819,8 @@ document.addEventListener('DOMContentLoaded', () => {
   // Listen for profile updates
   socket.on('profile_updated', (data) => {
     if (data.user && data.bio !== undefined) {
+      forgetUserCard(data.user);
+
       // Update bio in open profile modals
       const profileBio = document.getElementById('profile-bio');
       if (profileBio && data.user !== nickname) {
@@ -3580,11 +3829,31 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   });
 
-  // Listen for online users list updates
+  // Presence arrives as versioned join/leave deltas; after a gap in the
+  // versions the full list is fetched again
+  let presenceVersion = null;
+
   socket.on('online_users_update', (data) => {
-    onlineUsers = new Set(data.users || []);
+    if (presenceVersion === null || data.version !== presenceVersion + 1) {
+      socket.emit('get_online_users');
+      return;
+    }
+    presenceVersion = data.version;
+    (data.joined || []).forEach(user => onlineUsers.add(user));
+    (data.left || []).forEach(user => onlineUsers.delete(user));
     updateChatListStatus();
     updateUsersList();
+
+    const changed = (data.joined || []).concat(data.left || []);
+    if (currentRoom.startsWith('private_')) {
+      const users = currentRoom.replace('private_', '').split('_');
+      const otherUser = users.find(u => u !== nickname) || users[0];
+      if (changed.includes(otherUser)) {
+        updateUserStatus(otherUser);
+      }
+    } else {
+      updateRoomStats(currentRoom);
+    }
   });
 
   // Real-time updates every 10 seconds for better responsiveness
@@ -3650,6 +3919,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const formData = new FormData();
     formData.append('file', file);
     formData.append('room', currentRoom);
+    formData.append('sid', socket.id);
 
     const fileType = isVideo ? 'video' : 'image';
     showNotification(`📤 Uploading ${fileType}...`, 'info');
@@ -3678,6 +3948,8 @@ document.addEventListener('DOMContentLoaded', () => {
     // Update chat display names in real-time
     const oldNick = data.old_nickname;
     const newNick = data.new_nickname;
+    forgetUserCard(oldNick);
+    forgetUserCard(newNick);
 
     // Update room list display names
     document.querySelectorAll('.chat-item').forEach(item => {
@@ -3743,11 +4015,10 @@ document.addEventListener('DOMContentLoaded', () => {
   // Load header avatar
   const headerAvatar = document.getElementById('header-avatar');
   if (headerAvatar) {
-    fetch(`/get_user_avatar/${nickname}`)
-      .then(r => r.json())
+    getUserCard(nickname)
       .then(data => {
         if (data.avatar && data.avatar !== '/static/default-avatar.png') {
-          headerAvatar.src = data.avatar + '?t=' + Date.now();
+          headerAvatar.src = data.avatar;
         } else {
           headerAvatar.src = '/static/default-avatar.svg';
         }
@@ -4033,8 +4304,7 @@ document.addEventListener('DOMContentLoaded', () => {
           const otherUser = users.find(u => u !== nickname) || users[0];
 
           // Real-time status update
-          fetch(`/user_status/${otherUser}`)
-            .then(r => r.json())
+          getUserCard(otherUser, 0)
             .then(data => {
               if (data.status === 'online') {
                 chatStatus.innerHTML = '🟢 У мережі';
@@ -4091,6 +4361,92 @@ document.addEventListener('DOMContentLoaded', () => {
     console.log('Connected to server');
     updateConnectionStatus('connected');
     socket.emit('join_room', { room: currentRoom });
+    // After a reconnect, fetch only what changed while we were away
+    if (connectedBefore) {
+      requestSync();
+    }
+    connectedBefore = true;
+  });
+
+  // Delta sync: send the last message id seen per room, get back only new
+  // messages, deletions and (if it changed) the room list
+  let connectedBefore = false;
+  let roomsHash = null;
+  let syncPending = false;
+
+  function syncPayload() {
+    const rooms = {};
+    Object.entries(messageHistory).forEach(([room, messages]) => {
+      const withIds = (messages || []).filter(msg => msg.id);
+      if (withIds.length) rooms[room] = withIds[withIds.length - 1].id;
+    });
+    const loaded = (messageHistory[currentRoom] || []).filter(msg => msg.id);
+    return {
+      rooms,
+      have: {[currentRoom]: loaded.slice(-500).map(msg => msg.id)},
+      rooms_hash: roomsHash
+    };
+  }
+
+  function requestSync() {
+    if (syncPending) return;
+    syncPending = true;
+    setTimeout(() => { syncPending = false; }, 10000);
+
+    if (socket.connected) {
+      socket.emit('sync', syncPayload());
+    } else {
+      fetch('/sync', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(syncPayload())
+      })
+      .then(r => r.json())
+      .then(applySync)
+      .catch(err => {
+        syncPending = false;
+        console.error('Sync failed:', err);
+      });
+    }
+  }
+
+  function applySync(data) {
+    syncPending = false;
+    if (data.rooms) {
+      loadRooms(data.rooms);
+    }
+    roomsHash = data.rooms_hash;
+
+    let currentChanged = false;
+    Object.entries(data.messages || {}).forEach(([room, messages]) => {
+      const known = new Set((messageHistory[room] || []).map(msg => msg.id));
+      const fresh = messages.filter(msg => !known.has(msg.id));
+      messageHistory[room] = (messageHistory[room] || []).concat(fresh);
+      if (room === currentRoom && fresh.length) currentChanged = true;
+    });
+    Object.entries(data.deleted || {}).forEach(([room, ids]) => {
+      const gone = new Set(ids);
+      messageHistory[room] = (messageHistory[room] || []).filter(msg => !gone.has(msg.id));
+      if (room === currentRoom) currentChanged = true;
+    });
+    (data.reset || []).forEach(room => {
+      delete messageHistory[room];
+      if (room === currentRoom) loadMessages(room);
+    });
+
+    localStorage.setItem('messageHistory', JSON.stringify(messageHistory));
+    if (currentChanged && !(data.reset || []).includes(currentRoom)) {
+      displayMessages(messageHistory[currentRoom] || []);
+    }
+  }
+
+  socket.on('sync', applySync);
+
+  document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'visible') {
+      requestSync();
+      markRead(currentRoom);
+    }
   });
 
   socket.on('disconnect', function() {
@@ -4126,7 +4482,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
   socket.on('online_users', function(data) {
     onlineUsers = new Set(data.users);
+    if (data.version !== undefined) presenceVersion = data.version;
     updateChatListStatus();
+    updateUsersList();
   });
 
   // Video reset function
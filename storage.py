@@ -0,0 +1,333 @@
+import os
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+import bin_codec
+from message_log import MessageLog
+from durable_writer import create_writer
+from shared_state import get_state
+
+# bin_name -> (backend stamp, parsed data); each bin is read once and served
+# from memory until the backend reports that it was changed from outside.
+_bin_cache = {}
+_cache_lock = threading.RLock()
+
+# Marks a cache entry whose latest save is still on its way to disk
+PENDING = object()
+
+# Per-bin locks, versions (bumped on every save or re-read, with the time of
+# the change) and saves in flight
+_bin_locks = {}
+_bin_versions = {}
+_pending_writes = {}
+
+# Durability waits deferred until the enclosing bin_transaction() ends
+_transaction = threading.local()
+
+# Names this process in validators built from its own counters; a forked
+# worker gets its own
+_process_token = uuid.uuid4().hex
+
+
+def _new_process_token():
+    global _process_token
+    _process_token = uuid.uuid4().hex
+
+
+os.register_at_fork(after_in_child=_new_process_token)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _file_stamp(filepath):
+    """Identify the current version of a file by inode, mtime and size"""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class JsonFileBackend:
+    """Default engine: one <bin>.json file per bin plus per-room message logs.
+
+    Every storage engine provides the same methods: stamp() returns a value
+    that changes whenever a bin changes (None if the bin does not exist),
+    read()/write() move whole bins, and `messages` is the chat history store.
+    """
+
+    name = 'json'
+
+    def __init__(self, directory='.', message_dir='message_log', writer=None,
+                 codec=None, hot_size=200):
+        self.directory = directory
+        self.codec = bin_codec.resolve_codec(
+            codec or os.environ.get('STORAGE_CODEC', 'json'))
+        self.writer = writer or create_writer()
+        self.messages = MessageLog(message_dir,
+                                   cap=1000,
+                                   writer=self.writer,
+                                   hot_size=hot_size)
+
+    def bin_path(self, bin_name):
+        return os.path.join(self.directory, f"{bin_name}.json")
+
+    def stamp(self, bin_name):
+        return _file_stamp(self.bin_path(bin_name))
+
+    def read(self, bin_name):
+        try:
+            with open(self.bin_path(bin_name), 'rb') as f:
+                return bin_codec.decode(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write(self, bin_name, data):
+        """Submit a bin write; returns a ticket to wait() on for durability"""
+        # Temp file + rename, so a crash mid-save can't truncate the bin
+        payload = bin_codec.encode(data, self.codec)
+        return self.writer.submit(self.bin_path(bin_name), payload)
+
+
+def create_backend(name=None):
+    """Build the storage engine selected by STORAGE_BACKEND (json or sqlite)"""
+    name = (name or os.environ.get('STORAGE_BACKEND', 'json')).lower()
+    message_dir = os.environ.get('MESSAGE_LOG_DIR', 'message_log')
+    hot_size = int(os.environ.get('MESSAGE_HOT_SIZE', 200))
+
+    if name == 'sqlite':
+        from sqlite_store import SQLiteBackend
+        return SQLiteBackend(os.environ.get('SQLITE_PATH', 'orbitmess.db'),
+                             durability=os.environ.get('STORAGE_DURABILITY', 'batch'),
+                             hot_size=hot_size)
+    if name != 'json':
+        print(f"Unknown STORAGE_BACKEND '{name}', using json")
+    if get_state().shared:
+        print("Warning: the JSON message log assumes one process; "
+              "use STORAGE_BACKEND=sqlite with several workers")
+    return JsonFileBackend('.', message_dir, hot_size=hot_size)
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+                print(f"Storage backend: {_backend.name}")
+    return _backend
+
+
+def bin_path(bin_name):
+    """Local file that backs a bin in the JSON engine"""
+    return f"{bin_name}.json"
+
+
+def bin_lock(bin_name):
+    """The lock guarding read-modify-write of one bin"""
+    lock = _bin_locks.get(bin_name)
+    if lock is None:
+        with _cache_lock:
+            lock = _bin_locks.setdefault(bin_name, threading.RLock())
+    return lock
+
+
+def _bump_version(bin_name):
+    version, _ = _bin_versions.get(bin_name, (0, 0))
+    _bin_versions[bin_name] = (version + 1, time.time())
+
+
+def bin_version(bin_name):
+    """Counter bumped whenever this process sees new data for a bin"""
+    return _bin_versions.get(bin_name, (0, 0))[0]
+
+
+def bin_validator(*bin_names):
+    """(stamps, time of the newest change) of some bins, for HTTP caching.
+
+    Loads each bin first, so changes written by another process count. The
+    stamps are the backend's, which every worker reading the same storage
+    agrees on; a bin whose latest save is still on its way to disk is named
+    by this process's own counter instead, which no other worker produces.
+    """
+    stamps = []
+    for bin_name in bin_names:
+        load_bin(bin_name)
+        cached = _bin_cache.get(bin_name)
+        stamp = cached[0] if cached else None
+        if stamp is PENDING:
+            stamp = (_process_token, bin_version(bin_name))
+        stamps.append(stamp)
+    changed = [_bin_versions.get(name, (0, 0))[1] for name in bin_names]
+    return tuple(stamps), max(changed + [0])
+
+
+@contextmanager
+def bin_transaction(*bin_names):
+    """Hold the locks of one or more bins for a read-modify-write.
+
+    Locks are taken in name order so transactions over several bins can't
+    deadlock. Saves made inside the block are applied to memory and queued
+    for disk right away, but waiting for them to become durable happens after
+    the locks are released, so other writers of the bin don't queue behind
+    the disk.
+
+    When the shared state is shared with other workers, each bin's shared
+    lock is held too, until the outermost transaction ends; those workers
+    read the bin from disk, so its saves are made durable before the locks
+    are let go.
+    """
+    names = sorted(set(bin_names))
+    locks = [bin_lock(name) for name in names]
+    for lock in locks:
+        lock.acquire()
+
+    outermost = getattr(_transaction, 'finishers', None) is None
+    if outermost:
+        _transaction.finishers = []
+        _transaction.shared_locks = {}
+    try:
+        state = get_state()
+        if state.shared:
+            for name in names:
+                if name not in _transaction.shared_locks:
+                    shared_lock = state.lock(f"bin:{name}")
+                    shared_lock.acquire()
+                    _transaction.shared_locks[name] = shared_lock
+        yield
+    finally:
+        try:
+            if outermost and _transaction.shared_locks:
+                _finish_transaction()
+        finally:
+            if outermost:
+                for shared_lock in _transaction.shared_locks.values():
+                    shared_lock.release()
+            for lock in reversed(locks):
+                lock.release()
+            if outermost:
+                try:
+                    _finish_transaction()
+                finally:
+                    _transaction.finishers = _transaction.shared_locks = None
+
+
+def _finish_transaction():
+    """Wait for the saves made in the current transaction to be durable"""
+    finishers, _transaction.finishers = _transaction.finishers, []
+    for finish in finishers:
+        finish()
+
+
+def load_bin(bin_name):
+    """Return bin data from memory, re-reading the backend only if it changed.
+
+    The returned object is shared by every caller: anything that mutates it
+    must do so inside bin_transaction() and hand it back to store_bin(), and
+    read-only callers must not modify it.
+    """
+    cached = _bin_cache.get(bin_name)
+    if cached and cached[0] is PENDING:
+        return cached[1]
+
+    backend = get_backend()
+    stamp = backend.stamp(bin_name)
+    if stamp is None:
+        return None
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    with _cache_lock:
+        cached = _bin_cache.get(bin_name)
+        if cached and (cached[0] is PENDING or cached[0] == stamp):
+            return cached[1]
+
+        data = backend.read(bin_name)
+        if data is None:
+            return None
+        # Stamp again after reading so a write racing with us is picked up next time
+        _bin_cache[bin_name] = (backend.stamp(bin_name), data)
+        _bump_version(bin_name)
+        return data
+
+
+def store_bin(bin_name, data):
+    """Write bin data to the backend and keep it as the in-memory copy"""
+    backend = get_backend()
+    with bin_lock(bin_name):
+        try:
+            ticket = backend.write(bin_name, data)
+        except Exception:
+            _bin_cache.pop(bin_name, None)
+            raise
+        _bump_version(bin_name)
+        _pending_writes[bin_name] = _pending_writes.get(bin_name, 0) + 1
+        # Serve the new data from memory until the disk has caught up
+        _bin_cache[bin_name] = (PENDING, data)
+
+    def finish():
+        try:
+            if ticket is not None:
+                ticket.wait()
+        finally:
+            with bin_lock(bin_name):
+                _pending_writes[bin_name] -= 1
+                cached = _bin_cache.get(bin_name)
+                if not _pending_writes[bin_name] and cached and cached[0] is PENDING:
+                    _bin_cache[bin_name] = (backend.stamp(bin_name), cached[1])
+
+    finishers = getattr(_transaction, 'finishers', None)
+    if finishers is not None:
+        finishers.append(finish)
+    else:
+        finish()
+
+
+def invalidate_bin(bin_name=None):
+    """Drop one bin (or all bins) from memory so the next load re-reads it"""
+    with _cache_lock:
+        if bin_name is None:
+            _bin_cache.clear()
+        else:
+            _bin_cache.pop(bin_name, None)
+
+
+def import_json_files(bin_names):
+    """Copy local <bin>.json files and message logs into a non-JSON backend.
+
+    Runs once per database: the backend remembers that the import happened.
+    """
+    backend = get_backend()
+    if backend.name == 'json' or backend.get_meta('imported_json'):
+        return False
+
+    source = JsonFileBackend('.',
+                             os.environ.get('MESSAGE_LOG_DIR', 'message_log'),
+                             writer=getattr(backend, 'writer', None))
+    print(f"Importing local JSON data into {backend.name} storage...")
+
+    for bin_name in bin_names:
+        if bin_name == 'messages':
+            continue
+        try:
+            data = source.read(bin_name)
+        except Exception as e:
+            print(f"Error reading {bin_name}.json: {e}")
+            continue
+        if data is not None:
+            backend.write(bin_name, data)
+            print(f"✓ Imported {bin_name}")
+
+    if source.messages.exists():
+        history = source.messages.snapshot()
+    else:
+        history = source.read('messages') or {}
+    backend.messages.import_rooms(history)
+    print(f"✓ Imported message history for {len(history)} rooms")
+
+    backend.set_meta('imported_json', '1')
+    invalidate_bin()
+    return True
@@ -0,0 +1,168 @@
+import time
+import threading
+
+
+class SyncQueue:
+    """Write-behind queue that uploads bins to JSONBin.io in the background.
+
+    Saving the same bin several times before it is uploaded collapses into one
+    upload of the latest data. Uploads are debounced by `interval` seconds (but
+    never held back longer than `max_delay`), and failed uploads are retried
+    with exponential backoff until newer data or a successful upload replaces them.
+    """
+
+    def __init__(self, upload, interval=2.0, max_delay=10.0, backoff=1.0,
+                 max_backoff=60.0):
+        self.upload = upload
+        self.interval = interval
+        self.max_delay = max(max_delay, interval)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # bin_name -> {'data', 'first', 'due', 'attempts'}
+        self._pending = {}
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+        self.uploaded = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='jsonbin-sync',
+                                            daemon=True)
+            self._thread.start()
+
+    def enqueue(self, bin_name, data):
+        """Schedule an upload of the latest data for a bin"""
+        now = time.time()
+        with self._cond:
+            entry = self._pending.get(bin_name)
+            if entry:
+                self.coalesced += 1
+                entry['data'] = data
+                entry['attempts'] = 0
+                entry['due'] = min(now + self.interval,
+                                   entry['first'] + self.max_delay)
+            else:
+                self._pending[bin_name] = {
+                    'data': data,
+                    'first': now,
+                    'due': now + self.interval,
+                    'attempts': 0
+                }
+            self._cond.notify()
+
+        # Also restarts the thread in a forked worker, where it no longer runs
+        if not self._thread or not self._thread.is_alive():
+            self.start()
+
+    def depth(self):
+        """Number of bins waiting to be uploaded"""
+        with self._cond:
+            return len(self._pending) + len(self._in_flight)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._pending) + len(self._in_flight),
+                'pending': sorted(self._pending),
+                'uploaded': self.uploaded,
+                'failed': self.failed,
+                'coalesced': self.coalesced
+            }
+
+    def flush(self, timeout=30):
+        """Upload everything that is queued right now; returns True if drained"""
+        deadline = time.time() + timeout
+        with self._cond:
+            for entry in self._pending.values():
+                entry['due'] = 0
+            self._cond.notify()
+
+        if not self._thread or not self._thread.is_alive():
+            self._drain_inline(deadline)
+
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.5))
+            return True
+
+    def stop(self, timeout=30):
+        """Flush queued uploads and stop the background thread"""
+        drained = self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=1)
+        return drained
+
+    def _take_due(self):
+        """Pop the bins whose upload is due; returns (items, seconds to wait)"""
+        now = time.time()
+        due = []
+        wait = None
+        for bin_name, entry in list(self._pending.items()):
+            if entry['due'] <= now:
+                due.append((bin_name, self._pending.pop(bin_name)))
+                self._in_flight.add(bin_name)
+            else:
+                delay = entry['due'] - now
+                wait = delay if wait is None else min(wait, delay)
+        return due, wait
+
+    def _upload_one(self, bin_name, entry):
+        try:
+            ok = self.upload(bin_name, entry['data'])
+        except Exception as e:
+            print(f"Sync error for {bin_name}: {e}")
+            ok = False
+
+        with self._cond:
+            self._in_flight.discard(bin_name)
+            if ok:
+                self.uploaded += 1
+            else:
+                self.failed += 1
+                # Newer data queued meanwhile supersedes the failed upload
+                if bin_name not in self._pending and not self._stopping:
+                    entry['attempts'] += 1
+                    delay = min(self.backoff * (2 ** (entry['attempts'] - 1)),
+                                self.max_backoff)
+                    entry['due'] = time.time() + delay
+                    self._pending[bin_name] = entry
+                    print(f"Sync of {bin_name} failed, retrying in {delay:.1f}s")
+            self._cond.notify_all()
+
+    def _drain_inline(self, deadline):
+        while time.time() < deadline:
+            with self._cond:
+                due, _ = self._take_due()
+            if not due:
+                return
+            for bin_name, entry in due:
+                self._upload_one(bin_name, entry)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due, wait = self._take_due()
+                while not due:
+                    if self._stopping:
+                        return
+                    self._cond.wait(wait)
+                    due, wait = self._take_due()
+
+            for bin_name, entry in due:
+                self._upload_one(bin_name, entry)
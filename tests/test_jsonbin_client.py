@@ -0,0 +1,153 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from jsonbin_client import JsonBinClient, create_client
+
+
+class StubJsonBin(BaseHTTPRequestHandler):
+    """Minimal stand-in for the JSONBin.io bins API"""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        server.requests.append((method, self.path, self.client_address))
+        if server.failures:
+            server.failures -= 1
+            self._reply(503, {'message': 'try again'})
+            return
+
+        bin_id = self.path.rsplit('/', 1)[-1]
+        if method == 'GET':
+            if bin_id in server.bins:
+                self._reply(200, {'record': server.bins[bin_id]})
+            else:
+                self._reply(404, {'message': 'Bin not found'})
+        elif method == 'PUT':
+            server.bins[bin_id] = json.loads(body)
+            self._reply(200, {'record': server.bins[bin_id]})
+        else:
+            bin_id = f"bin{len(server.bins) + 1}"
+            server.bins[bin_id] = json.loads(body)
+            self._reply(200, {'metadata': {'id': bin_id}})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubJsonBin)
+    server.bins = {}
+    server.requests = []
+    server.failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(stub):
+    client = JsonBinClient(f"http://127.0.0.1:{stub.server_port}/v3/b/",
+                           backoff=0)
+    yield client
+    client.close()
+
+
+def test_get_and_put_reuse_one_pooled_connection(stub, client):
+    stub.bins['abc'] = {'users': []}
+
+    assert client.get('abc').json() == {'record': {'users': []}}
+    assert client.put('abc', json={'users': ['a']}).status_code == 200
+    assert client.get('abc').json() == {'record': {'users': ['a']}}
+
+    assert [(method, path) for method, path, _ in stub.requests] == [
+        ('GET', '/v3/b/abc'), ('PUT', '/v3/b/abc'), ('GET', '/v3/b/abc')
+    ]
+    # Keep-alive: every call went over the same client socket
+    assert len({address for _, _, address in stub.requests}) == 1
+
+
+def test_base_url_override_points_the_client_at_the_stub(stub, monkeypatch):
+    monkeypatch.setenv('JSONBIN_BASE_URL',
+                       f"http://127.0.0.1:{stub.server_port}/v3/b")
+    stub.bins['abc'] = {'n': 1}
+
+    client = create_client('https://api.jsonbin.io/v3/b')
+    try:
+        assert client.get('abc').json() == {'record': {'n': 1}}
+    finally:
+        client.close()
+
+
+def test_post_creates_bin_at_base_url(stub, client):
+    response = client.post(json={'placeholder': 'data'})
+
+    assert response.json() == {'metadata': {'id': 'bin1'}}
+    assert stub.requests[0][:2] == ('POST', '/v3/b')
+
+
+def test_get_and_put_are_retried_on_server_errors(stub, client):
+    stub.bins['abc'] = {'n': 1}
+
+    stub.failures = 2
+    assert client.get('abc').json() == {'record': {'n': 1}}
+    assert len(stub.requests) == 3
+
+    stub.failures = 2
+    assert client.put('abc', json={'n': 2}).status_code == 200
+    assert len(stub.requests) == 6
+    assert stub.bins['abc'] == {'n': 2}
+
+
+def test_retries_give_up_with_the_last_response(stub, client):
+    stub.bins['abc'] = {}
+    stub.failures = 10
+
+    assert client.get('abc').status_code == 503
+    assert len(stub.requests) == 1 + 3  # first try plus `retries`
+
+
+def test_post_is_not_retried(stub, client):
+    stub.failures = 1
+
+    assert client.post(json={}).status_code == 503
+    assert len(stub.requests) == 1
+    assert stub.bins == {}
+
+
+def test_reset_replaces_the_session(stub, client):
+    stub.bins['abc'] = {}
+    client.get('abc')
+    old_session = client.session
+
+    client.reset()
+    client.get('abc')
+
+    assert client.session is not old_session
+    # The new session opened its own connection
+    assert len({address for _, _, address in stub.requests}) == 2
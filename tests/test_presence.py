@@ -0,0 +1,105 @@
+import os
+import time
+import uuid
+
+import pytest
+from flask import Flask
+from flask_socketio import SocketIO
+
+from presence import Presence
+from shared_state import LocalPubSubManager, LocalState
+
+
+def make_worker(channel, state):
+    """A Flask-SocketIO "worker" whose presence deltas are broadcast"""
+    app = Flask(__name__)
+    sio = SocketIO(app, client_manager=LocalPubSubManager(channel))
+
+    def broadcast(version, joined, left):
+        with app.app_context():
+            sio.emit('online_users_update',
+                     {'version': version, 'joined': joined, 'left': left})
+
+    # A long interval keeps the sweeper thread out of the test's way
+    presence = Presence(ttl=1, interval=3600, on_change=broadcast, state=state)
+    return app, sio, presence
+
+
+@pytest.fixture
+def workers():
+    channel = uuid.uuid4().hex
+    state = LocalState()  # what workers sharing one Redis would see
+    return make_worker(channel, state), make_worker(channel, state)
+
+
+def updates(client):
+    return [packet['args'][0] for packet in client.get_received()
+            if packet['name'] == 'online_users_update']
+
+
+def go_offline(presence, sid):
+    presence.disconnect(sid)
+    presence.sweep(time.time() + presence.ttl + 2)
+    presence.flush()
+
+
+def test_join_and_leave_are_announced_at_first_and_last_worker(workers):
+    (app1, sio1, presence1), (app2, sio2, presence2) = workers
+    watcher = sio2.test_client(app2)
+
+    presence1.touch('bob', sid='sid-1')
+    presence1.flush()
+    presence2.touch('bob', sid='sid-2')
+    presence2.flush()
+
+    joins = updates(watcher)
+    assert [update['joined'] for update in joins] == [['bob']]
+
+    go_offline(presence2, 'sid-2')
+    assert updates(watcher) == []
+    assert presence2.is_online('bob')
+
+    go_offline(presence1, 'sid-1')
+    leaves = updates(watcher)
+    assert [update['left'] for update in leaves] == [['bob']]
+    assert leaves[0]['version'] == joins[0]['version'] + 1
+    assert not presence2.is_online('bob')
+
+
+def test_users_of_a_dead_worker_are_reaped_by_the_others(workers):
+    (app1, sio1, presence1), (app2, sio2, presence2) = workers
+    watcher = sio1.test_client(app1)
+
+    presence2.touch('amy', sid='sid-1')
+    presence2.flush()
+    updates(watcher)
+
+    # presence2's worker is killed: it never flushes or closes again
+    presence1.dead_after = 0
+    presence1.flush()
+
+    assert [update['left'] for update in updates(watcher)] == [['amy']]
+    assert presence1.snapshot()[1] == []
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_forked_worker_starts_with_its_own_id_and_no_users(workers):
+    (_, _, presence), _ = workers
+    presence.touch('bob', sid='sid-1')
+    parent_id = presence.worker_id
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            result = (presence.worker_id != parent_id and
+                      not presence.is_online('bob') and
+                      presence.snapshot()[1] == [])
+            os.write(write_end, b'1' if result else b'0')
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end, 'rb') as f:
+        assert f.read() == b'1'
+    assert presence.worker_id == parent_id
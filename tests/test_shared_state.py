@@ -0,0 +1,79 @@
+import uuid
+
+import pytest
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+import shared_state
+from shared_state import LocalPubSubManager, LocalState
+
+
+def make_worker(channel):
+    """One "worker": a Flask-SocketIO server on the local stand-in broker"""
+    app = Flask(__name__)
+    sio = SocketIO(app, client_manager=LocalPubSubManager(channel))
+
+    @sio.on('join')
+    def on_join(room):
+        join_room(room)
+
+    @sio.on('say')
+    def on_say(text):
+        sio.emit('said', {'text': text})
+
+    return app, sio
+
+
+@pytest.fixture
+def workers():
+    channel = uuid.uuid4().hex  # brokers of other tests stay out of the way
+    return make_worker(channel), make_worker(channel)
+
+
+def received(client, event):
+    return [packet['args'][0] for packet in client.get_received()
+            if packet['name'] == event]
+
+
+def test_local_message_queue_uses_the_stand_in_broker(monkeypatch):
+    monkeypatch.setattr(shared_state, 'SOCKETIO_MESSAGE_QUEUE', 'local')
+
+    options = shared_state.socketio_options()
+
+    assert isinstance(options['client_manager'], LocalPubSubManager)
+
+
+def test_broadcast_reaches_a_client_of_another_worker(workers):
+    (app1, sio1), (app2, sio2) = workers
+    sender = sio1.test_client(app1)
+    listener = sio2.test_client(app2)
+
+    sender.emit('say', 'hello')
+
+    assert received(listener, 'said') == [{'text': 'hello'}]
+    assert received(sender, 'said') == [{'text': 'hello'}]
+
+
+def test_room_emit_reaches_only_members_on_other_workers(workers):
+    (app1, sio1), (app2, sio2) = workers
+    member = sio2.test_client(app2)
+    member.emit('join', 'user:bob')
+    outsider = sio2.test_client(app2)
+
+    with app1.app_context():
+        sio1.emit('unread_update', {'room': 'r', 'count': 1}, room='user:bob')
+
+    assert received(member, 'unread_update') == [{'room': 'r', 'count': 1}]
+    assert received(outsider, 'unread_update') == []
+
+
+def test_local_state_is_seen_by_everything_handed_it():
+    state = LocalState()
+
+    state.hincr('presence', 'bob')
+    state.hincr('presence', 'bob')
+
+    assert state.hget('presence', 'bob') == 2
+    assert state.hdecr('presence', 'bob') == 1
+    assert state.hdecr('presence', 'bob') == 0
+    assert state.hgetall('presence') == {}
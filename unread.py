@@ -0,0 +1,95 @@
+import threading
+
+
+class UnreadCounters:
+    """Unread message counts per user and room, kept in memory.
+
+    A user's count for a room is computed once from their read cursor (one
+    page read after it) and from then on updated incrementally:
+    message_added() bumps the count of every member whose counts are loaded,
+    joined() starts a new member's count at zero so it is bumped too, and
+    forget() makes the next counts() call recompute it. Counts stop at
+    `limit`, which clients show as "99+", so computing one never reads more
+    than a page.
+
+    Each count remembers the room version it is current at. A room changed
+    in some other way (an edit, a delete, a message sent through another
+    worker) is recomputed on the next counts() call.
+    """
+
+    def __init__(self, messages, limit=100):
+        self.messages = messages  # MessageLog or SQLiteMessageStore
+        self.limit = limit
+        self._counts = {}  # nickname -> {room: [unread count, room version]}
+        self._lock = threading.Lock()
+
+    def counts(self, nickname, rooms, cursors, hidden_for):
+        """Unread counts for a user's rooms.
+
+        `cursors` maps a room to the last message id the user has read (rooms
+        without one count from their first message); `hidden_for(room)`
+        returns the user's (upto, ids) hidden state, whose messages don't
+        count.
+        """
+        versions = {room: self.messages.versions.get(room)[0] for room in rooms}
+        with self._lock:
+            counts = self._counts.setdefault(nickname, {})
+            missing = [room for room in rooms
+                       if counts.get(room, (0, None))[1] != versions[room]]
+
+        for room in missing:
+            hidden_upto, hidden_ids = hidden_for(room)
+            window = self.messages.page(room,
+                                        self.limit,
+                                        after=cursors.get(room, 0),
+                                        hidden_upto=hidden_upto,
+                                        hidden_ids=hidden_ids)
+            count = sum(1 for m in window if m.get('nick') != nickname)
+            with self._lock:
+                counts[room] = [count, versions[room]]
+
+        with self._lock:
+            return {room: counts[room][0] if room in counts else 0
+                    for room in rooms}
+
+    def message_added(self, room, sender, members=None, count=1):
+        """Count new messages for room members (all loaded users if None).
+
+        Returns {nickname: new count} for the users whose count changed.
+        """
+        changed = {}
+        version = self.messages.versions.get(room)[0]
+        with self._lock:
+            nicknames = self._counts if members is None else members
+            for nickname in nicknames:
+                counts = self._counts.get(nickname)
+                if nickname == sender or counts is None or room not in counts:
+                    continue
+                entry = counts[room]
+                if entry[1] != version - 1:
+                    continue  # already counted, or stale and recomputed later
+                entry[1] = version
+                if entry[0] < self.limit:
+                    entry[0] = min(entry[0] + count, self.limit)
+                    changed[nickname] = entry[0]
+        return changed
+
+    def joined(self, nickname, room):
+        """A user became a member of a room, with everything in it read.
+
+        Call before reading the room's last id for their cursor: a message
+        racing with the join is then counted rather than missed.
+        """
+        version = self.messages.versions.get(room)[0]
+        with self._lock:
+            counts = self._counts.get(nickname)
+            if counts is not None:
+                counts[room] = [0, version]
+
+    def forget(self, nickname, room=None):
+        """Drop cached counts (one room or all) so they are recomputed"""
+        with self._lock:
+            if room is None:
+                self._counts.pop(nickname, None)
+            elif nickname in self._counts:
+                self._counts[nickname].pop(room, None)
@@ -0,0 +1,92 @@
+import os
+import threading
+
+DEFAULT_AVATAR = '/static/default-avatar.png'
+
+
+def _avatar_url(avatar, updated=None):
+    """Avatar URL with a version, so browsers cache it until it changes.
+
+    The version is the upload time stored with the user, or for avatars
+    uploaded before that was recorded, the file's mtime.
+    """
+    if not avatar or avatar == DEFAULT_AVATAR:
+        return DEFAULT_AVATAR
+    if updated:
+        return f"{avatar}?v={updated}"
+    try:
+        mtime = int(os.stat(avatar.lstrip('/')).st_mtime)
+    except OSError:
+        return avatar
+    return f"{avatar}?v={mtime}"
+
+
+class UserCards:
+    """Precomputed profile cards: nickname -> avatar, bio, joined, badges.
+
+    Rendering a room used to cost one request per user per field, each
+    loading a bin again. Cards are built from the users, verification and
+    premium bins and brought up to date whenever `key` (their bin versions)
+    changes; only the cards whose fields changed are rebuilt, so a profile
+    edit touches one card and at most one avatar file. Looking up many
+    cards is a dict access each. Online status changes too often to cache
+    and is added by the caller.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._cards = {}
+        self._fields = {}  # nickname -> the fields its card was built from
+        self._lock = threading.Lock()
+
+    def sync(self, key, load):
+        """Make sure the cards describe the bins with these versions.
+
+        `load()` returns (users, verification, premium) bin data and is only
+        called when the cards need rebuilding.
+        """
+        if key == self._key:
+            return
+        with self._lock:
+            if key == self._key:
+                return
+            users_data, verification, premium = load()
+            cards = {}
+            fields = {}
+            for info in list(users_data.values()):
+                if not isinstance(info, dict) or 'nickname' not in info:
+                    continue
+                nickname = info['nickname']
+                if nickname in fields:
+                    continue  # first record wins, as in UserIndex
+                fields[nickname] = (info.get('avatar'), info.get('avatar_updated'),
+                                    info.get('bio', ''), info.get('date', ''),
+                                    bool(verification.get(nickname, False)),
+                                    bool(premium.get(nickname, False)))
+                previous = self._fields.get(nickname)
+                if previous == fields[nickname]:
+                    cards[nickname] = self._cards[nickname]
+                    continue
+                avatar, updated, bio, joined, verified, is_premium = fields[nickname]
+                if previous and previous[:2] == (avatar, updated):
+                    avatar_url = self._cards[nickname]['avatar']
+                else:
+                    avatar_url = _avatar_url(avatar, updated)
+                cards[nickname] = {
+                    'avatar': avatar_url,
+                    'bio': bio,
+                    'joined': joined,
+                    'verified': verified,
+                    'premium': is_premium,
+                }
+            self._cards = cards
+            self._fields = fields
+            self._key = key
+
+    def get(self, nickname):
+        """A copy of the user's card; unknown users get the defaults"""
+        card = self._cards.get(nickname)
+        if card is None:
+            return {'avatar': DEFAULT_AVATAR, 'bio': '', 'joined': '',
+                    'verified': False, 'premium': False}
+        return dict(card)
@@ -0,0 +1,84 @@
+import threading
+
+
+class UserIndex:
+    """Nickname -> user record and IP -> nicknames lookups for the users bin.
+
+    The users bin is keyed by md5(ip_nickname), so finding a user by nickname
+    used to mean scanning every record. The index is built from the bin object
+    the store hands out and rebuilt whenever that object is replaced (e.g. the
+    file was edited outside the app); in-place creates, renames and deletes are
+    applied incrementally through added(), renamed() and removed().
+    """
+
+    def __init__(self):
+        self._source = None
+        self._by_nickname = {}  # nickname -> (user_id, record)
+        self._by_ip = {}  # ip -> set of nicknames
+        self._lock = threading.RLock()
+
+    def sync(self, users_data):
+        """Make sure the index describes this users bin object"""
+        if users_data is self._source:
+            return
+        with self._lock:
+            if users_data is self._source:
+                return
+            self._by_nickname = {}
+            self._by_ip = {}
+            for user_id, info in list(users_data.items()):
+                if isinstance(info, dict) and 'nickname' in info:
+                    # First record wins, as with the old linear scans
+                    if info['nickname'] not in self._by_nickname:
+                        self._add(user_id, info)
+            self._source = users_data
+
+    def _add(self, user_id, info):
+        self._by_nickname[info['nickname']] = (user_id, info)
+        ip = info.get('ip')
+        if ip:
+            self._by_ip.setdefault(ip, set()).add(info['nickname'])
+
+    def _discard_ip(self, ip, nickname):
+        nicknames = self._by_ip.get(ip)
+        if nicknames:
+            nicknames.discard(nickname)
+            if not nicknames:
+                del self._by_ip[ip]
+
+    def get(self, nickname):
+        """(user_id, record) for a nickname, or (None, None)"""
+        return self._by_nickname.get(nickname, (None, None))
+
+    def __contains__(self, nickname):
+        return nickname in self._by_nickname
+
+    def __len__(self):
+        return len(self._by_nickname)
+
+    def nicknames(self):
+        return list(self._by_nickname)
+
+    def nicknames_for_ip(self, ip):
+        return sorted(self._by_ip.get(ip, ()))
+
+    def added(self, user_id, info):
+        with self._lock:
+            self._add(user_id, info)
+
+    def renamed(self, old_nickname, new_nickname):
+        with self._lock:
+            entry = self._by_nickname.pop(old_nickname, None)
+            if not entry:
+                return
+            self._by_nickname[new_nickname] = entry
+            ip = entry[1].get('ip')
+            if ip:
+                self._discard_ip(ip, old_nickname)
+                self._by_ip.setdefault(ip, set()).add(new_nickname)
+
+    def removed(self, nickname):
+        with self._lock:
+            entry = self._by_nickname.pop(nickname, None)
+            if entry and entry[1].get('ip'):
+                self._discard_ip(entry[1]['ip'], nickname)